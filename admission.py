@@ -0,0 +1,260 @@
+"""
+Admission Control - Per-class concurrency limits, bounded queues and client rate limits
+"""
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app, g, jsonify, request
+
+# Classes used when a view is not explicitly assigned one
+READ_CLASS = 'read'
+READ_METHODS = ('GET', 'HEAD')
+MAX_TRACKED_CLIENTS = 10000
+_UNSET = object()
+
+
+def limit(admission_class):
+    """Assign a view to an admission class from ADMISSION_CLASSES.
+
+    admission_class may also be a function of the view arguments that returns
+    the class name, for views whose cost depends on what they act on.
+    """
+    def decorator(view):
+        view.admission_class = admission_class
+        return view
+    return decorator
+
+
+def exempt(view):
+    """Never queue or rate-limit a view (e.g. long-lived event streams)"""
+    view.admission_class = None
+    return view
+
+
+class Gate:
+    """Concurrency limit with a bounded wait queue for one admission class"""
+
+    def __init__(self, name, concurrency, queue, queue_timeout, **_):
+        self.name = name
+        self.concurrency = concurrency
+        self.queue_size = queue
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.rate_limited = 0
+        self.service_time = 0.0  # Moving average of seconds per request
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """Take a slot, waiting up to queue_timeout; False if the queue is full or the wait times out"""
+        with self._condition:
+            if self.active < self.concurrency and self.waiting == 0:
+                self.active += 1
+                self.admitted += 1
+                return True
+            if self.waiting >= self.queue_size:
+                self.rejected += 1
+                return False
+
+            self.waiting += 1
+            deadline = time.monotonic() + self.queue_timeout
+            try:
+                while self.active >= self.concurrency:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.timed_out += 1
+                        return False
+                    self._condition.wait(remaining)
+                self.active += 1
+                self.admitted += 1
+                return True
+            finally:
+                self.waiting -= 1
+
+    def release(self, duration):
+        with self._condition:
+            self.active -= 1
+            self.service_time = duration if not self.service_time else 0.8 * self.service_time + 0.2 * duration
+            self._condition.notify()
+
+    def retry_after(self):
+        """Seconds until a slot is likely to be free, from queue depth and service time"""
+        backlog = (self.waiting + self.active) / max(self.concurrency, 1)
+        return max(1, math.ceil(backlog * (self.service_time or 1.0)))
+
+    def snapshot(self):
+        return {
+            'concurrency': self.concurrency,
+            'queue_size': self.queue_size,
+            'active': self.active,
+            'waiting': self.waiting,
+            'admitted': self.admitted,
+            'rejected_queue_full': self.rejected,
+            'rejected_timeout': self.timed_out,
+            'rate_limited': self.rate_limited,
+            'avg_service_ms': round(self.service_time * 1000, 1),
+        }
+
+
+class RateLimiter:
+    """Token buckets per (client, class); least recently seen clients are evicted"""
+
+    def __init__(self, max_clients=MAX_TRACKED_CLIENTS):
+        self.max_clients = max_clients
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        """Spend a token; returns 0 if allowed, else the seconds until one is available"""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            wait = 0 if tokens >= 1 else (1 - tokens) / rate
+            if not wait:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+        return wait
+
+
+class AdmissionController:
+    def __init__(self):
+        self.gates = {}
+        self.limits = {}
+        self.rate_limiter = RateLimiter()
+        self.heavy_slots = None
+        self.heavy_in_use = 0
+        self._heavy_lock = threading.Lock()
+
+    def configure(self, classes, threads=None):
+        """Set up the gates; threads is the number a worker can spend on admitted requests.
+
+        A request waiting in a queue holds a thread just like a running one.
+        With a known thread count, every class's concurrency + queue is capped
+        to it, and all classes other than reads together may hold at most half
+        of it, so a burst of uploads or chats cannot starve reads.
+        """
+        self.limits = classes
+        self.gates = {name: Gate(name, **settings) for name, settings in classes.items()}
+        self.heavy_slots = None
+        if threads:
+            self.heavy_slots = max(1, threads // 2)
+            for gate in self.gates.values():
+                gate.concurrency = max(1, min(gate.concurrency, threads))
+                gate.queue_size = max(0, min(gate.queue_size, threads - gate.concurrency))
+
+    def _take_heavy_slot(self):
+        with self._heavy_lock:
+            if self.heavy_in_use >= self.heavy_slots:
+                return False
+            self.heavy_in_use += 1
+            return True
+
+    def _release_heavy_slot(self):
+        with self._heavy_lock:
+            self.heavy_in_use -= 1
+
+    def classify(self):
+        if request.method == 'OPTIONS':
+            return None  # CORS preflights are answered without running the view
+        view = current_app.view_functions.get(request.endpoint) if request.endpoint else None
+        if view is None:
+            return None
+        admission_class = getattr(view, 'admission_class', _UNSET)
+        if admission_class is _UNSET:
+            return READ_CLASS if request.method in READ_METHODS else None
+        if callable(admission_class):
+            return admission_class(**(request.view_args or {}))
+        return admission_class
+
+    def client_id(self):
+        if current_app.config.get('ADMISSION_TRUST_PROXY') and request.access_route:
+            return request.access_route[0]
+        return request.remote_addr or 'unknown'
+
+    def before_request(self):
+        if not current_app.config.get('ADMISSION_CONTROL_ENABLED', True):
+            return None
+        admission_class = self.classify()
+        gate = self.gates.get(admission_class)
+        if gate is None:
+            return None
+
+        settings = self.limits[admission_class]
+        if settings.get('rate'):
+            wait = self.rate_limiter.take(
+                (self.client_id(), admission_class), settings['rate'], settings.get('burst', settings['rate'])
+            )
+            if wait:
+                gate.rate_limited += 1
+                return _reject(429, 'Rate limit exceeded', admission_class, math.ceil(wait))
+
+        heavy = bool(self.heavy_slots) and admission_class != READ_CLASS
+        if heavy and not self._take_heavy_slot():
+            gate.rejected += 1
+            return _reject(503, 'Server busy', admission_class, gate.retry_after())
+        if not gate.acquire():
+            if heavy:
+                self._release_heavy_slot()
+            return _reject(503, 'Server busy', admission_class, gate.retry_after())
+        g.admission_heavy = heavy
+        g.admission_gate = gate
+        g.admission_started = time.monotonic()
+        return None
+
+    def teardown_request(self, exc=None):
+        gate = g.pop('admission_gate', None)
+        if gate is not None:
+            gate.release(time.monotonic() - g.pop('admission_started'))
+            if g.pop('admission_heavy', False):
+                self._release_heavy_slot()
+
+    def metrics(self):
+        return {name: gate.snapshot() for name, gate in self.gates.items()}
+
+    def prometheus(self):
+        """Metrics in the Prometheus text exposition format"""
+        lines = []
+        for metric, key, kind in (
+            ('admission_active', 'active', 'gauge'),
+            ('admission_waiting', 'waiting', 'gauge'),
+            ('admission_concurrency_limit', 'concurrency', 'gauge'),
+            ('admission_queue_limit', 'queue_size', 'gauge'),
+            ('admission_admitted_total', 'admitted', 'counter'),
+            ('admission_rejected_queue_full_total', 'rejected_queue_full', 'counter'),
+            ('admission_rejected_timeout_total', 'rejected_timeout', 'counter'),
+            ('admission_rate_limited_total', 'rate_limited', 'counter'),
+        ):
+            lines.append(f"# TYPE {metric} {kind}")
+            for name, snapshot in self.metrics().items():
+                lines.append(f'{metric}{{class="{name}"}} {snapshot[key]}')
+        return "\n".join(lines) + "\n"
+
+
+def _reject(status_code, message, admission_class, retry_after):
+    response = jsonify({'error': message, 'class': admission_class, 'retry_after': retry_after})
+    response.status_code = status_code
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+
+controller = AdmissionController()
+
+
+def init_app(app):
+    """Register admission control on a Flask app"""
+    threads = app.config.get('ADMISSION_WORKER_THREADS')
+    if threads:
+        # Open event streams hold threads that admitted requests cannot use
+        threads = max(1, threads - (app.config.get('EVENTS_MAX_STREAMS') or 0))
+    controller.configure(app.config.get('ADMISSION_CLASSES') or {}, threads)
+    # Runs first, so rejected requests never reach other hooks or the database
+    app.before_request_funcs.setdefault(None, []).insert(0, controller.before_request)
+    app.teardown_request(controller.teardown_request)
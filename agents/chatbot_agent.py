@@ -39,6 +39,16 @@ class ChatbotAgent:
             print("Using fallback response system (still functional)")
             self.chatbot = None
     
+    def after_fork(self, threads):
+        """Limit inference threads in a forked worker so workers do not oversubscribe the CPUs"""
+        if self.chatbot is None:
+            return
+        try:
+            import torch
+            torch.set_num_threads(threads)
+        except ImportError:
+            pass
+    
     def build_context(self, patient_context):
         """Build context string from patient data"""
         context_parts = []
@@ -51,9 +61,9 @@ class ChatbotAgent:
         if patient_context.get('documents'):
             context_parts.append("\nMedical Documents:")
             for doc in patient_context['documents']:
-                if doc.get('parsed_text'):
-                    # Use first 500 chars of each document
-                    text = doc['parsed_text'][:500]
+                if doc.get('text_preview'):
+                    # The stored preview is the first 500 chars of each document
+                    text = doc['text_preview']
                     context_parts.append(f"- {doc.get('document_type', 'Document')}: {text}...")
         
         # Add vitals context
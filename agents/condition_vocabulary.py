@@ -0,0 +1,103 @@
+"""
+Condition Vocabulary - Normalised condition and relation codes for family history
+"""
+import re
+
+# Canonical condition code -> free-text spellings seen in intake forms
+CONDITION_SYNONYMS = {
+    'hypertension': ['hypertension', 'high blood pressure', 'htn', 'high bp', 'elevated blood pressure'],
+    'diabetes_type_1': ['type 1 diabetes', 'diabetes type 1', 't1dm', 'juvenile diabetes', 'iddm', 'type i diabetes'],
+    'diabetes_type_2': ['type 2 diabetes', 'diabetes type 2', 't2dm', 'niddm', 'adult onset diabetes', 'type ii diabetes'],
+    'diabetes': ['diabetes', 'diabetes mellitus', 'dm', 'sugar', 'high blood sugar'],
+    'coronary_artery_disease': ['coronary artery disease', 'cad', 'coronary heart disease', 'ischemic heart disease', 'ischaemic heart disease', 'heart disease'],
+    'myocardial_infarction': ['myocardial infarction', 'heart attack', 'mi'],
+    'stroke': ['stroke', 'cva', 'cerebrovascular accident', 'brain attack'],
+    'hypercholesterolemia': ['hypercholesterolemia', 'high cholesterol', 'hyperlipidemia', 'familial hypercholesterolemia'],
+    'breast_cancer': ['breast cancer', 'breast carcinoma', 'ca breast'],
+    'ovarian_cancer': ['ovarian cancer', 'ovarian carcinoma'],
+    'colorectal_cancer': ['colorectal cancer', 'colon cancer', 'bowel cancer', 'rectal cancer'],
+    'prostate_cancer': ['prostate cancer', 'prostate carcinoma'],
+    'lung_cancer': ['lung cancer', 'lung carcinoma'],
+    'cancer': ['cancer', 'carcinoma', 'malignancy', 'tumor', 'tumour'],
+    'asthma': ['asthma', 'bronchial asthma'],
+    'alzheimers_disease': ['alzheimers', 'alzheimers disease', 'alzheimer disease'],
+    'dementia': ['dementia'],
+    'depression': ['depression', 'major depressive disorder', 'mdd'],
+    'bipolar_disorder': ['bipolar disorder', 'bipolar', 'manic depression'],
+    'schizophrenia': ['schizophrenia'],
+    'epilepsy': ['epilepsy', 'seizures', 'seizure disorder'],
+    'chronic_kidney_disease': ['chronic kidney disease', 'ckd', 'kidney disease', 'renal disease', 'renal failure'],
+    'thyroid_disease': ['thyroid disease', 'hypothyroidism', 'hyperthyroidism', 'thyroid'],
+    'osteoporosis': ['osteoporosis'],
+    'obesity': ['obesity', 'obese'],
+    'sickle_cell_disease': ['sickle cell disease', 'sickle cell anemia', 'sickle cell anaemia', 'sickle cell'],
+    'thalassemia': ['thalassemia', 'thalassaemia'],
+    'cystic_fibrosis': ['cystic fibrosis', 'cf'],
+    'huntingtons_disease': ['huntingtons disease', 'huntingtons', 'huntington disease'],
+    'glaucoma': ['glaucoma'],
+    'arthritis': ['arthritis', 'rheumatoid arthritis', 'osteoarthritis'],
+}
+
+# Normalised relation -> degree of relationship to the patient
+RELATION_DEGREES = {
+    'mother': 1, 'father': 1, 'parent': 1,
+    'sister': 1, 'brother': 1, 'sibling': 1,
+    'daughter': 1, 'son': 1, 'child': 1,
+    'maternal grandmother': 2, 'maternal grandfather': 2,
+    'paternal grandmother': 2, 'paternal grandfather': 2,
+    'grandmother': 2, 'grandfather': 2, 'grandparent': 2,
+    'aunt': 2, 'uncle': 2, 'niece': 2, 'nephew': 2,
+    'half sister': 2, 'half brother': 2, 'half sibling': 2,
+    'grandchild': 2, 'granddaughter': 2, 'grandson': 2,
+    'cousin': 3,
+}
+
+# Relations that name exactly one person, so repeated entries describe the same relative
+UNIQUE_RELATIONS = {
+    'mother', 'father',
+    'maternal grandmother', 'maternal grandfather',
+    'paternal grandmother', 'paternal grandfather',
+}
+
+RELATION_ALIASES = {
+    'mom': 'mother', 'mum': 'mother', 'dad': 'father',
+    'grandma': 'grandmother', 'grandpa': 'grandfather',
+    'half-sister': 'half sister', 'half-brother': 'half brother',
+}
+
+_SYNONYM_INDEX = {
+    spelling: code for code, spellings in CONDITION_SYNONYMS.items() for spelling in spellings
+}
+
+
+def _clean(text):
+    text = (text or '').lower().replace("'s", 's').replace("'", '')
+    return re.sub(r'[^a-z0-9]+', ' ', text).strip()
+
+
+def normalize_condition(condition):
+    """Map free-text condition to a canonical code; unknown conditions get a slug"""
+    cleaned = _clean(condition)
+    if not cleaned:
+        return None
+    return _SYNONYM_INDEX.get(cleaned, cleaned.replace(' ', '_'))
+
+
+def normalize_relation(relation):
+    """Map free-text relation to a normalised relation name"""
+    cleaned = (relation or '').strip().lower()
+    cleaned = RELATION_ALIASES.get(cleaned, cleaned)
+    return _clean(cleaned) or None
+
+
+def relation_degree(relation_code):
+    """Degree of relationship (1 = first-degree), or None if unknown"""
+    return RELATION_DEGREES.get(relation_code)
+
+
+def onset_bucket(age):
+    """Decade bucket label for an age of onset, e.g. '40-49'"""
+    if age is None:
+        return None
+    start = (int(age) // 10) * 10
+    return f"{start}-{start + 9}"
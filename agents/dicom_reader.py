@@ -0,0 +1,137 @@
+"""
+DICOM Reader - Header parsing, memory-mapped pixel access and windowed previews
+"""
+import struct
+from datetime import datetime
+
+from PIL import Image
+
+try:
+    import numpy as np
+    import pydicom
+    PYDICOM_AVAILABLE = True
+except ImportError:
+    PYDICOM_AVAILABLE = False
+
+PIXEL_DATA_TAG = (0x7FE0, 0x0010)
+UNDEFINED_LENGTH = 0xFFFFFFFF
+
+
+class UnsupportedPixelData(ValueError):
+    """Pixel data in a transfer syntax no installed decoder handles"""
+
+
+def _first(value):
+    """Multi-valued tags (e.g. several window centres) use their first value"""
+    if value is None or value == '':
+        return None
+    if isinstance(value, (list, tuple)) or type(value).__name__ == 'MultiValue':
+        return value[0] if len(value) else None
+    return value
+
+
+def _as_float(value):
+    value = _first(value)
+    return float(value) if value is not None else None
+
+
+def _as_date(value):
+    try:
+        return datetime.strptime(str(value), '%Y%m%d').date() if value else None
+    except ValueError:
+        return None
+
+
+def read_header(file_path):
+    """Parse DICOM tags without reading pixel data.
+
+    Returns a dict of the tags the application indexes or needs for
+    rendering, including the file offset of uncompressed pixel data.
+    """
+    with open(file_path, 'rb') as fp:
+        ds = pydicom.dcmread(fp, stop_before_pixels=True)
+        transfer_syntax = ds.file_meta.TransferSyntaxUID
+
+        # dcmread leaves the file positioned at the PixelData tag
+        pixel_data_offset = None
+        element_header = fp.read(12 if not transfer_syntax.is_implicit_VR else 8)
+        byte_order = '<' if transfer_syntax.is_little_endian else '>'
+        if len(element_header) >= 8 and struct.unpack(byte_order + 'HH', element_header[:4]) == PIXEL_DATA_TAG:
+            if transfer_syntax.is_implicit_VR:
+                length = struct.unpack(byte_order + 'I', element_header[4:8])[0]
+            else:
+                length = struct.unpack(byte_order + 'I', element_header[8:12])[0]
+            if length != UNDEFINED_LENGTH and not transfer_syntax.is_compressed:
+                pixel_data_offset = fp.tell()
+
+    return {
+        'modality': ds.get('Modality'),
+        'study_instance_uid': ds.get('StudyInstanceUID'),
+        'series_instance_uid': ds.get('SeriesInstanceUID'),
+        'sop_instance_uid': ds.get('SOPInstanceUID'),
+        'rows': ds.get('Rows'),
+        'columns': ds.get('Columns'),
+        'number_of_frames': int(ds.get('NumberOfFrames') or 1),
+        'acquisition_date': _as_date(ds.get('AcquisitionDate') or ds.get('StudyDate')),
+        'transfer_syntax_uid': str(transfer_syntax),
+        'pixel_data_offset': pixel_data_offset,
+        'bits_allocated': ds.get('BitsAllocated'),
+        'pixel_representation': ds.get('PixelRepresentation', 0),
+        'samples_per_pixel': ds.get('SamplesPerPixel', 1),
+        'photometric_interpretation': ds.get('PhotometricInterpretation'),
+        'little_endian': transfer_syntax.is_little_endian,
+        'window_center': _as_float(ds.get('WindowCenter')),
+        'window_width': _as_float(ds.get('WindowWidth')),
+        'rescale_slope': _as_float(ds.get('RescaleSlope')) or 1.0,
+        'rescale_intercept': _as_float(ds.get('RescaleIntercept')) or 0.0,
+    }
+
+
+def pixel_frames(file_path, header):
+    """Pixel data as an array of shape (frames, rows, columns[, samples]).
+
+    Uncompressed data is memory-mapped, so only the pages of the frames that
+    are actually touched are read. Compressed transfer syntaxes have to be
+    decoded by pydicom, which loads the whole dataset.
+    """
+    shape = (header['number_of_frames'], header['rows'], header['columns'])
+    if header['samples_per_pixel'] > 1:
+        shape += (header['samples_per_pixel'],)
+
+    if header['pixel_data_offset'] is None:
+        try:
+            return pydicom.dcmread(file_path).pixel_array.reshape(shape)
+        except (NotImplementedError, RuntimeError) as e:
+            raise UnsupportedPixelData(f"Cannot decode pixel data: {str(e)}") from e
+
+    kind = 'i' if header['pixel_representation'] else 'u'
+    byte_order = '<' if header['little_endian'] else '>'
+    dtype = np.dtype(f"{byte_order}{kind}{header['bits_allocated'] // 8}")
+    return np.memmap(file_path, dtype=dtype, mode='r', offset=header['pixel_data_offset'], shape=shape)
+
+
+def render_preview(file_path, header, frame=None, center=None, width=None, max_size=(1024, 1024)):
+    """Render one frame with a VOI window into an 8-bit PIL image"""
+    frames = pixel_frames(file_path, header)
+    frame = header['number_of_frames'] // 2 if frame is None else frame
+    if not 0 <= frame < header['number_of_frames']:
+        raise ValueError(f"Frame {frame} out of range")
+
+    pixels = np.asarray(frames[frame])
+    if header['samples_per_pixel'] > 1:
+        img = Image.fromarray(pixels.astype(np.uint8))
+    else:
+        values = pixels.astype(np.float32) * header['rescale_slope'] + header['rescale_intercept']
+        center = center if center is not None else header['window_center']
+        width = width if width is not None else header['window_width']
+        if center is None or not width:
+            low, high = float(values.min()), float(values.max())
+        else:
+            low, high = center - width / 2.0, center + width / 2.0
+        scaled = np.clip((values - low) / max(high - low, 1e-6), 0.0, 1.0) * 255.0
+        if header['photometric_interpretation'] == 'MONOCHROME1':
+            scaled = 255.0 - scaled
+        img = Image.fromarray(scaled.astype(np.uint8))
+
+    img.thumbnail(max_size, Image.Resampling.LANCZOS)
+    return img
@@ -7,6 +7,8 @@ import pytesseract
 from PIL import Image
 import PyPDF2
 
+import text_store
+
 class DocumentAgent:
     """Agent responsible for processing medical documents"""
     
@@ -73,18 +75,24 @@ class DocumentAgent:
         except Exception as e:
             return f"Error with image OCR: {str(e)}"
     
-    def store_document(self, patient_id, filename, file_path, parsed_text, document_type, db_session):
+    def store_document(self, patient_id, filename, file_path, parsed_text, document_type, db_session, sha256=None):
         """Store document in database"""
-        from database import Document
+        from database import Document, DocumentText, touch_section
         
         doc = Document(
             patient_id=patient_id,
             filename=filename,
             file_path=file_path,
-            parsed_text=parsed_text,
+            sha256=sha256,
+            text_preview=text_store.preview(parsed_text),
+            text_length=len(parsed_text) if parsed_text else 0,
             document_type=document_type
         )
+        if parsed_text:
+            codec, blob = text_store.compress_text(parsed_text)
+            doc.text = DocumentText(codec=codec, data=blob)
         db_session.add(doc)
+        touch_section(db_session, patient_id, 'documents')
         db_session.commit()
         return doc.to_dict()
 
@@ -1,6 +1,7 @@
 """
 Family History Agent - Handles patient family history input and storage
 """
+from agents import condition_vocabulary
 
 class FamilyHistoryAgent:
     """Agent responsible for managing patient family history"""
@@ -32,7 +33,7 @@ class FamilyHistoryAgent:
     
     def store_family_history(self, patient_id, history_data, db_session):
         """Store family history in database"""
-        from database import FamilyHistory
+        from database import FamilyHistory, touch_section, GLOBAL_SCOPE
         
         fh = FamilyHistory(
             patient_id=patient_id,
@@ -43,9 +44,194 @@ class FamilyHistoryAgent:
         )
         
         db_session.add(fh)
+        self.update_aggregates(fh, db_session)
+        touch_section(db_session, patient_id, 'family_history')
+        touch_section(db_session, GLOBAL_SCOPE, 'family_history_aggregates')
         db_session.commit()
         return fh.to_dict()
     
+    def update_aggregates(self, fh, db_session):
+        """Normalise an entry and fold it into the cohort aggregates (same transaction)"""
+        fh.condition_code = condition_vocabulary.normalize_condition(fh.condition)
+        fh.relation_code = condition_vocabulary.normalize_relation(fh.relation)
+        self.add_to_aggregates([{
+            'patient_id': fh.patient_id,
+            'condition_code': fh.condition_code,
+            'relation_code': fh.relation_code,
+            'age_of_onset': fh.age_of_onset
+        }], db_session)
+    
+    def add_to_aggregates(self, entries, db_session):
+        """Fold normalised entries into the aggregates, one UPDATE per distinct key.
+        
+        The entries must already be in the session.
+        """
+        self._add_counts(entries, db_session)
+        self.refresh_risks(db_session, {
+            (entry['patient_id'], entry['condition_code']) for entry in entries if entry['condition_code']
+        })
+    
+    def _add_counts(self, entries, db_session):
+        from database import FamilyConditionStat, FamilyOnsetBucket, increment_counters
+        
+        stats, buckets = {}, {}
+        for entry in entries:
+            condition_code = entry['condition_code']
+            if not condition_code:
+                continue
+            age = entry['age_of_onset']
+            
+            stat = stats.setdefault((condition_code, entry['relation_code'] or 'unknown'), [0, 0, 0])
+            stat[0] += 1
+            if age is not None:
+                stat[1] += 1
+                stat[2] += age
+                bucket = (condition_code, condition_vocabulary.onset_bucket(age))
+                buckets[bucket] = buckets.get(bucket, 0) + 1
+        
+        for (condition_code, relation_code), (count, onset_count, onset_sum) in stats.items():
+            increment_counters(
+                db_session, FamilyConditionStat,
+                {'condition_code': condition_code, 'relation_code': relation_code},
+                entries=count, onset_count=onset_count, onset_sum=onset_sum
+            )
+        for (condition_code, bucket), count in buckets.items():
+            increment_counters(
+                db_session, FamilyOnsetBucket,
+                {'condition_code': condition_code, 'bucket': bucket},
+                entries=count
+            )
+    
+    def refresh_risks(self, db_session, keys=None):
+        """Recount the affected relatives behind PatientConditionRisk rows.
+        
+        Relations that name one person (mother, father, the grandparents) count
+        once per patient and condition however many entries mention them, e.g.
+        one per visit. Entries for other relations, such as two sisters, and
+        entries without a relation each count as a relative. keys limits the
+        recount to those (patient_id, condition_code) pairs.
+        """
+        from database import FamilyHistory, PatientConditionRisk, upsert
+        from sqlalchemy import case, distinct, func, or_
+        
+        if keys is not None and not keys:
+            return
+        first_degree = {
+            code for code, degree in condition_vocabulary.RELATION_DEGREES.items() if degree == 1
+        }
+        unique = condition_vocabulary.UNIQUE_RELATIONS
+        relation = FamilyHistory.relation_code
+        repeatable = or_(relation.is_(None), relation.notin_(unique))
+        query = db_session.query(
+            FamilyHistory.patient_id,
+            FamilyHistory.condition_code,
+            func.count(distinct(case((relation.in_(first_degree & unique), relation)))),
+            func.sum(case((relation.in_(first_degree - unique), 1), else_=0)),
+            func.count(distinct(case((relation.in_(unique), relation)))),
+            func.sum(case((repeatable, 1), else_=0))
+        ).filter(FamilyHistory.condition_code.isnot(None))
+        if keys is not None:
+            query = query.filter(
+                FamilyHistory.patient_id.in_({patient_id for patient_id, _ in keys}),
+                FamilyHistory.condition_code.in_({condition_code for _, condition_code in keys})
+            )
+        
+        for patient_id, condition_code, unique_first, other_first, unique_total, other_total in query.group_by(
+            FamilyHistory.patient_id, FamilyHistory.condition_code
+        ):
+            counts = {
+                'first_degree_count': unique_first + (other_first or 0),
+                'total_count': unique_total + (other_total or 0)
+            }
+            upsert(
+                db_session, PatientConditionRisk,
+                {'patient_id': patient_id, 'condition_code': condition_code}, counts, counts
+            )
+    
+    def rebuild_aggregates(self, db_session, batch_size=1000):
+        """Recompute all aggregates from the family_history table"""
+        from database import FamilyHistory, FamilyConditionStat, FamilyOnsetBucket, PatientConditionRisk
+        
+        for model in (FamilyConditionStat, FamilyOnsetBucket, PatientConditionRisk):
+            db_session.query(model).delete()
+        
+        count = 0
+        batch = []
+        for fh in db_session.query(FamilyHistory).order_by(FamilyHistory.id).yield_per(batch_size):
+            fh.condition_code = condition_vocabulary.normalize_condition(fh.condition)
+            fh.relation_code = condition_vocabulary.normalize_relation(fh.relation)
+            batch.append({
+                'patient_id': fh.patient_id,
+                'condition_code': fh.condition_code,
+                'relation_code': fh.relation_code,
+                'age_of_onset': fh.age_of_onset
+            })
+            count += 1
+            if len(batch) >= batch_size:
+                self._add_counts(batch, db_session)
+                batch = []
+        self._add_counts(batch, db_session)
+        db_session.flush()
+        self.refresh_risks(db_session)
+        db_session.commit()
+        return count
+    
+    def get_cohort_analytics(self, db_session, condition=None, min_first_degree=2, limit=100):
+        """Population views answered from the aggregate tables"""
+        from database import FamilyConditionStat, FamilyOnsetBucket, PatientConditionRisk
+        from sqlalchemy import func
+        
+        condition_code = condition_vocabulary.normalize_condition(condition) if condition else None
+        
+        stats = db_session.query(FamilyConditionStat)
+        buckets = db_session.query(FamilyOnsetBucket)
+        at_risk = db_session.query(PatientConditionRisk).filter(
+            PatientConditionRisk.first_degree_count >= min_first_degree
+        )
+        risk_counts = db_session.query(
+            PatientConditionRisk.condition_code, func.count()
+        ).filter(PatientConditionRisk.first_degree_count >= min_first_degree)
+        
+        if condition_code:
+            stats = stats.filter(FamilyConditionStat.condition_code == condition_code)
+            buckets = buckets.filter(FamilyOnsetBucket.condition_code == condition_code)
+            at_risk = at_risk.filter(PatientConditionRisk.condition_code == condition_code)
+            risk_counts = risk_counts.filter(PatientConditionRisk.condition_code == condition_code)
+        
+        onset_distribution = {}
+        for bucket in buckets.order_by(FamilyOnsetBucket.condition_code, FamilyOnsetBucket.bucket):
+            onset_distribution.setdefault(bucket.condition_code, {})[bucket.bucket] = bucket.entries
+        
+        return {
+            'condition': condition_code,
+            'condition_relation_counts': [
+                {
+                    'condition': stat.condition_code,
+                    'relation': stat.relation_code,
+                    'count': stat.entries,
+                    'mean_age_of_onset': round(stat.onset_sum / stat.onset_count, 1) if stat.onset_count else None
+                }
+                for stat in stats.order_by(FamilyConditionStat.entries.desc())
+            ],
+            'onset_distribution': onset_distribution,
+            'hereditary_risk': {
+                'min_first_degree_relatives': min_first_degree,
+                'patients_by_condition': dict(
+                    risk_counts.group_by(PatientConditionRisk.condition_code).all()
+                ),
+                'patients': [
+                    {
+                        'patient_id': risk.patient_id,
+                        'condition': risk.condition_code,
+                        'first_degree_relatives': risk.first_degree_count
+                    }
+                    for risk in at_risk.order_by(
+                        PatientConditionRisk.first_degree_count.desc(), PatientConditionRisk.patient_id
+                    ).limit(limit)
+                ]
+            }
+        }
+    
     def get_family_history_summary(self, patient_id, db_session):
         """Get formatted family history summary for a patient"""
         from database import FamilyHistory
@@ -1,15 +1,44 @@
 """
 Image Agent - Handles medical image upload and storage
 """
+import io
 import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from flask import current_app
 from PIL import Image
 
+from agents import dicom_reader, image_pyramid, perceptual_hash
+from storage import SNIFF_SIZE, sniff_format
+import tiering
+
 class ImageAgent:
     """Agent responsible for managing medical images"""
     
-    def __init__(self):
+    def __init__(self, max_workers=2):
         self.supported_formats = ['png', 'jpg', 'jpeg', 'dicom', 'dcm']
-        self.max_image_size = (2048, 2048)  # Max dimensions
+        self.max_similarity_distance = 11  # Keeps the per-band search radius at 2 bits
+        self.preview_sizes = (256, 512, 1024, 2048, 4096)
+        self.header_formats = {'png', 'jpeg', 'dicom'}  # Formats recognised from the leading bytes
+        self.dicom_columns = [
+            'modality', 'study_instance_uid', 'series_instance_uid', 'sop_instance_uid',
+            'rows', 'columns', 'number_of_frames', 'acquisition_date',
+            'transfer_syntax_uid', 'pixel_data_offset'
+        ]
+        # Tiles and thumbnails are built off the request thread
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='image-derivatives')
+        # Images with a background job queued or running, so each is only built once at a time
+        self._in_flight = set()
+        self._in_flight_lock = threading.Lock()
+    
+    def after_fork(self):
+        """Give a forked worker its own executor; threads and queued work are not inherited"""
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='image-derivatives')
+        self._in_flight = set()
+        self._in_flight_lock = threading.Lock()
     
     def validate_image(self, file_path):
         """Validate medical image file"""
@@ -21,44 +50,343 @@ class ImageAgent:
         except Exception as e:
             return False, f"Invalid image file: {str(e)}"
     
+    def validate_header(self, head, file_format):
+        """Validate an upload from its leading bytes, before the body is stored"""
+        if file_format not in self.header_formats:
+            return False, "Invalid image file: unrecognised image format"
+        if file_format == 'dicom' and not dicom_reader.PYDICOM_AVAILABLE:
+            return False, "DICOM support requires the pydicom and numpy packages"
+        return True, None
+    
+    def is_dicom(self, file_path):
+        """Check the DICOM preamble of a stored file"""
+        with open(file_path, 'rb') as f:
+            return sniff_format(f.read(SNIFF_SIZE)) == 'dicom'
+    
     def process_image(self, file_path):
-        """Process and optionally resize image"""
+        """Read image info from the file header; the original file is never modified"""
         try:
-            img = Image.open(file_path)
-            
-            # Get image info
-            info = {
-                'format': img.format,
-                'mode': img.mode,
-                'size': img.size
-            }
+            if self.is_dicom(file_path):
+                tags = dicom_reader.read_header(file_path)
+                return {
+                    'format': 'DICOM',
+                    'mode': tags['photometric_interpretation'],
+                    'size': (tags['columns'], tags['rows']),
+                    'dicom': tags
+                }
             
-            # Optionally resize if too large
-            if img.size[0] > self.max_image_size[0] or img.size[1] > self.max_image_size[1]:
-                img.thumbnail(self.max_image_size, Image.Resampling.LANCZOS)
-                img.save(file_path, optimize=True)
-                info['resized'] = True
-            
-            return info
+            with Image.open(file_path) as img:
+                return {
+                    'format': img.format,
+                    'mode': img.mode,
+                    'size': img.size
+                }
         except Exception as e:
             return {'error': str(e)}
     
-    def store_image(self, patient_id, filename, file_path, image_type, description, db_session):
-        """Store image metadata in database"""
+    def derived_dir(self, image_id, derived_root):
+        """Directory holding the tile pyramid and thumbnails of an image"""
+        return os.path.join(derived_root, str(image_id))
+    
+    def schedule_processing(self, image_id, file_path, derived_root, dicom_tags=None):
+        """Hash a new upload and, unless it is DICOM, build its pyramid in the background"""
+        self._claim(image_id)  # A new upload, so nothing else can be building it
+        return self._submit(self._process_upload, image_id, file_path, derived_root, dicom_tags)
+    
+    def _claim(self, image_id):
+        """Mark an image as having a background job, False if it already has one"""
+        with self._in_flight_lock:
+            if image_id in self._in_flight:
+                return False
+            self._in_flight.add(image_id)
+            return True
+    
+    def _release(self, image_id):
+        with self._in_flight_lock:
+            self._in_flight.discard(image_id)
+    
+    def _submit(self, job, image_id, *args):
+        """Run job(image_id, *args, db_session) on the executor; the image's claim is released when it ends"""
+        app = current_app._get_current_object()
+        try:
+            future = self.executor.submit(self._run_job, app, job, image_id, *args)
+        except Exception:
+            self._release(image_id)
+            raise
+        future.add_done_callback(lambda done: self._release(image_id))
+        future.add_done_callback(self._log_job_failure)
+        return future
+    
+    @staticmethod
+    def _run_job(app, job, *args):
+        with app.app_context():
+            from database import db
+            return job(*args, db.session)
+    
+    @staticmethod
+    def _log_job_failure(future):
+        error = future.exception()
+        if error is not None:
+            print(f"Warning: Background image job failed: {str(error)}")
+    
+    def _process_upload(self, image_id, file_path, derived_root, dicom_tags, db_session):
+        self.hash_image(image_id, file_path, dicom_tags, db_session)
+        # DICOM previews are rendered lazily on request instead of tiled up front
+        if not dicom_tags:
+            self.build_derivatives(image_id, file_path, derived_root, db_session)
+    
+    def hash_image(self, image_id, file_path, dicom_tags, db_session):
+        """Compute and record an image's perceptual hash, flagging it if it nearly duplicates an earlier one"""
+        from database import MedicalImage, touch_section
+        
+        source_path = tiering.local_path(file_path)
+        phash = self.compute_phash(source_path, dicom_tags) if source_path else None
+        image = db_session.get(MedicalImage, image_id)
+        if phash is None or image is None:
+            return None
+        self.set_phash(image, phash)
+        
+        # Re-exports, screenshots and resized copies of the patient's earlier images
+        matches = self.find_similar(
+            phash, db_session, current_app.config['PHASH_DUPLICATE_DISTANCE'],
+            patient_id=image.patient_id, exclude_id=image.id
+        )
+        earlier = [match for match in matches if match['id'] < image.id]
+        image.near_duplicate_of = earlier[0]['id'] if earlier else None
+        touch_section(db_session, image.patient_id, 'images')
+        db_session.commit()
+        return phash
+    
+    def build_derivatives(self, image_id, file_path, derived_root, db_session):
+        """Build an image's pyramid and thumbnails now and record whether it worked"""
+        status, error = 'ready', None
+        try:
+            source_path = tiering.local_path(file_path)
+            if source_path is None:
+                raise FileNotFoundError("Original image file is missing")
+            image_pyramid.build_derivatives(source_path, self.derived_dir(image_id, derived_root))
+        except Exception as e:
+            status, error = 'failed', str(e)
+            print(f"Warning: Could not build image derivatives: {error}")
+        self.set_derivatives_status(image_id, status, db_session, error)
+        db_session.commit()
+        return status
+    
+    def set_derivatives_status(self, image_id, status, db_session, error=None):
+        from database import MedicalImage, touch_section
+        
+        image = db_session.get(MedicalImage, image_id)
+        if image is None:
+            return
+        image.derivatives_status = status
+        image.derivatives_error = error
+        image.derivatives_updated_at = datetime.utcnow()
+        # The status is part of the image list
+        touch_section(db_session, image.patient_id, 'images')
+    
+    def get_derivatives_state(self, image, derived_root, db_session, stale_after):
+        """(status, descriptor) of an image's pyramid.
+        
+        A build that has been pending longer than stale_after seconds was lost
+        (e.g. queued when the server restarted), and a ready pyramid whose files
+        are gone must be rebuilt; both are queued again unless this process
+        already has a job for the image queued or running.
+        """
+        status = image.derivatives_status
+        if status == 'ready':
+            info = self.get_tile_info(image.id, derived_root)
+            if info:
+                return status, info
+            if not self._claim(image.id):
+                return 'pending', None  # Being rebuilt already
+        elif status == 'pending':
+            # Images from before derivatives were tracked have no timestamp and are built now
+            updated_at = image.derivatives_updated_at
+            if updated_at and (datetime.utcnow() - updated_at).total_seconds() < stale_after:
+                return status, None
+            if not self._claim(image.id):
+                return status, None  # Still queued or building in this process
+        else:
+            return status, None
+        
+        try:
+            self.set_derivatives_status(image.id, 'pending', db_session)
+            db_session.commit()
+        except Exception:
+            self._release(image.id)
+            raise
+        self._submit(self.build_derivatives, image.id, image.file_path, derived_root)
+        return 'pending', None
+    
+    def get_tile_info(self, image_id, derived_root):
+        """Pyramid descriptor for an image, or None while it is being built"""
+        return image_pyramid.read_descriptor(self.derived_dir(image_id, derived_root))
+    
+    def get_tile_path(self, image_id, level, col, row, derived_root):
+        """Path of a tile, or None if the pyramid is not ready or the tile is out of range"""
+        output_dir = self.derived_dir(image_id, derived_root)
+        info = image_pyramid.read_descriptor(output_dir)
+        if not info or not 0 <= level <= info['max_level']:
+            return None
+        
+        level_width, level_height = image_pyramid.level_dimensions(info['width'], info['height'], level)
+        cols, rows = image_pyramid.tile_grid(level_width, level_height, info['tile_size'])
+        if not (0 <= col < cols and 0 <= row < rows):
+            return None
+        return image_pyramid.tile_path(output_dir, level, col, row)
+    
+    def get_thumbnail_path(self, image_id, size, derived_root):
+        """Path of a thumbnail, or None if it has not been built yet"""
+        if size not in image_pyramid.THUMBNAIL_SIZES:
+            return None
+        path = image_pyramid.thumbnail_path(self.derived_dir(image_id, derived_root), size)
+        return path if os.path.exists(path) else None
+    
+    def compute_phash(self, file_path, dicom_tags=None):
+        """Perceptual hash of an image, or None if it cannot be decoded"""
+        try:
+            if dicom_tags:
+                return perceptual_hash.dhash(
+                    dicom_reader.render_preview(file_path, dicom_tags, max_size=(64, 64))
+                )
+            with Image.open(file_path) as img:
+                return perceptual_hash.dhash(img)
+        except Exception as e:
+            print(f"Warning: Could not hash image {file_path}: {str(e)}")
+            return None
+    
+    def set_phash(self, img, phash):
+        """Record a perceptual hash and its search bands on a MedicalImage"""
+        if phash is None:
+            return
+        img.phash = perceptual_hash.to_signed(phash)
+        for i, band in enumerate(perceptual_hash.bands(phash)):
+            setattr(img, f"phash_band{i}", band)
+    
+    def find_similar(self, phash, db_session, max_distance=6, patient_id=None, exclude_id=None, limit=50):
+        """Images whose perceptual hash is within max_distance bits of phash.
+        
+        Candidates come from an indexed lookup of each hash band against its
+        Hamming neighbours, so only a small slice of the table is verified.
+        """
+        from sqlalchemy import or_
         from database import MedicalImage
         
+        max_distance = max(0, min(max_distance, self.max_similarity_distance))
+        radius = perceptual_hash.band_radius(max_distance)
+        conditions = [
+            getattr(MedicalImage, f"phash_band{i}").in_(perceptual_hash.band_neighbours(band, radius))
+            for i, band in enumerate(perceptual_hash.bands(phash))
+        ]
+        
+        query = db_session.query(
+            MedicalImage.id, MedicalImage.patient_id, MedicalImage.filename, MedicalImage.image_type, MedicalImage.phash
+        ).filter(or_(*conditions))
+        if patient_id is not None:
+            query = query.filter(MedicalImage.patient_id == patient_id)
+        if exclude_id is not None:
+            query = query.filter(MedicalImage.id != exclude_id)
+        
+        matches = []
+        for image_id, owner_id, filename, image_type, stored in query:
+            distance = perceptual_hash.hamming(phash, perceptual_hash.to_unsigned(stored))
+            if distance <= max_distance:
+                matches.append({
+                    'id': image_id,
+                    'patient_id': owner_id,
+                    'filename': filename,
+                    'image_type': image_type,
+                    'distance': distance
+                })
+        
+        matches.sort(key=lambda match: (match['distance'], match['id']))
+        return matches[:limit]
+    
+    def store_image(self, patient_id, filename, file_path, image_type, description, db_session, sha256=None, dicom_tags=None):
+        """Store image metadata in database"""
+        from database import MedicalImage, DicomMetadata, touch_section
+        
         img = MedicalImage(
             patient_id=patient_id,
             filename=filename,
             file_path=file_path,
+            sha256=sha256,
             image_type=image_type,
-            description=description
+            description=description,
+            derivatives_status='none' if dicom_tags else 'pending'
         )
+
+        
+        if dicom_tags:
+            img.dicom = DicomMetadata(
+                patient_id=patient_id,
+                **{column: dicom_tags.get(column) for column in self.dicom_columns}
+            )
         
         db_session.add(img)
+        touch_section(db_session, patient_id, 'images')
         db_session.commit()
         return img.to_dict()
     
+    def find_dicom_images(self, patient_id, db_session, modality=None, study_uid=None, series_uid=None):
+        """Look up a patient's DICOM images through the indexed tag columns"""
+        from database import MedicalImage, DicomMetadata
+        
+        query = (
+            db_session.query(MedicalImage, DicomMetadata)
+            .join(DicomMetadata, DicomMetadata.image_id == MedicalImage.id)
+            .filter(DicomMetadata.patient_id == patient_id)
+        )
+        if modality:
+            query = query.filter(DicomMetadata.modality == modality.upper())
+        if study_uid:
+            query = query.filter(DicomMetadata.study_instance_uid == study_uid)
+        if series_uid:
+            query = query.filter(DicomMetadata.series_instance_uid == series_uid)
+        
+        query = query.order_by(DicomMetadata.acquisition_date, MedicalImage.id)
+        return [dict(img.to_dict(), dicom=tags.to_dict()) for img, tags in query]
+    
+    def get_dicom_preview(self, image, derived_root, frame=None, center=None, width=None, size=1024):
+        """Render a windowed PNG preview of a DICOM image, None if the file is missing.
+
+        The size is rounded up to one of preview_sizes. Previews in the stored
+        window are cached on disk and returned as a path; a custom center or
+        width is rendered into memory each time, so request parameters cannot
+        fill the disk with variants.
+        """
+        size = next((allowed for allowed in self.preview_sizes if allowed >= size), self.preview_sizes[-1])
+        output_dir = self.derived_dir(image.id, derived_root)
+        cached = center is None and width is None
+        preview_path = os.path.join(output_dir, f"preview_{frame}_{size}.png")
+        if cached and os.path.exists(preview_path):
+            return preview_path
+        
+        file_path = tiering.local_path(image.file_path)
+        if file_path is None:
+            return None
+        header = dicom_reader.read_header(file_path)
+        preview = dicom_reader.render_preview(
+            file_path, header, frame=frame, center=center, width=width, max_size=(size, size)
+        )
+        if not cached:
+            buffer = io.BytesIO()
+            preview.save(buffer, format='PNG')
+            buffer.seek(0)
+            return buffer
+        
+        os.makedirs(output_dir, exist_ok=True)
+        # A private temp file per render, so concurrent requests never write the same file
+        fd, tmp_path = tempfile.mkstemp(dir=output_dir, prefix='.preview-', suffix='.png')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                preview.save(f, format='PNG')
+            os.replace(tmp_path, preview_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        return preview_path
+    
     def get_image_summary(self, patient_id, db_session):
         """Get summary of all images for a patient"""
         from database import MedicalImage
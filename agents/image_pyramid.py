@@ -0,0 +1,131 @@
+"""
+Image Pyramid - Deep Zoom style tile pyramids and thumbnails for medical images
+"""
+import json
+import math
+import os
+import shutil
+import tempfile
+
+from PIL import Image
+
+TILE_SIZE = 254
+TILE_OVERLAP = 1
+TILE_FORMAT = 'jpg'
+TILE_QUALITY = 90
+THUMBNAIL_SIZES = {
+    'small': (256, 256),
+    'medium': (1024, 1024),
+}
+DESCRIPTOR_NAME = 'pyramid.json'
+
+
+def max_level(width, height):
+    """Index of the full-resolution level (level 0 is 1x1)"""
+    return int(math.ceil(math.log2(max(width, height, 1))))
+
+
+def level_dimensions(width, height, level):
+    """Pixel dimensions of a pyramid level"""
+    scale = 2 ** (max_level(width, height) - level)
+    return max(1, int(math.ceil(width / scale))), max(1, int(math.ceil(height / scale)))
+
+
+def tile_grid(level_width, level_height, tile_size=TILE_SIZE):
+    """Number of (columns, rows) of tiles at a level"""
+    return int(math.ceil(level_width / tile_size)), int(math.ceil(level_height / tile_size))
+
+
+def tile_box(col, row, level_width, level_height, tile_size=TILE_SIZE, overlap=TILE_OVERLAP):
+    """Crop box of a tile, including overlap with its neighbours"""
+    left = col * tile_size - (overlap if col > 0 else 0)
+    top = row * tile_size - (overlap if row > 0 else 0)
+    right = min((col + 1) * tile_size + overlap, level_width)
+    bottom = min((row + 1) * tile_size + overlap, level_height)
+    return left, top, right, bottom
+
+
+def tile_path(output_dir, level, col, row):
+    return os.path.join(output_dir, 'tiles', str(level), f"{col}_{row}.{TILE_FORMAT}")
+
+
+def thumbnail_path(output_dir, size):
+    return os.path.join(output_dir, f"thumbnail_{size}.{TILE_FORMAT}")
+
+
+def read_descriptor(output_dir):
+    """Return the pyramid descriptor, or None while it is still being built"""
+    try:
+        with open(os.path.join(output_dir, DESCRIPTOR_NAME)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def displayable(img):
+    """Convert an image to a mode that can be written as JPEG"""
+    if img.mode in ('I;16', 'I;16B', 'I;16L', 'I', 'F'):
+        if img.mode.startswith('I;16'):
+            img = img.convert('I')
+        lo, hi = img.getextrema()
+        scale = 255.0 / (hi - lo) if hi > lo else 1.0
+        return img.point(lambda v: (v - lo) * scale).convert('L')
+    if img.mode not in ('RGB', 'L'):
+        return img.convert('RGB')
+    return img
+
+
+def build_derivatives(source_path, output_dir):
+    """Build the tile pyramid and thumbnails for an image.
+
+    The original file is only read. Output is written to a scratch directory
+    and moved into place once complete, with the descriptor written last, so
+    readers never see a half-built pyramid.
+    """
+    parent_dir, name = os.path.split(os.path.abspath(output_dir))
+    os.makedirs(parent_dir, exist_ok=True)
+    # Unique per build, so a concurrent build never removes this one's files
+    scratch_dir = tempfile.mkdtemp(prefix=f".{name}.tmp-", dir=parent_dir)
+
+    try:
+        source = Image.open(source_path)
+        source.load()
+        img = displayable(source)
+        width, height = img.size
+        top = max_level(width, height)
+
+        for size_name, size in THUMBNAIL_SIZES.items():
+            thumb = img.copy()
+            thumb.thumbnail(size, Image.Resampling.LANCZOS)
+            thumb.save(thumbnail_path(scratch_dir, size_name), quality=TILE_QUALITY)
+
+        level_img = img
+        for level in range(top, -1, -1):
+            level_width, level_height = level_dimensions(width, height, level)
+            if level_img.size != (level_width, level_height):
+                level_img = level_img.resize((level_width, level_height), Image.Resampling.LANCZOS)
+
+            os.makedirs(os.path.join(scratch_dir, 'tiles', str(level)))
+            cols, rows = tile_grid(level_width, level_height)
+            for col in range(cols):
+                for row in range(rows):
+                    box = tile_box(col, row, level_width, level_height)
+                    level_img.crop(box).save(tile_path(scratch_dir, level, col, row), quality=TILE_QUALITY)
+
+        descriptor = {
+            'width': width,
+            'height': height,
+            'tile_size': TILE_SIZE,
+            'overlap': TILE_OVERLAP,
+            'format': TILE_FORMAT,
+            'max_level': top,
+        }
+        shutil.rmtree(output_dir, ignore_errors=True)
+        os.replace(scratch_dir, output_dir)
+        with open(os.path.join(output_dir, DESCRIPTOR_NAME + '.tmp'), 'w') as f:
+            json.dump(descriptor, f)
+        os.replace(os.path.join(output_dir, DESCRIPTOR_NAME + '.tmp'), os.path.join(output_dir, DESCRIPTOR_NAME))
+        return descriptor
+    except Exception:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+        raise
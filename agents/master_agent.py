@@ -11,12 +11,12 @@ from agents.teeth_agent import TeethAgent
 class MasterAgent:
     """Master agent that controls and coordinates all sub-agents"""
     
-    def __init__(self):
+    def __init__(self, image_workers=2):
         self.document_agent = DocumentAgent()
         self.vitals_agent = VitalsAgent()
         self.family_history_agent = FamilyHistoryAgent()
         self.chatbot_agent = ChatbotAgent()
-        self.image_agent = ImageAgent()
+        self.image_agent = ImageAgent(max_workers=image_workers)
         self.teeth_agent = TeethAgent()
     
     def get_agent(self, agent_type):
@@ -31,9 +31,19 @@ class MasterAgent:
         }
         return agents.get(agent_type)
     
+    def after_fork(self, inference_threads=1):
+        """Reset per-process state in a worker forked from a preloaded parent.
+
+        Model weights loaded before the fork stay shared copy-on-write;
+        only thread pools are recreated.
+        """
+        self.image_agent.after_fork()
+        self.chatbot_agent.after_fork(inference_threads)
+    
     def get_patient_context(self, patient_id, db_session):
         """Aggregate all patient information for context"""
         from database import Patient, Document, Vital, FamilyHistory, MedicalImage
+        import tiering
         
         patient = db_session.query(Patient).filter_by(id=patient_id).first()
         if not patient:
@@ -42,7 +52,7 @@ class MasterAgent:
         context = {
             'patient': patient.to_dict(),
             'documents': [doc.to_dict() for doc in patient.documents],
-            'vitals': [vital.to_dict() for vital in patient.vitals],
+            'vitals': [vital for batch in tiering.vitals_batches(db_session, patient_id) for vital in batch],
             'family_history': [fh.to_dict() for fh in patient.family_history],
             'images': [img.to_dict() for img in patient.images],
             'dental_records': [record.to_dict() for record in patient.dental_records]
@@ -0,0 +1,74 @@
+"""
+Perceptual Hash - dHash fingerprints and multi-index Hamming search helpers
+"""
+from itertools import combinations
+
+from PIL import Image
+
+from agents import image_pyramid
+
+HASH_BITS = 64
+BAND_COUNT = 4
+BAND_BITS = HASH_BITS // BAND_COUNT
+BAND_MASK = (1 << BAND_BITS) - 1
+
+
+def dhash(img):
+    """64-bit difference hash of a PIL image.
+
+    Robust to re-encoding, resizing and small brightness changes, which is
+    what distinguishes a re-exported or screenshotted X-ray from a new one.
+    """
+    if img.format == 'JPEG':
+        # Let the decoder downscale in the DCT domain instead of decoding full size
+        img.draft('L', (64, 64))
+    # Stretch 16-bit and float images to their own range; a plain convert('L') clips them
+    gray = image_pyramid.displayable(img).convert('L').resize((9, 8), Image.Resampling.LANCZOS)
+    pixels = list(gray.getdata())
+
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            right = pixels[row * 9 + col + 1]
+            value = (value << 1) | (1 if right > left else 0)
+    return value
+
+
+def to_signed(value):
+    """Store an unsigned 64-bit hash in a signed BIGINT column"""
+    return value - (1 << HASH_BITS) if value >= 1 << (HASH_BITS - 1) else value
+
+
+def to_unsigned(value):
+    return value + (1 << HASH_BITS) if value < 0 else value
+
+
+def bands(value):
+    """Split a hash into BAND_COUNT disjoint substrings for multi-index hashing"""
+    return [(value >> (i * BAND_BITS)) & BAND_MASK for i in range(BAND_COUNT)]
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+def band_neighbours(band, radius):
+    """Every band value within Hamming distance radius of band"""
+    values = [band]
+    for distance in range(1, radius + 1):
+        for positions in combinations(range(BAND_BITS), distance):
+            flipped = band
+            for position in positions:
+                flipped ^= 1 << position
+            values.append(flipped)
+    return values
+
+
+def band_radius(max_distance):
+    """Per-band search radius that guarantees every match within max_distance.
+
+    If two hashes differ in at most max_distance bits, at least one of the
+    BAND_COUNT bands differs in at most max_distance // BAND_COUNT bits.
+    """
+    return max_distance // BAND_COUNT
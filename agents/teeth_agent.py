@@ -12,7 +12,7 @@ class TeethAgent:
     
     def _normalize_condition(self, condition: str) -> str:
         """Normalize and validate condition strings."""
-        if not condition:
+        if not condition or not isinstance(condition, str):
             return ''
         condition = condition.strip().lower()
         return condition if condition in self.allowed_conditions else ''
@@ -22,7 +22,7 @@ class TeethAgent:
     
     def update_tooth_condition(self, patient_id: int, tooth_id: str, condition: str, db_session) -> Tuple[Dict, int]:
         """Create, update, or delete a tooth condition entry."""
-        from database import DentalAssessment
+        from database import DentalAssessment, touch_section
         
         if not self._is_valid_tooth(tooth_id):
             return {'error': 'Invalid tooth identifier'}, 400
@@ -39,6 +39,7 @@ class TeethAgent:
         if not normalized_condition:
             if record:
                 db_session.delete(record)
+                touch_section(db_session, patient_id, 'teeth')
                 db_session.commit()
             return {'tooth_id': tooth_id, 'condition': None, 'action': 'removed'}, 200
         
@@ -52,9 +53,23 @@ class TeethAgent:
             )
             db_session.add(record)
         
+        touch_section(db_session, patient_id, 'teeth')
         db_session.commit()
         return {'tooth_id': tooth_id, 'condition': record.condition, 'action': 'saved'}, 200
     
+    def normalize_teeth(self, teeth: Dict[str, str]) -> Tuple[Dict[str, str], list]:
+        """Validate a tooth_id -> condition mapping; returns (valid entries, errors)."""
+        valid, errors = {}, []
+        for tooth_id, condition in (teeth or {}).items():
+            normalized_condition = self._normalize_condition(condition)
+            if not self._is_valid_tooth(tooth_id):
+                errors.append(f"Invalid tooth identifier: {tooth_id}")
+            elif not normalized_condition:
+                errors.append(f"Invalid condition for {tooth_id}: {condition}")
+            else:
+                valid[tooth_id.lower()] = normalized_condition
+        return valid, errors
+    
     def get_teeth(self, patient_id: int, db_session) -> Dict[str, str]:
         """Return a mapping of tooth_id to condition for a patient."""
         from database import DentalAssessment
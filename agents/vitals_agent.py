@@ -66,28 +66,27 @@ class VitalsAgent:
         
         return errors
     
+    def normalize_vitals(self, vitals_data):
+        """Convert submitted vital signs to column values (empty strings become None)"""
+        return {
+            'temperature': float(vitals_data.get('temperature')) if vitals_data.get('temperature') else None,
+            'weight': float(vitals_data.get('weight')) if vitals_data.get('weight') else None,
+            'height': float(vitals_data.get('height')) if vitals_data.get('height') else None,
+            'blood_pressure_systolic': int(vitals_data.get('blood_pressure_systolic')) if vitals_data.get('blood_pressure_systolic') else None,
+            'blood_pressure_diastolic': int(vitals_data.get('blood_pressure_diastolic')) if vitals_data.get('blood_pressure_diastolic') else None,
+            'heart_rate': int(vitals_data.get('heart_rate')) if vitals_data.get('heart_rate') else None,
+            'respiratory_rate': int(vitals_data.get('respiratory_rate')) if vitals_data.get('respiratory_rate') else None,
+            'oxygen_saturation': float(vitals_data.get('oxygen_saturation')) if vitals_data.get('oxygen_saturation') else None
+        }
+    
     def store_vitals(self, patient_id, vitals_data, db_session):
         """Store vital signs in database"""
-        from database import Vital
-        
-        # Convert empty strings to None
-        for key in vitals_data:
-            if vitals_data[key] == '':
-                vitals_data[key] = None
+        from database import Vital, touch_section
         
-        vital = Vital(
-            patient_id=patient_id,
-            temperature=float(vitals_data.get('temperature')) if vitals_data.get('temperature') else None,
-            weight=float(vitals_data.get('weight')) if vitals_data.get('weight') else None,
-            height=float(vitals_data.get('height')) if vitals_data.get('height') else None,
-            blood_pressure_systolic=int(vitals_data.get('blood_pressure_systolic')) if vitals_data.get('blood_pressure_systolic') else None,
-            blood_pressure_diastolic=int(vitals_data.get('blood_pressure_diastolic')) if vitals_data.get('blood_pressure_diastolic') else None,
-            heart_rate=int(vitals_data.get('heart_rate')) if vitals_data.get('heart_rate') else None,
-            respiratory_rate=int(vitals_data.get('respiratory_rate')) if vitals_data.get('respiratory_rate') else None,
-            oxygen_saturation=float(vitals_data.get('oxygen_saturation')) if vitals_data.get('oxygen_saturation') else None
-        )
+        vital = Vital(patient_id=patient_id, **self.normalize_vitals(vitals_data))
         
         db_session.add(vital)
+        touch_section(db_session, patient_id, 'vitals')
         db_session.commit()
         return vital.to_dict()
 
@@ -2,35 +2,99 @@
 Clinical Assistant Application - Flask Backend
 Main application file with API endpoints
 """
-from flask import Flask, request, jsonify, render_template, send_from_directory
+from flask import Flask, request, jsonify, render_template, send_file, stream_with_context
 from flask_cors import CORS
 import os
 from werkzeug.utils import secure_filename
 from datetime import datetime
 import uuid
+import time
+import random
 
 from config import Config
-from database import db, Patient, Document, Vital, FamilyHistory, MedicalImage, DentalAssessment
+import admission
+import archive
+import bulk_io
+import compression
+import events
+import migrations
+import storage
+import streaming
+import resumable_uploads
+import text_store
+import tiering
+from serialization import ClinicalJSONProvider
+from database import db, Patient, Document, DocumentText, Vital, FamilyHistory, MedicalImage, DentalAssessment, UploadSession, touch_section, init_engine, GLOBAL_SCOPE
+from conditional import conditional_get, PATIENT_SECTIONS
 from agents.master_agent import MasterAgent
+from agents import dicom_reader, perceptual_hash
 
 app = Flask(__name__)
+app.request_class = storage.UploadRequest
+app.json = ClinicalJSONProvider(app)
 app.config.from_object(Config)
 CORS(app)
+compression.init_app(app)
+admission.init_app(app)
 
 # Initialize database
 db.init_app(app)
+init_engine(app)
+events.init_app(app, db)
 
 # Initialize master agent
-master_agent = MasterAgent()
+master_agent = MasterAgent(image_workers=app.config['IMAGE_WORKERS'])
 
 # Create upload directory
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs(os.path.join(app.config['UPLOAD_FOLDER'], 'documents'), exist_ok=True)
 os.makedirs(os.path.join(app.config['UPLOAD_FOLDER'], 'images'), exist_ok=True)
+os.makedirs(os.path.join(app.config['UPLOAD_FOLDER'], 'derived'), exist_ok=True)
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
 
+def derived_root():
+    return os.path.abspath(os.path.join(app.config['UPLOAD_FOLDER'], 'derived'))
+
+def incoming_dir():
+    return os.path.join(app.config['UPLOAD_FOLDER'], 'incoming')
+
+def timestamped_filename(original_name):
+    # The uuid keeps same-named uploads in the same second from sharing a path
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    return f"{timestamp}_{uuid.uuid4().hex}_{secure_filename(original_name)}"
+
+def finish_document_upload(patient_id, ingested, filename, document_type):
+    """Parse and store a document that has been moved into uploads/documents"""
+    document_agent = master_agent.get_agent('document')
+    parsed_text = document_agent.parse_document(ingested.path, filename)
+    
+    doc = document_agent.store_document(
+        patient_id, filename, ingested.path, parsed_text, document_type, db.session, sha256=ingested.sha256
+    )
+    return jsonify(doc), 201
+
+def finish_image_upload(patient_id, ingested, filename, image_type, description):
+    """Read metadata for and store an image that has been moved into uploads/images"""
+    image_agent = master_agent.get_agent('image')
+    
+    # Header-only read; full decoding happens in the background workers
+    image_info = image_agent.process_image(ingested.path)
+    if 'error' in image_info:
+        os.remove(ingested.path)
+        return jsonify({'error': f"Invalid image file: {image_info['error']}"}), 400
+    
+    img = image_agent.store_image(
+        patient_id, filename, ingested.path, image_type, description, db.session,
+        sha256=ingested.sha256, dicom_tags=image_info.get('dicom')
+    )
+    
+    # Hashing and tiling decode the whole image, so both run in the background workers
+    image_agent.schedule_processing(img['id'], ingested.path, derived_root(), image_info.get('dicom'))
+    
+    return jsonify(img), 201
+
 # ==================== Frontend Routes ====================
 
 @app.route('/')
@@ -47,10 +111,10 @@ def patient_detail(patient_id):
 
 # Patient Management
 @app.route('/api/patients', methods=['GET'])
+@conditional_get('patients', scope=GLOBAL_SCOPE)
 def get_patients():
     """Get all patients"""
-    patients = Patient.query.all()
-    return jsonify([p.to_dict() for p in patients])
+    return streaming.stream_list(streaming.list_select(Patient).order_by(Patient.id))
 
 @app.route('/api/patients', methods=['POST'])
 def create_patient():
@@ -70,17 +134,20 @@ def create_patient():
     
     patient = Patient(reference_number=ref_number, name=name)
     db.session.add(patient)
+    touch_section(db.session, GLOBAL_SCOPE, 'patients')
     db.session.commit()
     
     return jsonify(patient.to_dict()), 201
 
 @app.route('/api/patients/<int:patient_id>', methods=['GET'])
+@conditional_get('patient')
 def get_patient(patient_id):
     """Get patient by ID"""
     patient = Patient.query.get_or_404(patient_id)
     return jsonify(patient.to_dict())
 
 @app.route('/api/patients/<int:patient_id>/context', methods=['GET'])
+@conditional_get(*PATIENT_SECTIONS)
 def get_patient_context(patient_id):
     """Get full patient context for chatbot"""
     context = master_agent.get_patient_context(patient_id, db.session)
@@ -88,8 +155,95 @@ def get_patient_context(patient_id):
         return jsonify({'error': 'Patient not found'}), 404
     return jsonify(context)
 
+@app.route('/api/patients/<int:patient_id>/archive', methods=['GET'])
+@admission.limit('archive')
+def get_patient_archive(patient_id):
+    """Stream a zip of the patient's uploads, record tables and a manifest"""
+    patient = Patient.query.get_or_404(patient_id)
+    response = app.response_class(
+        stream_with_context(iter(archive.PatientArchive(patient, db.session))), mimetype='application/zip'
+    )
+    response.headers['Content-Disposition'] = (
+        f"attachment; filename={patient.reference_number}-{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip"
+    )
+    return response
+
+# Bulk Import/Export
+@app.route('/api/import', methods=['POST'])
+@admission.limit('bulk')
+@storage.large_body('BULK_IMPORT_MAX_SIZE')
+def bulk_import():
+    """Import patients with their vitals, family history and teeth from NDJSON or CSV"""
+    fmt = request.args.get('format') or ('csv' if request.mimetype == 'text/csv' else 'ndjson')
+    on_conflict = request.args.get('on_conflict', 'rename')
+    if fmt not in bulk_io.FORMATS:
+        return jsonify({'error': f"format must be one of: {', '.join(bulk_io.FORMATS)}"}), 400
+    if on_conflict not in bulk_io.CONFLICT_POLICIES:
+        return jsonify({'error': f"on_conflict must be one of: {', '.join(bulk_io.CONFLICT_POLICIES)}"}), 400
+    
+    importer = bulk_io.BulkImporter(
+        master_agent, db.session, on_conflict=on_conflict, batch_rows=app.config['BULK_IMPORT_BATCH_ROWS']
+    )
+    summary = importer.run(bulk_io.READERS[fmt](request.stream))
+    return jsonify(summary)
+
+@app.route('/api/export', methods=['GET'])
+@admission.limit('bulk')
+def bulk_export():
+    """Export every patient with vitals, family history and teeth as NDJSON or CSV"""
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in bulk_io.FORMATS:
+        return jsonify({'error': f"format must be one of: {', '.join(bulk_io.FORMATS)}"}), 400
+    
+    body = bulk_io.iter_export(db.session, fmt, app.config['EXPORT_BATCH_PATIENTS'])
+    response = app.response_class(stream_with_context(body), mimetype=bulk_io.MIMETYPES[fmt])
+    response.headers['Content-Disposition'] = (
+        f"attachment; filename=patients-{datetime.now().strftime('%Y%m%d_%H%M%S')}.{fmt}"
+    )
+    return response
+
+@app.route('/api/metrics', methods=['GET'])
+@admission.exempt
+def get_metrics():
+    """Admission control queue depths and counters (JSON, or Prometheus text with ?format=prometheus)"""
+    if request.args.get('format') == 'prometheus':
+        return app.response_class(admission.controller.prometheus(), mimetype='text/plain; version=0.0.4')
+    return jsonify({'admission': admission.controller.metrics(), 'event_subscribers': events.bus.subscriber_count})
+
+# Change Events
+def event_stream_response(patient_id=None):
+    """Open a Server-Sent Events stream of committed changes"""
+    last_event_id = request.headers.get('Last-Event-ID', type=int)
+    try:
+        subscription, replay = events.bus.subscribe(patient_id, last_event_id)
+    except events.TooManySubscribers:
+        # EventSource gives up for good on an error status, but reconnects
+        # after a stream that ends normally; jitter spreads the retries
+        retry_ms = int(app.config['EVENTS_HEARTBEAT_INTERVAL'] * 1000 * random.uniform(1, 2))
+        body = f"retry: {retry_ms}\n\n"
+    else:
+        body = events.bus.stream(subscription, replay, app.config['EVENTS_HEARTBEAT_INTERVAL'])
+    response = app.response_class(body, mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # nginx must not buffer the stream
+    return response
+
+@app.route('/api/patients/<int:patient_id>/events', methods=['GET'])
+@admission.exempt
+def get_patient_events(patient_id):
+    """Stream changes to one patient's record"""
+    Patient.query.get_or_404(patient_id)
+    return event_stream_response(patient_id)
+
+@app.route('/api/events', methods=['GET'])
+@admission.exempt
+def get_events():
+    """Stream changes to all records"""
+    return event_stream_response()
+
 # Document Agent Routes
 @app.route('/api/patients/<int:patient_id>/documents', methods=['POST'])
+@admission.limit('ocr_upload')
 def upload_document(patient_id):
     """Upload and process medical document"""
     patient = Patient.query.get_or_404(patient_id)
@@ -102,31 +256,51 @@ def upload_document(patient_id):
         return jsonify({'error': 'No file selected'}), 400
     
     if file and allowed_file(file.filename):
-        filename = secure_filename(file.filename)
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        filename = f"{timestamp}_{filename}"
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], 'documents', filename)
-        file.save(file_path)
-        
-        # Parse document
-        document_agent = master_agent.get_agent('document')
-        parsed_text = document_agent.parse_document(file_path, filename)
+        filename = timestamped_filename(file.filename)
+        try:
+            ingested = storage.ingest_upload(
+                file, os.path.join(app.config['UPLOAD_FOLDER'], 'documents'), filename
+            )
+        except storage.IngestError as e:
+            return jsonify({'error': str(e)}), e.status_code
         
-        # Store in database
         document_type = request.form.get('document_type', 'Medical Report')
-        doc = document_agent.store_document(
-            patient_id, filename, file_path, parsed_text, document_type, db.session
-        )
-        
-        return jsonify(doc), 201
+        return finish_document_upload(patient_id, ingested, filename, document_type)
     
     return jsonify({'error': 'Invalid file type'}), 400
 
 @app.route('/api/patients/<int:patient_id>/documents', methods=['GET'])
+@conditional_get('patient', 'documents')
 def get_documents(patient_id):
     """Get all documents for a patient"""
-    patient = Patient.query.get_or_404(patient_id)
-    return jsonify([doc.to_dict() for doc in patient.documents])
+    Patient.query.get_or_404(patient_id)
+    return streaming.stream_list(
+        streaming.list_select(Document).where(Document.patient_id == patient_id).order_by(Document.id)
+    )
+
+@app.route('/api/documents/<int:document_id>/text', methods=['GET'])
+def get_document_text(document_id):
+    """Stream the full parsed text of a document"""
+    stored = db.session.get(DocumentText, document_id)
+    if stored is None:
+        Document.query.get_or_404(document_id)
+        stored = DocumentText(codec=None, data=b'')
+    
+    # Text never changes once stored, so the document id identifies it
+    coding = text_store.CONTENT_CODINGS.get(stored.codec)
+    passthrough = coding is not None and coding in request.accept_encodings
+    if passthrough:
+        response = app.response_class(stored.data, mimetype='text/plain')
+        response.headers['Content-Encoding'] = coding
+        response.set_etag(f"document-text-{document_id}-{coding}")
+    else:
+        body = text_store.iter_text_bytes(stored.codec, stored.data) if stored.codec else iter(())
+        response = app.response_class(body, mimetype='text/plain')
+        # Weak, since the stream may still be compressed on the way out
+        response.set_etag(f"document-text-{document_id}", weak=True)
+    response.vary.add('Accept-Encoding')
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response.make_conditional(request)
 
 # Vitals Agent Routes
 @app.route('/api/patients/<int:patient_id>/vitals', methods=['POST'])
@@ -147,10 +321,12 @@ def add_vitals(patient_id):
     return jsonify(vital), 201
 
 @app.route('/api/patients/<int:patient_id>/vitals', methods=['GET'])
+@conditional_get('patient', 'vitals')
 def get_vitals(patient_id):
     """Get all vital signs for a patient"""
-    patient = Patient.query.get_or_404(patient_id)
-    return jsonify([v.to_dict() for v in patient.vitals])
+    Patient.query.get_or_404(patient_id)
+    # Includes vitals moved to cold storage, merged back in id order
+    return streaming.stream_batches(tiering.vitals_batches(db.session, patient_id))
 
 # Family History Agent Routes
 @app.route('/api/patients/<int:patient_id>/family-history', methods=['POST'])
@@ -171,13 +347,39 @@ def add_family_history(patient_id):
     return jsonify(fh), 201
 
 @app.route('/api/patients/<int:patient_id>/family-history', methods=['GET'])
+@conditional_get('patient', 'family_history')
 def get_family_history(patient_id):
     """Get all family history for a patient"""
-    patient = Patient.query.get_or_404(patient_id)
-    return jsonify([fh.to_dict() for fh in patient.family_history])
+    Patient.query.get_or_404(patient_id)
+    return streaming.stream_list(
+        streaming.list_select(FamilyHistory).where(FamilyHistory.patient_id == patient_id).order_by(FamilyHistory.id)
+    )
+
+@app.route('/api/analytics/family-history', methods=['GET'])
+@conditional_get('family_history_aggregates', scope=GLOBAL_SCOPE)
+def get_family_history_analytics():
+    """Cohort views of family history, answered from precomputed aggregates"""
+    family_history_agent = master_agent.get_agent('family_history')
+    analytics = family_history_agent.get_cohort_analytics(
+        db.session,
+        condition=request.args.get('condition'),
+        min_first_degree=request.args.get('min_first_degree', 2, type=int),
+        limit=min(request.args.get('limit', 100, type=int), 1000)
+    )
+    return jsonify(analytics)
+
+@app.cli.command('rebuild-family-aggregates')
+def rebuild_family_aggregates_command():
+    """Recompute family history codes and cohort aggregates from scratch"""
+    family_history_agent = master_agent.get_agent('family_history')
+    count = family_history_agent.rebuild_aggregates(db.session)
+    touch_section(db.session, GLOBAL_SCOPE, 'family_history_aggregates')
+    db.session.commit()
+    print(f"Rebuilt aggregates from {count} family history entries")
 
 # Chatbot Agent Routes
 @app.route('/api/patients/<int:patient_id>/chat', methods=['POST'])
+@admission.limit('chat')
 def chat_with_patient(patient_id):
     """Chat with medical chatbot about patient"""
     data = request.json
@@ -203,6 +405,7 @@ def chat_with_patient(patient_id):
 
 # Image Agent Routes
 @app.route('/api/patients/<int:patient_id>/images', methods=['POST'])
+@admission.limit('image_upload')
 def upload_image(patient_id):
     """Upload medical image"""
     patient = Patient.query.get_or_404(patient_id)
@@ -215,41 +418,313 @@ def upload_image(patient_id):
         return jsonify({'error': 'No file selected'}), 400
     
     if file and allowed_file(file.filename):
-        filename = secure_filename(file.filename)
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        filename = f"{timestamp}_{filename}"
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], 'images', filename)
-        file.save(file_path)
+        filename = timestamped_filename(file.filename)
         
-        # Process image
+        # Single pass: validate the sniffed header, then rename the spooled upload into place
         image_agent = master_agent.get_agent('image')
-        is_valid, error = image_agent.validate_image(file_path)
+        try:
+            ingested = storage.ingest_upload(
+                file, os.path.join(app.config['UPLOAD_FOLDER'], 'images'), filename,
+                validate=image_agent.validate_header
+            )
+        except storage.IngestError as e:
+            return jsonify({'error': str(e)}), e.status_code
         
-        if not is_valid:
-            os.remove(file_path)
-            return jsonify({'error': error}), 400
-        
-        image_info = image_agent.process_image(file_path)
-        
-        # Store in database
         image_type = request.form.get('image_type', 'Medical Image')
         description = request.form.get('description', '')
-        img = image_agent.store_image(
-            patient_id, filename, file_path, image_type, description, db.session
-        )
-        
-        return jsonify(img), 201
+        return finish_image_upload(patient_id, ingested, filename, image_type, description)
     
     return jsonify({'error': 'Invalid file type'}), 400
 
 @app.route('/api/patients/<int:patient_id>/images', methods=['GET'])
+@conditional_get('patient', 'images')
 def get_images(patient_id):
     """Get all images for a patient"""
+    Patient.query.get_or_404(patient_id)
+    return streaming.stream_list(
+        streaming.list_select(MedicalImage).where(MedicalImage.patient_id == patient_id).order_by(MedicalImage.id),
+        formatters=MedicalImage.list_formatters
+    )
+
+def derivatives_unavailable(status, image):
+    """Response for a pyramid that is not ready: keep polling while pending, stop on failure"""
+    if status == 'failed':
+        return jsonify({'status': 'failed', 'error': image.derivatives_error}), 422
+    if status == 'none':
+        return jsonify({'status': 'none', 'error': 'DICOM images are not tiled, use the preview'}), 404
+    return jsonify({'status': 'processing'}), 202
+
+def send_dicom_preview(image, **options):
+    """Serve a rendered DICOM preview, mapping render failures to client errors"""
+    image_agent = master_agent.get_agent('image')
+    try:
+        preview_path = image_agent.get_dicom_preview(image, derived_root(), **options)
+    except dicom_reader.UnsupportedPixelData as e:
+        return jsonify({'error': str(e)}), 415
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if preview_path is None:
+        return jsonify({'error': 'Image file not found'}), 404
+    response = send_file(preview_path, mimetype='image/png', max_age=storage.IMMUTABLE_MAX_AGE)
+    return storage.private_cache(response, storage.IMMUTABLE_MAX_AGE)
+
+@app.route('/api/images/<int:image_id>/tiles', methods=['GET'])
+def get_image_tiles(image_id):
+    """Get the tile pyramid descriptor for an image"""
+    image = MedicalImage.query.get_or_404(image_id)
+    image_agent = master_agent.get_agent('image')
+    status, info = image_agent.get_derivatives_state(
+        image, derived_root(), db.session, app.config['IMAGE_DERIVATIVE_TIMEOUT']
+    )
+    if not info:
+        return derivatives_unavailable(status, image)
+    return jsonify(dict(info, status='ready'))
+
+@app.route('/api/images/<int:image_id>/tiles/<int:level>/<int:col>_<int:row>', methods=['GET'])
+@admission.exempt  # A deep-zoom viewer fetches dozens of small, immutable tiles at once
+def get_image_tile(image_id, level, col, row):
+    """Serve a single tile of the image pyramid"""
+    image_agent = master_agent.get_agent('image')
+    if not image_agent.get_tile_info(image_id, derived_root()):
+        image = MedicalImage.query.get_or_404(image_id)
+        status, _ = image_agent.get_derivatives_state(
+            image, derived_root(), db.session, app.config['IMAGE_DERIVATIVE_TIMEOUT']
+        )
+        return derivatives_unavailable(status, image)
+    
+    tile_path = image_agent.get_tile_path(image_id, level, col, row, derived_root())
+    if not tile_path:
+        return jsonify({'error': 'Tile not found'}), 404
+    response = send_file(tile_path, max_age=storage.IMMUTABLE_MAX_AGE)
+    return storage.private_cache(response, storage.IMMUTABLE_MAX_AGE)
+
+@app.route('/api/images/<int:image_id>/thumbnail', methods=['GET'])
+@admission.exempt  # Image lists load every thumbnail at once
+def get_image_thumbnail(image_id):
+    """Serve an image thumbnail, falling back to the original while it is built"""
+    image = MedicalImage.query.get_or_404(image_id)
+    image_agent = master_agent.get_agent('image')
+    size = request.args.get('size', 'small')
+    
+    if image.dicom:
+        return send_dicom_preview(image, size=1024 if size == 'medium' else 256)
+    
+    thumbnail_path = image_agent.get_thumbnail_path(image_id, size, derived_root())
+    if thumbnail_path:
+        response = send_file(thumbnail_path, max_age=storage.IMMUTABLE_MAX_AGE)
+        return storage.private_cache(response, storage.IMMUTABLE_MAX_AGE)
+    return storage.send_upload(os.path.join('images', image.filename))
+
+@app.route('/api/images/<int:image_id>/preview', methods=['GET'])
+def get_image_preview(image_id):
+    """Render a windowed preview of a DICOM image"""
+    image = MedicalImage.query.get_or_404(image_id)
+    if not image.dicom:
+        return jsonify({'error': 'Image is not a DICOM file'}), 400
+    
+    return send_dicom_preview(
+        image,
+        frame=request.args.get('frame', type=int),
+        center=request.args.get('center', type=float),
+        width=request.args.get('width', type=float),
+        size=request.args.get('size', 1024, type=int)
+    )
+
+@app.route('/api/images/<int:image_id>/similar', methods=['GET'])
+def get_similar_images(image_id):
+    """Find perceptually similar images, optionally limited to the same patient"""
+    image = MedicalImage.query.get_or_404(image_id)
+    if image.phash is None:
+        return jsonify({'error': 'Image has no perceptual hash'}), 409
+    
+    image_agent = master_agent.get_agent('image')
+    same_patient = request.args.get('scope', 'patient') == 'patient'
+    matches = image_agent.find_similar(
+        perceptual_hash.to_unsigned(image.phash), db.session,
+        max_distance=request.args.get('max_distance', app.config['PHASH_DUPLICATE_DISTANCE'], type=int),
+        patient_id=image.patient_id if same_patient else None,
+        exclude_id=image.id,
+        limit=min(request.args.get('limit', 50, type=int), 500)
+    )
+    return jsonify(matches)
+
+@app.cli.command('upgrade-db')
+def upgrade_db_command():
+    """Add new tables and columns to an existing database and migrate its data"""
+    summary = migrations.upgrade(db.session)
+    for key, value in summary.items():
+        print(f"{key}: {value}")
+
+@app.cli.command('backfill-phash')
+def backfill_phash_command():
+    """Compute perceptual hashes for images uploaded before hashing was added"""
+    image_agent = master_agent.get_agent('image')
+    images = MedicalImage.query.filter(MedicalImage.phash.is_(None)).order_by(MedicalImage.id).all()
+    hashed = failed = 0
+    for image in images:
+        file_path = tiering.local_path(image.file_path)
+        dicom_tags = dicom_reader.read_header(file_path) if file_path and image.dicom else None
+        if image_agent.hash_image(image.id, image.file_path, dicom_tags, db.session) is None:
+            failed += 1
+        else:
+            hashed += 1
+    print(f"Hashed {hashed} image(s), {failed} failed")
+
+@app.cli.command('rebuild-derivatives')
+def rebuild_derivatives_command():
+    """Build tile pyramids that are missing, failed, or were lost while queued"""
+    image_agent = master_agent.get_agent('image')
+    images = (
+        db.session.query(MedicalImage.id, MedicalImage.file_path, MedicalImage.derivatives_status)
+        .filter(MedicalImage.derivatives_status != 'none').order_by(MedicalImage.id).all()
+    )
+    results = {'ready': 0, 'failed': 0}
+    for image_id, file_path, status in images:
+        if status == 'ready' and image_agent.get_tile_info(image_id, derived_root()):
+            continue
+        results[image_agent.build_derivatives(image_id, file_path, derived_root(), db.session)] += 1
+    print(f"Built {results['ready']} pyramid(s), {results['failed']} failed")
+
+@app.route('/api/patients/<int:patient_id>/dicom', methods=['GET'])
+@conditional_get('patient', 'images')
+def get_dicom_images(patient_id):
+    """Find a patient's DICOM images by modality, study or series"""
     patient = Patient.query.get_or_404(patient_id)
-    return jsonify([img.to_dict() for img in patient.images])
+    image_agent = master_agent.get_agent('image')
+    images = image_agent.find_dicom_images(
+        patient_id, db.session,
+        modality=request.args.get('modality'),
+        study_uid=request.args.get('study_uid'),
+        series_uid=request.args.get('series_uid')
+    )
+    return jsonify(images)
+
+# Resumable Upload Routes
+_last_upload_purge = 0.0
+
+def purge_stale_uploads():
+    """Garbage-collect abandoned uploads, at most once per purge interval"""
+    global _last_upload_purge
+    now = time.monotonic()
+    if now - _last_upload_purge < app.config['RESUMABLE_UPLOAD_PURGE_INTERVAL']:
+        return 0
+    _last_upload_purge = now
+    return resumable_uploads.purge_stale(incoming_dir(), app.config['RESUMABLE_UPLOAD_TTL'], db.session)
+
+@app.route('/api/patients/<int:patient_id>/uploads', methods=['POST'])
+def init_upload(patient_id):
+    """Start a resumable chunked upload"""
+    patient = Patient.query.get_or_404(patient_id)
+    data = request.get_json() or {}
+    
+    if not data.get('filename') or not allowed_file(data['filename']):
+        return jsonify({'error': 'Invalid file type'}), 400
+    
+    purge_stale_uploads()
+    try:
+        upload = resumable_uploads.create_session(
+            patient_id, data, incoming_dir(),
+            app.config['UPLOAD_CHUNK_SIZE'], app.config['RESUMABLE_UPLOAD_MAX_SIZE'], db.session
+        )
+    except resumable_uploads.UploadError as e:
+        return jsonify({'error': str(e)}), e.status_code
+    return jsonify(upload.to_dict()), 201
+
+@app.route('/api/uploads/<upload_id>', methods=['GET'])
+def get_upload(upload_id):
+    """Get upload progress, including which chunks have been received"""
+    upload = UploadSession.query.get_or_404(upload_id)
+    return jsonify(upload.to_dict())
+
+@app.route('/api/uploads/<upload_id>/chunks/<int:index>', methods=['PUT'])
+def put_upload_chunk(upload_id, index):
+    """Write one chunk; send its SHA-256 in the X-Chunk-SHA256 header"""
+    upload = UploadSession.query.get_or_404(upload_id)
+    try:
+        checksum = resumable_uploads.write_chunk(
+            upload, index, request.stream, request.headers.get('X-Chunk-SHA256'), incoming_dir(), db.session
+        )
+    except resumable_uploads.UploadError as e:
+        return jsonify({'error': str(e)}), e.status_code
+    return jsonify({'upload_id': upload_id, 'index': index, 'sha256': checksum})
+
+def commit_admission_class(upload_id):
+    """A commit parses or processes the assembled file, so it is admitted like a direct upload"""
+    kind = db.session.query(UploadSession.kind).filter_by(id=upload_id).scalar()
+    return 'image_upload' if kind == 'image' else 'ocr_upload'
+
+@app.route('/api/uploads/<upload_id>/commit', methods=['POST'])
+@admission.limit(commit_admission_class)
+def commit_upload(upload_id):
+    """Assemble a completed upload and hand it to the document or image agent"""
+    upload = UploadSession.query.get_or_404(upload_id)
+    
+    missing = resumable_uploads.missing_chunks(upload)
+    if missing:
+        return jsonify({'error': 'Upload is incomplete', 'missing': missing}), 409
+    
+    filename = timestamped_filename(upload.filename)
+    fields = upload.fields or {}
+    subdir = 'documents' if upload.kind == 'document' else 'images'
+    validate = master_agent.get_agent('image').validate_header if upload.kind == 'image' else None
+    
+    try:
+        ingested = storage.adopt_file(
+            resumable_uploads.part_path(incoming_dir(), upload.id),
+            os.path.join(app.config['UPLOAD_FOLDER'], subdir), filename, validate=validate
+        )
+    except storage.IngestError as e:
+        resumable_uploads.discard(upload, incoming_dir(), db.session)
+        return jsonify({'error': str(e)}), e.status_code
+    
+    expected_sha256 = upload.sha256
+    patient_id = upload.patient_id
+    db.session.delete(upload)
+    db.session.commit()
+    
+    if expected_sha256 and expected_sha256 != ingested.sha256:
+        os.remove(ingested.path)
+        return jsonify({'error': 'File checksum mismatch'}), 422
+    
+    if subdir == 'documents':
+        return finish_document_upload(
+            patient_id, ingested, filename, fields.get('document_type', 'Medical Report')
+        )
+    return finish_image_upload(
+        patient_id, ingested, filename,
+        fields.get('image_type', 'Medical Image'), fields.get('description', '')
+    )
+
+@app.route('/api/uploads/<upload_id>', methods=['DELETE'])
+def abort_upload(upload_id):
+    """Abandon an upload and delete its received chunks"""
+    upload = UploadSession.query.get_or_404(upload_id)
+    resumable_uploads.discard(upload, incoming_dir(), db.session)
+    return jsonify({'upload_id': upload_id, 'action': 'removed'})
+
+@app.cli.command('tier-storage')
+def tier_storage_command():
+    """Move idle uploads and old vitals to compressed packs and trim the rehydration cache"""
+    writer = tiering.pack_writer()
+    try:
+        files, size = tiering.archive_idle_uploads(db.session, app.config['TIER_UPLOADS_AFTER_DAYS'], writer)
+        print(f"Archived {files} upload(s), {size / 1024 / 1024:.1f} MB")
+        rows = tiering.archive_old_vitals(db.session, app.config['TIER_VITALS_AFTER_DAYS'], writer)
+        print(f"Archived {rows} vitals row(s)")
+    finally:
+        writer.close()
+    freed = tiering.trim_cache(app.config['TIER_CACHE_MAX_SIZE'])
+    print(f"Freed {freed / 1024 / 1024:.1f} MB of rehydrated uploads")
+
+@app.cli.command('purge-uploads')
+def purge_uploads_command():
+    """Delete resumable uploads that have been idle longer than RESUMABLE_UPLOAD_TTL"""
+    removed = resumable_uploads.purge_stale(incoming_dir(), app.config['RESUMABLE_UPLOAD_TTL'], db.session)
+    print(f"Removed {removed} stale upload(s)")
 
 # Teeth Agent Routes
 @app.route('/api/patients/<int:patient_id>/teeth', methods=['GET'])
+@conditional_get('patient', 'teeth')
 def get_teeth(patient_id):
     """Get saved tooth conditions for a patient"""
     patient = Patient.query.get_or_404(patient_id)
@@ -278,11 +753,12 @@ def update_tooth(patient_id):
 # Serve uploaded files
 @app.route('/uploads/<path:filename>')
 def uploaded_file(filename):
-    """Serve uploaded files"""
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    """Serve uploaded files with range, caching and sendfile support"""
+    return storage.send_upload(filename)
 
 if __name__ == '__main__':
+    # Development server; use gunicorn (see gunicorn.conf.py) in production
     with app.app_context():
-        db.create_all()
-    app.run(debug=True, host='0.0.0.0', port=5000)
+        migrations.upgrade(db.session)
+    app.run(debug=app.config['DEBUG'], host=os.environ.get('HOST', '0.0.0.0'), port=int(os.environ.get('PORT', 5000)))
 
@@ -0,0 +1,212 @@
+"""
+Archive - Streamed per-patient zip of uploads, record tables and a manifest
+"""
+import csv
+import hashlib
+import io
+import os
+import zipfile
+from datetime import datetime
+
+from sqlalchemy import select
+
+from database import (
+    Document, DocumentText, MedicalImage, Vital, FamilyHistory, DentalAssessment, ArchivedUpload, PackBlob
+)
+from serialization import dumps_bytes
+import streaming
+import text_store
+import tiering
+
+READ_SIZE = 1024 * 1024
+# Formats that are already compressed gain nothing from deflate
+STORED_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.pdf', '.zip', '.gz'}
+
+RECORD_TABLES = (
+    ('vitals', Vital),
+    ('family_history', FamilyHistory),
+    ('dental_chart', DentalAssessment),
+)
+
+
+class _ZipSink:
+    """Write-only, unseekable file object collecting zip output for the generator to yield.
+
+    zipfile detects that it cannot seek and writes data descriptors after
+    each entry instead of patching local headers, which is what lets the
+    archive be produced front to back without a temp file.
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def _zip_info(name, timestamp=None, stored=False):
+    timestamp = timestamp or datetime.utcnow()
+    info = zipfile.ZipInfo(name, date_time=timestamp.timetuple()[:6])
+    info.compress_type = zipfile.ZIP_STORED if stored else zipfile.ZIP_DEFLATED
+    info.external_attr = 0o644 << 16
+    return info
+
+
+def _safe_name(name):
+    return os.path.basename(name).replace('\\', '_') or 'file'
+
+
+def _table_select(model, patient_id):
+    table = model.__table__
+    columns = getattr(model, 'list_columns', None) or [column.name for column in table.columns]
+    return (
+        select(*(table.c[name] for name in columns))
+        .where(table.c.patient_id == patient_id).order_by(table.c.id)
+    )
+
+
+def _ndjson_chunks(batches):
+    for rows in batches:
+        yield b''.join(dumps_bytes(row) + b'\n' for row in rows)
+
+
+def _csv_chunks(batches, columns):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for rows in batches:
+        for row in rows:
+            writer.writerow([
+                value.isoformat() if hasattr(value, 'isoformat') else value
+                for value in (row[column] for column in columns)
+            ])
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue().encode('utf-8')
+
+
+class PatientArchive:
+    """Generate a patient's zip archive as an iterator of byte chunks.
+
+    Uploaded files are copied in READ_SIZE pieces and record tables are read
+    in streaming batches, so memory use does not depend on archive size.
+    Entries are written with zip64 extensions, so single files and the
+    archive as a whole can exceed 4 GB.
+
+    Everything read from the database, including where each upload is
+    stored, comes first. The read transaction then ends, so copying the
+    uploads, which can take as long as the download, does not hold back
+    SQLite WAL checkpoints.
+    """
+
+    def __init__(self, patient, db_session):
+        self.patient = patient
+        self.db_session = db_session
+        self.sink = _ZipSink()
+        self.zip = zipfile.ZipFile(self.sink, 'w', allowZip64=True)
+        self.manifest = []
+        self.missing = []
+
+    def _write_entry(self, info, chunks, source=None):
+        """Write one entry from an iterable of bytes, yielding zip output as it is produced"""
+        digest = hashlib.sha256()
+        size = 0
+        with self.zip.open(info, 'w', force_zip64=True) as entry:
+            for chunk in chunks:
+                entry.write(chunk)
+                digest.update(chunk)
+                size += len(chunk)
+                data = self.sink.drain()
+                if data:
+                    yield data
+        entry_record = {'path': info.filename, 'size': size, 'sha256': digest.hexdigest()}
+        if source:
+            entry_record.update(source)
+        self.manifest.append(entry_record)
+        yield self.sink.drain()
+
+    def _upload_rows(self, folder, model):
+        """(folder, row) for each upload, with the pack location of archived ones"""
+        rows = self.db_session.execute(
+            select(
+                model.id, model.filename, model.file_path, model.sha256, model.uploaded_at,
+                PackBlob.pack, PackBlob.offset, PackBlob.length, PackBlob.codec
+            )
+            .outerjoin(ArchivedUpload, ArchivedUpload.file_path == model.file_path)
+            .outerjoin(PackBlob, PackBlob.sha256 == ArchivedUpload.sha256)
+            .where(model.patient_id == self.patient.id).order_by(model.id)
+        ).all()
+        return [(folder, row) for row in rows]
+
+    def _upload_entries(self, uploads):
+        for folder, row in uploads:
+            name = f"{folder}/{row.id}_{_safe_name(row.filename)}"
+            # Archived uploads are read straight from their pack, bypassing the rehydration cache
+            chunks = tiering.read_upload(row.file_path, row if row.pack else None, READ_SIZE)
+            if chunks is None:
+                self.missing.append({'path': name, 'id': row.id, 'file_path': row.file_path})
+                continue
+            stored = os.path.splitext(row.filename)[1].lower() in STORED_EXTENSIONS
+            source = {'id': row.id, 'stored_sha256': row.sha256}
+            yield from self._write_entry(_zip_info(name, row.uploaded_at, stored), chunks, source)
+
+    def _document_text_entries(self):
+        rows = self.db_session.execute(
+            select(Document.id, Document.filename, Document.uploaded_at, DocumentText.codec, DocumentText.data)
+            .join(DocumentText, DocumentText.document_id == Document.id)
+            .where(Document.patient_id == self.patient.id).order_by(Document.id)
+        )
+        for document_id, filename, uploaded_at, codec, data in rows:
+            name = f"documents/{document_id}_{_safe_name(filename)}.txt"
+            yield from self._write_entry(
+                _zip_info(name, uploaded_at), text_store.iter_text_bytes(codec, data), {'id': document_id}
+            )
+
+    def _record_entries(self):
+        for name, model in RECORD_TABLES:
+            statement = _table_select(model, self.patient.id)
+            columns = [column.name for column in statement.selected_columns]
+            yield from self._write_entry(
+                _zip_info(f"records/{name}.ndjson"), _ndjson_chunks(self._record_batches(model, statement))
+            )
+            yield from self._write_entry(
+                _zip_info(f"records/{name}.csv"), _csv_chunks(self._record_batches(model, statement), columns)
+            )
+
+    def _record_batches(self, model, statement):
+        if model is Vital:
+            # Same columns and order as the statement, plus vitals moved to cold storage
+            return tiering.vitals_batches(self.db_session, self.patient.id)
+        return streaming.iter_batches(statement)
+
+    def __iter__(self):
+        generated_at = datetime.utcnow()
+        patient = self.patient.to_dict()
+        yield from self._write_entry(_zip_info('patient.json', generated_at), [dumps_bytes(patient)])
+        yield from self._record_entries()
+        yield from self._document_text_entries()
+        uploads = self._upload_rows('documents', Document) + self._upload_rows('images', MedicalImage)
+        # Nothing was written; this only ends the read transaction before the long copy
+        self.db_session.commit()
+        yield from self._upload_entries(uploads)
+
+        manifest = {
+            'patient': patient,
+            'generated_at': generated_at,
+            'files': self.manifest,
+            'missing': self.missing,
+        }
+        with self.zip.open(_zip_info('manifest.json', generated_at), 'w', force_zip64=True) as entry:
+            entry.write(dumps_bytes(manifest, indent=2))
+        self.zip.close()
+        yield self.sink.drain()
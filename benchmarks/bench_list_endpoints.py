@@ -0,0 +1,126 @@
+"""
+Benchmark - Peak RSS and latency of list endpoints, ORM vs streamed Core path
+
+Seeds a patient with many vitals, then fetches the list through the previous
+ORM handler (model instances + to_dict + jsonify) and through the current
+streamed ``/api/patients/<id>/vitals`` route. Each variant runs in a fresh
+process so peak RSS is not shared between them.
+
+    python benchmarks/bench_list_endpoints.py --rows 50000 --repeat 5
+"""
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+VARIANTS = ('orm', 'stream')
+
+
+def _max_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _load_app(workdir):
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.chdir(workdir)
+    import app as app_module
+    return app_module
+
+
+def seed(workdir, rows):
+    app_module = _load_app(workdir)
+    from database import Patient, Vital
+
+    with app_module.app.app_context():
+        db = app_module.db
+        db.create_all()
+        patient = Patient(reference_number='BENCH-0001', name='Benchmark Patient')
+        db.session.add(patient)
+        db.session.commit()
+
+        start = datetime(2020, 1, 1)
+        vitals = Vital.__table__
+        for offset in range(0, rows, 10000):
+            db.session.execute(vitals.insert(), [
+                {
+                    'patient_id': patient.id,
+                    'temperature': 36.5 + (i % 10) / 10,
+                    'weight': 70.0 + (i % 50) / 10,
+                    'height': 175.0,
+                    'blood_pressure_systolic': 110 + i % 30,
+                    'blood_pressure_diastolic': 70 + i % 20,
+                    'heart_rate': 60 + i % 40,
+                    'respiratory_rate': 12 + i % 8,
+                    'oxygen_saturation': 95.0 + (i % 5),
+                    'recorded_at': start + timedelta(minutes=i),
+                }
+                for i in range(offset, min(offset + 10000, rows))
+            ])
+        db.session.commit()
+        return patient.id
+
+
+def run_variant(workdir, variant, patient_id, repeat):
+    app_module = _load_app(workdir)
+    app = app_module.app
+    from flask import jsonify
+    from database import Patient
+
+    @app.route('/bench-legacy/<int:patient_id>/vitals')
+    def legacy(patient_id):
+        patient = Patient.query.get_or_404(patient_id)
+        return jsonify([v.to_dict() for v in patient.vitals])
+
+    url = f'/bench-legacy/{patient_id}/vitals' if variant == 'orm' else f'/api/patients/{patient_id}/vitals'
+    client = app.test_client()
+    headers = {'Accept-Encoding': 'identity'}
+
+    baseline = _max_rss_mb()
+    timings = []
+    size = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        response = client.get(url, headers=headers)
+        size = sum(len(chunk) for chunk in response.response)
+        response.close()
+        timings.append(time.perf_counter() - start)
+        assert response.status_code == 200, response.status_code
+
+    timings.sort()
+    print(f"{variant:<8} median {timings[len(timings) // 2] * 1000:9.1f} ms   "
+          f"min {timings[0] * 1000:9.1f} ms   peak RSS +{_max_rss_mb() - baseline:8.1f} MB   "
+          f"({size / 1024 / 1024:.1f} MB body)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--rows', type=int, default=50000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--variant', choices=VARIANTS, help=argparse.SUPPRESS)
+    parser.add_argument('--workdir', help=argparse.SUPPRESS)
+    parser.add_argument('--patient-id', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.variant:
+        run_variant(args.workdir, args.variant, args.patient_id, args.repeat)
+        return
+
+    workdir = tempfile.mkdtemp(prefix='bench_lists_')
+    patient_id = seed(workdir, args.rows)
+    print(f"{args.rows} vitals rows, {args.repeat} requests per variant")
+    for variant in VARIANTS:
+        subprocess.run([
+            sys.executable, os.path.abspath(__file__), '--variant', variant, '--workdir', workdir,
+            '--patient-id', str(patient_id), '--repeat', str(args.repeat)
+        ], check=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+"""
+Benchmark - Request throughput against the number of gunicorn workers
+
+Seeds a database, then for each worker count starts the production launcher
+(gunicorn.conf.py: preloaded app, forked workers, WAL SQLite) and drives it
+with keep-alive clients in separate processes for a fixed duration. Mixed
+reads and writes exercise the SQLite pragmas and per-worker pools.
+
+    python benchmarks/bench_scaling.py --workers 1 2 4 8 --clients 32 --duration 10
+"""
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+PATIENTS = 200
+VITALS_PER_PATIENT = 50
+
+
+def seed(workdir):
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.chdir(workdir)
+    import app as app_module
+    from database import Patient, Vital
+
+    with app_module.app.app_context():
+        db = app_module.db
+        db.create_all()
+        db.session.execute(Patient.__table__.insert(), [
+            {'reference_number': f'BENCH-{i:05d}', 'name': f'Patient {i}'} for i in range(PATIENTS)
+        ])
+        db.session.execute(Vital.__table__.insert(), [
+            {'patient_id': p + 1, 'temperature': 36.6, 'heart_rate': 60 + v % 40, 'weight': 70.0}
+            for p in range(PATIENTS) for v in range(VITALS_PER_PATIENT)
+        ])
+        db.session.commit()
+
+
+def client(port, duration, write_ratio, seed_value, results):
+    rng = random.Random(seed_value)
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    headers = {'Content-Type': 'application/json', 'Accept-Encoding': 'identity'}
+    done = errors = 0
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        patient_id = rng.randint(1, PATIENTS)
+        try:
+            if rng.random() < write_ratio:
+                body = json.dumps({'temperature': 36.8, 'heart_rate': rng.randint(55, 100)})
+                connection.request('POST', f'/api/patients/{patient_id}/vitals', body, headers)
+            else:
+                connection.request('GET', f'/api/patients/{patient_id}/vitals', headers=headers)
+            response = connection.getresponse()
+            response.read()
+            if response.status < 400:
+                done += 1
+            else:
+                errors += 1
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            connection.close()
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    results.put((done, errors))
+
+
+def wait_ready(port, timeout=120):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=2)
+            connection.request('GET', '/api/patients/1')
+            connection.getresponse().read()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError('server did not start')
+
+
+def run(workdir, workers, args):
+    env = dict(
+        os.environ,
+        DATABASE_URL=f"sqlite:///{os.path.join(workdir, 'bench.db')}",
+        WEB_CONCURRENCY=str(workers),
+        BIND=f'127.0.0.1:{args.port}',
+        ADMISSION_CONTROL='0',  # Measure the server, not the per-client rate limits
+        PYTHONPATH=ROOT,
+    )
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', os.path.join(ROOT, 'gunicorn.conf.py')],
+        cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        wait_ready(args.port)
+        results = multiprocessing.Queue()
+        clients = [
+            multiprocessing.Process(target=client, args=(args.port, args.duration, args.write_ratio, i, results))
+            for i in range(args.clients)
+        ]
+        for process in clients:
+            process.start()
+        totals = [results.get() for _ in clients]
+        for process in clients:
+            process.join()
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait()
+
+    done = sum(t[0] for t in totals)
+    errors = sum(t[1] for t in totals)
+    return done / args.duration, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, multiprocessing.cpu_count()])
+    parser.add_argument('--clients', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--write-ratio', type=float, default=0.1)
+    parser.add_argument('--port', type=int, default=5099)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench_scaling_')
+    seed_process = multiprocessing.Process(target=seed, args=(workdir,))
+    seed_process.start()
+    seed_process.join()
+
+    print(f"{multiprocessing.cpu_count()} CPUs, {args.clients} clients, "
+          f"{args.write_ratio:.0%} writes, {args.duration:g}s per run")
+    baseline = None
+    for workers in sorted(set(args.workers)):
+        throughput, errors = run(workdir, workers, args)
+        baseline = baseline or throughput
+        print(f"{workers:>3} workers   {throughput:9.1f} req/s   x{throughput / baseline:5.2f}   {errors} errors")
+
+
+if __name__ == '__main__':
+    main()
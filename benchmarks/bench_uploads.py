@@ -0,0 +1,107 @@
+"""
+Benchmark - Upload serving throughput and CPU cost per MB
+
+Compares the previous ``send_from_directory`` handler with the current
+``/uploads`` route for full downloads, byte ranges and revalidation.
+
+    python benchmarks/bench_uploads.py --size-mb 64 --repeat 20
+    python benchmarks/bench_uploads.py --url http://localhost:5000/uploads/images/<file> --server-pid <pid>
+
+The second form measures a running server, so the WSGI server's sendfile
+path is included; CPU is read from /proc for the given server process.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+MB = 1024 * 1024
+
+
+def _proc_cpu_seconds(pid):
+    with open(f'/proc/{pid}/stat') as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    ticks = os.sysconf('SC_CLK_TCK')
+    return (int(fields[11]) + int(fields[12])) / ticks
+
+
+def _report(label, total_bytes, wall, cpu, requests):
+    mb = total_bytes / MB
+    if mb >= 1:
+        print(f"{label:<28} {mb / wall:9.1f} MB/s   {cpu / mb * 1000:8.3f} ms CPU/MB   ({mb:.0f} MB in {wall:.2f}s)")
+    else:
+        print(f"{label:<28} {requests / wall:9.1f} req/s  {cpu / requests * 1000:8.3f} ms CPU/req  ({total_bytes} bytes in {wall:.2f}s)")
+
+
+def bench_in_process(size_mb, repeat):
+    workdir = tempfile.mkdtemp(prefix='bench_uploads_')
+    os.environ.setdefault('DATABASE_URL', f"sqlite:///{os.path.join(workdir, 'bench.db')}")
+    os.chdir(workdir)
+
+    from flask import send_from_directory
+    import app as app_module
+
+    app = app_module.app
+    with app.app_context():
+        app_module.db.create_all()
+
+    name = '20240101_000000_bench.bin'
+    path = os.path.join(app.config['UPLOAD_FOLDER'], 'images', name)
+    with open(path, 'wb') as f:
+        f.write(os.urandom(size_mb * MB))
+
+    @app.route('/bench-legacy/<path:filename>')
+    def legacy(filename):
+        return send_from_directory(os.path.abspath(app.config['UPLOAD_FOLDER']), filename)
+
+    client = app.test_client()
+
+    def run(label, url, headers=None, expect=200):
+        total = 0
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        for _ in range(repeat):
+            response = client.get(url, headers=headers or {})
+            assert response.status_code == expect, response.status_code
+            total += len(response.data)
+        _report(label, total, time.perf_counter() - wall_start, time.process_time() - cpu_start, repeat)
+
+    run('legacy full download', f'/bench-legacy/images/{name}')
+    run('full download', f'/uploads/images/{name}')
+    run('range 1 MB', f'/uploads/images/{name}', {'Range': f'bytes=0-{MB - 1}'}, 206)
+    etag = client.get(f'/uploads/images/{name}').headers['ETag']
+    run('revalidate (304)', f'/uploads/images/{name}', {'If-None-Match': etag}, 304)
+
+
+def bench_live(url, repeat, server_pid):
+    total = 0
+    cpu_start = _proc_cpu_seconds(server_pid) if server_pid else 0.0
+    wall_start = time.perf_counter()
+    for _ in range(repeat):
+        with urllib.request.urlopen(url) as response:
+            for chunk in iter(lambda: response.read(MB), b''):
+                total += len(chunk)
+    wall = time.perf_counter() - wall_start
+    cpu = _proc_cpu_seconds(server_pid) - cpu_start if server_pid else float('nan')
+    _report('live full download', total, wall, cpu, repeat)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--size-mb', type=int, default=32)
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--url', help='Benchmark a running server instead of the in-process app')
+    parser.add_argument('--server-pid', type=int, help='Server process to read CPU time from')
+    args = parser.parse_args()
+
+    if args.url:
+        bench_live(args.url, args.repeat, args.server_pid)
+    else:
+        bench_in_process(args.size_mb, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
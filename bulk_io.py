@@ -0,0 +1,469 @@
+"""
+Bulk I/O - Streaming NDJSON/CSV import and export of patients and their records
+"""
+import codecs
+import csv
+import io
+import uuid
+from datetime import datetime
+
+from sqlalchemy import insert, select
+
+from database import (
+    Patient, Vital, FamilyHistory, DentalAssessment, GLOBAL_SCOPE, touch_section
+)
+from agents import condition_vocabulary
+from serialization import dumps_bytes, loads_bytes
+import tiering
+
+FORMATS = ('ndjson', 'csv')
+CONFLICT_POLICIES = ('rename', 'skip', 'merge')
+MIMETYPES = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+
+VITAL_FIELDS = (
+    'temperature', 'weight', 'height', 'blood_pressure_systolic', 'blood_pressure_diastolic',
+    'heart_rate', 'respiratory_rate', 'oxygen_saturation'
+)
+FAMILY_FIELDS = ('condition', 'relation', 'age_of_onset', 'notes')
+CSV_COLUMNS = (
+    'record_type', 'reference_number', 'name', 'created_at', *VITAL_FIELDS, 'recorded_at',
+    *FAMILY_FIELDS, 'tooth_id', 'tooth_condition'
+)
+IN_CLAUSE_SIZE = 500
+MAX_REPORTED_ERRORS = 100
+READ_BUFFER_SIZE = 1024 * 1024
+
+
+class RecordError(ValueError):
+    """Raised for a record that cannot be imported; the rest of the import continues"""
+
+
+def generate_reference_number():
+    return f"PAT-{datetime.now().strftime('%Y%m%d')}-{str(uuid.uuid4())[:8].upper()}"
+
+
+def _parse_datetime(value):
+    if not value:
+        return None
+    if isinstance(value, datetime):
+        return value
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        raise RecordError(f"Invalid timestamp: {value}")
+
+
+# ---------------------------------------------------------------- reading
+
+def read_ndjson(stream):
+    """Yield (line_number, record) from an NDJSON byte stream; one patient per line"""
+    for line_number, line in enumerate(io.BufferedReader(stream, READ_BUFFER_SIZE), 1):
+        if not line.strip():
+            continue
+        try:
+            yield line_number, loads_bytes(line)
+        except ValueError as e:
+            yield line_number, RecordError(f"Invalid JSON: {e}")
+
+
+def read_csv(stream):
+    """Yield (line_number, record) from a CSV byte stream.
+
+    Rows have a ``record_type`` of patient, vital, family_history or tooth.
+    Consecutive rows with the same reference_number are one patient record.
+    """
+    lines = codecs.iterdecode(io.BufferedReader(stream, READ_BUFFER_SIZE), 'utf-8-sig')
+    reader = csv.DictReader(lines)
+
+    record, first_line, error = None, None, None
+    for row in reader:
+        row = {key: (value if value != '' else None) for key, value in row.items()}
+        reference_number = row.get('reference_number')
+        record_type = row.get('record_type')
+
+        starts_record = (
+            record is None
+            or reference_number != record['reference_number']
+            or (record_type == 'patient' and 'name' in record)
+        )
+        if starts_record:
+            if record is not None:
+                yield first_line, error or record
+            record = {'reference_number': reference_number, 'vitals': [], 'family_history': [], 'teeth': {}}
+            first_line, error = reader.line_num, None
+
+        if record_type == 'patient':
+            record['name'] = row.get('name')
+            record['created_at'] = row.get('created_at')
+        elif record_type == 'vital':
+            record['vitals'].append({field: row.get(field) for field in (*VITAL_FIELDS, 'recorded_at')})
+        elif record_type == 'family_history':
+            record['family_history'].append({field: row.get(field) for field in (*FAMILY_FIELDS, 'recorded_at')})
+        elif record_type == 'tooth':
+            record['teeth'][row.get('tooth_id') or ''] = row.get('tooth_condition')
+        else:
+            error = error or RecordError(f"Unknown record_type on line {reader.line_num}: {record_type}")
+
+    if record is not None:
+        yield first_line, error or record
+
+
+READERS = {'ndjson': read_ndjson, 'csv': read_csv}
+
+
+# ---------------------------------------------------------------- importing
+
+class BulkImporter:
+    """Import patient records in chunked transactions.
+
+    Records are validated with the agents' own rules and accumulated until a
+    batch holds ``batch_rows`` rows. Each batch then costs one IN query to
+    resolve reference numbers, one multi-row INSERT ... RETURNING for new
+    patients, one executemany per record table and one commit.
+
+    A record with a ``name`` creates a patient. If its reference number is
+    taken, ``on_conflict`` decides: ``rename`` appends a suffix, as
+    ``POST /api/patients`` does, ``skip`` ignores the record, and ``merge``
+    adds its records to the existing patient. A record without a name adds
+    its records to the existing patient with that reference number.
+    """
+
+    def __init__(self, master_agent, db_session, on_conflict='rename', batch_rows=5000):
+        self.vitals_agent = master_agent.get_agent('vitals')
+        self.family_history_agent = master_agent.get_agent('family_history')
+        self.teeth_agent = master_agent.get_agent('teeth')
+        self.db_session = db_session
+        self.on_conflict = on_conflict
+        self.batch_rows = batch_rows
+        self.summary = {
+            'patients_created': 0, 'patients_updated': 0, 'patients_skipped': 0,
+            'vitals': 0, 'family_history': 0, 'teeth': 0,
+            'batches': 0, 'error_count': 0, 'errors': []
+        }
+
+    def _error(self, line_number, message):
+        self.summary['error_count'] += 1
+        if len(self.summary['errors']) < MAX_REPORTED_ERRORS:
+            self.summary['errors'].append({'line': line_number, 'error': str(message)})
+
+    def run(self, records):
+        batch, rows = [], 0
+        for line_number, record in records:
+            try:
+                prepared = self._prepare(record)
+            except RecordError as e:
+                self._error(line_number, e)
+                continue
+            except (TypeError, AttributeError) as e:
+                # A field of the wrong JSON type; reject the record, not the import
+                self._error(line_number, f"Invalid record: {e}")
+                continue
+            batch.append((line_number, prepared))
+            rows += 1 + len(prepared['vitals']) + len(prepared['family_history']) + len(prepared['teeth'])
+            if rows >= self.batch_rows:
+                self._import_batch(batch)
+                batch, rows = [], 0
+        if batch:
+            self._import_batch(batch)
+        return self.summary
+
+    def _prepare(self, record):
+        """Validate and convert one record, raising RecordError if any part is invalid"""
+        if isinstance(record, Exception):
+            raise record
+        if not isinstance(record, dict):
+            raise RecordError('Each record must be a JSON object')
+
+        reference_number = (record.get('reference_number') or '').strip() or None
+        name = (record.get('name') or '').strip() or None
+        if not name and not reference_number:
+            raise RecordError('A record needs a name (new patient) or a reference_number (existing patient)')
+        if not all(isinstance(entry, dict) for key in ('vitals', 'family_history') for entry in record.get(key) or []):
+            raise RecordError('vitals and family_history must be lists of objects')
+        if not isinstance(record.get('teeth') or {}, dict):
+            raise RecordError('teeth must be an object mapping tooth ids to conditions')
+
+        vitals = []
+        for entry in record.get('vitals') or []:
+            try:
+                errors = self.vitals_agent.validate_vitals(entry)
+                row = self.vitals_agent.normalize_vitals(entry)
+            except (TypeError, ValueError) as e:
+                raise RecordError(f"Invalid vitals: {e}")
+            if errors:
+                raise RecordError('; '.join(errors))
+            row['recorded_at'] = _parse_datetime(entry.get('recorded_at')) or datetime.utcnow()
+            vitals.append(row)
+
+        family_history = []
+        for entry in record.get('family_history') or []:
+            errors = self.family_history_agent.validate_family_history(entry)
+            if errors:
+                raise RecordError('; '.join(errors))
+            age = entry.get('age_of_onset')
+            family_history.append({
+                'condition': entry['condition'],
+                'relation': entry.get('relation'),
+                'age_of_onset': int(age) if age not in (None, '') else None,
+                'notes': entry.get('notes'),
+                'recorded_at': _parse_datetime(entry.get('recorded_at')) or datetime.utcnow(),
+                'condition_code': condition_vocabulary.normalize_condition(entry['condition']),
+                'relation_code': condition_vocabulary.normalize_relation(entry.get('relation')),
+            })
+
+        teeth, errors = self.teeth_agent.normalize_teeth(record.get('teeth'))
+        if errors:
+            raise RecordError('; '.join(errors))
+
+        return {
+            'reference_number': reference_number,
+            'name': name,
+            'created_at': _parse_datetime(record.get('created_at')),
+            'vitals': vitals,
+            'family_history': family_history,
+            'teeth': teeth,
+        }
+
+    def _existing_ids(self, reference_numbers):
+        """Map reference numbers to patient ids with one IN query per IN_CLAUSE_SIZE"""
+        reference_numbers = list(reference_numbers)
+        found = {}
+        for offset in range(0, len(reference_numbers), IN_CLAUSE_SIZE):
+            chunk = reference_numbers[offset:offset + IN_CLAUSE_SIZE]
+            found.update(self.db_session.execute(
+                select(Patient.reference_number, Patient.id).where(Patient.reference_number.in_(chunk))
+            ).all())
+        return found
+
+    def _resolve_targets(self, batch):
+        """Decide, per record, which patient it belongs to. Returns (targets, new_patients)
+        where a target is ('existing', patient_id) or ('new', index into new_patients)."""
+        existing = self._existing_ids({record['reference_number'] for _, record in batch if record['reference_number']})
+        claimed = {}  # reference number -> target, for references used earlier in this batch
+        targets, new_patients = [], []
+
+        for line_number, record in batch:
+            reference_number = record['reference_number']
+            known = claimed.get(reference_number) or (
+                ('existing', existing[reference_number]) if reference_number in existing else None
+            )
+
+            if not record['name']:
+                if known is None:
+                    self._error(line_number, f"Unknown reference_number: {reference_number}")
+                    targets.append(None)
+                else:
+                    targets.append(known)
+                continue
+
+            if known is not None and self.on_conflict == 'skip':
+                self.summary['patients_skipped'] += 1
+                targets.append(None)
+                continue
+            if known is not None and self.on_conflict == 'merge':
+                targets.append(known)
+                continue
+
+            target = ('new', len(new_patients))
+            new_patients.append({
+                'reference_number': reference_number if known is None else None,
+                'requested': reference_number,
+                'name': record['name'],
+                'created_at': record['created_at'] or datetime.utcnow(),
+            })
+            if reference_number and known is None:
+                claimed[reference_number] = target
+            targets.append(target)
+
+        self._assign_reference_numbers(new_patients, existing)
+        return targets, new_patients
+
+    def _assign_reference_numbers(self, new_patients, existing):
+        """Give generated or suffixed reference numbers to patients that need one"""
+        taken = set(existing) | {patient['reference_number'] for patient in new_patients if patient['reference_number']}
+        pending = [patient for patient in new_patients if not patient['reference_number']]
+        while pending:
+            for patient in pending:
+                requested = patient['requested']
+                patient['reference_number'] = (
+                    f"{requested}-{str(uuid.uuid4())[:4].upper()}" if requested else generate_reference_number()
+                )
+            in_use = set(self._existing_ids(patient['reference_number'] for patient in pending))
+            retry = []
+            for patient in pending:
+                if patient['reference_number'] in taken or patient['reference_number'] in in_use:
+                    retry.append(patient)
+                else:
+                    taken.add(patient['reference_number'])
+            pending = retry
+
+    def _import_batch(self, batch):
+        db_session = self.db_session
+        targets, new_patients = self._resolve_targets(batch)
+
+        new_ids = []
+        if new_patients:
+            new_ids = list(db_session.scalars(
+                insert(Patient).returning(Patient.id, sort_by_parameter_order=True),
+                [
+                    {
+                        'reference_number': patient['reference_number'],
+                        'name': patient['name'],
+                        'created_at': patient['created_at'],
+                        'updated_at': patient['created_at'],
+                    }
+                    for patient in new_patients
+                ]
+            ))
+
+        vitals, family_history, teeth = [], [], {}
+        updated = {}  # existing patient id -> sections changed
+        for (line_number, record), target in zip(batch, targets):
+            if target is None:
+                continue
+            kind, value = target
+            patient_id = new_ids[value] if kind == 'new' else value
+            if kind == 'existing':
+                sections = updated.setdefault(patient_id, set())
+                sections.update(
+                    section for section, present in (
+                        ('vitals', record['vitals']), ('family_history', record['family_history']), ('teeth', record['teeth'])
+                    ) if present
+                )
+
+            vitals.extend(dict(row, patient_id=patient_id) for row in record['vitals'])
+            family_history.extend(dict(row, patient_id=patient_id) for row in record['family_history'])
+            for tooth_id, condition in record['teeth'].items():
+                teeth[(patient_id, tooth_id)] = condition
+
+        if vitals:
+            db_session.execute(insert(Vital), vitals)
+        if family_history:
+            db_session.execute(insert(FamilyHistory), family_history)
+            self.family_history_agent.add_to_aggregates(family_history, db_session)
+        if teeth:
+            self._replace_teeth(teeth, set(updated))
+
+        if new_patients:
+            touch_section(db_session, GLOBAL_SCOPE, 'patients')
+        if family_history:
+            touch_section(db_session, GLOBAL_SCOPE, 'family_history_aggregates')
+        for patient_id, sections in updated.items():
+            if sections:
+                touch_section(db_session, patient_id, *sections)
+        db_session.commit()
+
+        self.summary['patients_created'] += len(new_patients)
+        self.summary['patients_updated'] += len(updated)
+        self.summary['vitals'] += len(vitals)
+        self.summary['family_history'] += len(family_history)
+        self.summary['teeth'] += len(teeth)
+        self.summary['batches'] += 1
+
+    def _replace_teeth(self, teeth, existing_patient_ids):
+        """Insert tooth conditions, replacing any an existing patient already has"""
+        db_session = self.db_session
+        replaced = {}
+        for patient_id, tooth_id in teeth:
+            if patient_id in existing_patient_ids:
+                replaced.setdefault(patient_id, []).append(tooth_id)
+        for patient_id, tooth_ids in replaced.items():
+            db_session.query(DentalAssessment).filter(
+                DentalAssessment.patient_id == patient_id, DentalAssessment.tooth_id.in_(tooth_ids)
+            ).delete(synchronize_session=False)
+
+        now = datetime.utcnow()
+        db_session.execute(insert(DentalAssessment), [
+            {'patient_id': patient_id, 'tooth_id': tooth_id, 'condition': condition, 'updated_at': now}
+            for (patient_id, tooth_id), condition in teeth.items()
+        ])
+
+
+# ---------------------------------------------------------------- exporting
+
+def _patient_batches(db_session, batch_size):
+    """Yield lists of patient rows using keyset pagination, so no cursor stays open"""
+    table = Patient.__table__
+    last_id = 0
+    while True:
+        rows = db_session.execute(
+            select(table.c.id, table.c.reference_number, table.c.name, table.c.created_at)
+            .where(table.c.id > last_id).order_by(table.c.id).limit(batch_size)
+        ).mappings().all()
+        if not rows:
+            return
+        yield rows
+        last_id = rows[-1]['id']
+
+
+def _records_by_patient(db_session, model, columns, patient_ids):
+    table = model.__table__
+    grouped = {}
+    statement = (
+        select(table.c.patient_id, *(table.c[name] for name in columns))
+        .where(table.c.patient_id.in_(patient_ids)).order_by(table.c.patient_id, table.c.id)
+    )
+    for row in db_session.execute(statement).mappings():
+        grouped.setdefault(row['patient_id'], []).append(row)
+    return grouped
+
+
+def iter_export(db_session, fmt, batch_size=500):
+    """Generate an export of every patient with vitals, family history and teeth.
+
+    Patients are read in pages of batch_size and their records fetched with
+    one IN query per table, so memory is bounded by the page, not the export.
+    """
+    if fmt == 'csv':
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=CSV_COLUMNS, extrasaction='ignore')
+        writer.writeheader()
+        yield buffer.getvalue().encode('utf-8')
+
+    for patients in _patient_batches(db_session, batch_size):
+        patient_ids = [patient['id'] for patient in patients]
+        vitals = _records_by_patient(db_session, Vital, ('id', *VITAL_FIELDS, 'recorded_at'), patient_ids)
+        for patient_id, archived in tiering.archived_vitals(db_session, patient_ids).items():
+            vitals[patient_id] = list(tiering.merge_vitals(archived, vitals.get(patient_id, [])))
+        family_history = _records_by_patient(db_session, FamilyHistory, (*FAMILY_FIELDS, 'recorded_at'), patient_ids)
+        teeth = _records_by_patient(db_session, DentalAssessment, ('tooth_id', 'condition'), patient_ids)
+
+        if fmt == 'ndjson':
+            chunk = bytearray()
+            for patient in patients:
+                patient_id = patient['id']
+                chunk += dumps_bytes({
+                    'reference_number': patient['reference_number'],
+                    'name': patient['name'],
+                    'created_at': patient['created_at'],
+                    'vitals': [{field: row[field] for field in (*VITAL_FIELDS, 'recorded_at')} for row in vitals.get(patient_id, [])],
+                    'family_history': [{field: row[field] for field in (*FAMILY_FIELDS, 'recorded_at')} for row in family_history.get(patient_id, [])],
+                    'teeth': {row['tooth_id']: row['condition'] for row in teeth.get(patient_id, [])},
+                })
+                chunk += b'\n'
+            yield bytes(chunk)
+            continue
+
+        buffer.seek(0)
+        buffer.truncate()
+        for patient in patients:
+            patient_id = patient['id']
+            reference_number = patient['reference_number']
+            writer.writerow({
+                'record_type': 'patient', 'reference_number': reference_number,
+                'name': patient['name'], 'created_at': _isoformat(patient['created_at'])
+            })
+            for row in vitals.get(patient_id, []):
+                writer.writerow(dict(row, record_type='vital', reference_number=reference_number,
+                                     recorded_at=_isoformat(row['recorded_at'])))
+            for row in family_history.get(patient_id, []):
+                writer.writerow(dict(row, record_type='family_history', reference_number=reference_number,
+                                     recorded_at=_isoformat(row['recorded_at'])))
+            for row in teeth.get(patient_id, []):
+                writer.writerow({'record_type': 'tooth', 'reference_number': reference_number,
+                                 'tooth_id': row['tooth_id'], 'tooth_condition': row['condition']})
+        yield buffer.getvalue().encode('utf-8')
+
+
+def _isoformat(value):
+    return value.isoformat() if value else None
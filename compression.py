@@ -0,0 +1,155 @@
+"""
+Compression - Negotiated gzip/brotli/zstd encoding of API responses, buffered or streamed
+"""
+import gzip
+import zlib
+
+from flask import current_app, request
+
+try:
+    import brotli
+    BROTLI_AVAILABLE = True
+except ImportError:
+    BROTLI_AVAILABLE = False
+
+try:
+    import zstandard
+    ZSTD_AVAILABLE = True
+except ImportError:
+    ZSTD_AVAILABLE = False
+
+COMPRESSIBLE_MIMETYPES = {
+    'application/json',
+    'application/msgpack',
+    'application/x-msgpack',
+    'application/javascript',
+    'application/x-ndjson',
+    'image/svg+xml',
+}
+
+DEFAULT_LEVELS = {'gzip': 6, 'br': 5, 'zstd': 3}
+
+
+def _gzip(data, level):
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def _brotli(data, level):
+    return brotli.compress(data, quality=level)
+
+
+def _zstd(data, level):
+    return zstandard.ZstdCompressor(level=level).compress(data)
+
+
+def available_encodings():
+    """Supported encodings in server preference order"""
+    encodings = []
+    if ZSTD_AVAILABLE:
+        encodings.append('zstd')
+    if BROTLI_AVAILABLE:
+        encodings.append('br')
+    encodings.append('gzip')
+    return encodings
+
+
+_COMPRESSORS = {
+    'gzip': _gzip,
+    'br': _brotli,
+    'zstd': _zstd,
+}
+
+
+def _gzip_stream(level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress, compressor.flush
+
+
+def _brotli_stream(level):
+    compressor = brotli.Compressor(quality=level)
+    return compressor.process, compressor.finish
+
+
+def _zstd_stream(level):
+    compressor = zstandard.ZstdCompressor(level=level).compressobj()
+    return compressor.compress, compressor.flush
+
+
+_STREAM_COMPRESSORS = {
+    'gzip': _gzip_stream,
+    'br': _brotli_stream,
+    'zstd': _zstd_stream,
+}
+
+
+def _compress_stream(chunks, encoding, level):
+    """Compress an iterable body incrementally, closing it when done"""
+    compress, finish = _STREAM_COMPRESSORS[encoding](level)
+    try:
+        for chunk in chunks:
+            data = compress(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+            if data:
+                yield data
+        yield finish()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+# Streams that must reach the client as soon as each chunk is written
+UNBUFFERED_MIMETYPES = {'text/event-stream'}
+
+
+def is_compressible(mimetype):
+    if not mimetype or mimetype in UNBUFFERED_MIMETYPES:
+        return False
+    return mimetype.startswith('text/') or mimetype in COMPRESSIBLE_MIMETYPES
+
+
+def negotiate_encoding():
+    """Pick the best content coding the client accepts, or None"""
+    return request.accept_encodings.best_match(available_encodings())
+
+
+def compress_response(response):
+    """after_request hook that compresses eligible response bodies"""
+    config = current_app.config
+
+    if not config.get('COMPRESSION_ENABLED', True):
+        return response
+    if response.status_code < 200 or response.status_code in (204, 206, 304):
+        return response
+    if response.direct_passthrough:
+        return response
+    if 'Content-Encoding' in response.headers or not is_compressible(response.mimetype):
+        return response
+    # Streamed bodies have no length yet; they are compressed as they are produced
+    if not response.is_streamed and (response.content_length or 0) < config.get('COMPRESSION_MIN_SIZE', 1024):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate_encoding()
+    if encoding is None:
+        return response
+
+    levels = config.get('COMPRESSION_LEVELS') or DEFAULT_LEVELS
+    level = levels.get(encoding, DEFAULT_LEVELS[encoding])
+    if response.is_streamed:
+        response.response = _compress_stream(response.response, encoding, level)
+        response.headers.pop('Content-Length', None)
+        response.headers['Content-Encoding'] = encoding
+        return response
+
+    data = response.get_data()
+    compressed = _COMPRESSORS[encoding](data, level)
+    if len(compressed) >= len(data):
+        return response
+
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def init_app(app):
+    """Register response compression on a Flask app"""
+    app.after_request(compress_response)
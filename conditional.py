@@ -0,0 +1,66 @@
+"""
+Conditional GET - Weak ETags and Last-Modified derived from section versions
+"""
+import hashlib
+from functools import wraps
+
+from flask import make_response, request
+
+from database import db, SectionVersion
+
+PATIENT_SECTIONS = ('patient', 'documents', 'vitals', 'family_history', 'images', 'teeth')
+
+
+def load_validators(patient_id, sections):
+    """Build (etag, last_modified) for the given sections with a single query"""
+    rows = (
+        db.session.query(SectionVersion.section, SectionVersion.version, SectionVersion.updated_at)
+        .filter(SectionVersion.patient_id == patient_id, SectionVersion.section.in_(sections))
+        .all()
+    )
+    versions = {section: (version, updated_at) for section, version, updated_at in rows}
+
+    key = f"{patient_id}:" + ",".join(
+        f"{section}={versions.get(section, (0, None))[0]}" for section in sections
+    )
+    etag = hashlib.blake2b(key.encode('utf-8'), digest_size=8).hexdigest()
+
+    timestamps = [updated_at for _, updated_at in versions.values() if updated_at]
+    last_modified = max(timestamps).replace(microsecond=0) if timestamps else None
+    return etag, last_modified
+
+
+def _is_not_modified(etag, last_modified):
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if last_modified and request.if_modified_since:
+        return last_modified <= request.if_modified_since.replace(tzinfo=None)
+    return False
+
+
+def conditional_get(*sections, scope=None):
+    """Decorator answering 304 from section versions before the view loads any rows.
+
+    Views are keyed on their ``patient_id`` argument unless ``scope`` is given
+    (e.g. ``GLOBAL_SCOPE`` for the patient list).
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            patient_id = scope if scope is not None else kwargs['patient_id']
+            etag, last_modified = load_validators(patient_id, sections)
+
+            if _is_not_modified(etag, last_modified):
+                response = make_response('', 304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+
+            response.set_etag(etag, weak=True)
+            if last_modified:
+                response.last_modified = last_modified
+            response.cache_control.no_cache = True
+            return response
+        return wrapper
+    return decorator
@@ -3,11 +3,98 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
+def engine_options(database_uri):
+    """Connection pool settings for the configured database"""
+    if database_uri.startswith('sqlite'):
+        if ':memory:' in database_uri or database_uri.rstrip('/') == 'sqlite:':
+            return {}  # Flask-SQLAlchemy uses a single static connection
+        # One connection per request thread; SQLite connections are cheap and never go stale
+        return {
+            'pool_size': int(os.environ.get('DB_POOL_SIZE', 8)),
+            'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 8)),
+            'pool_timeout': 10,
+        }
+    return {
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 5)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+        'pool_timeout': 10,
+        'pool_pre_ping': True,  # Drop connections closed by the server or a failover
+        'pool_recycle': 1800,  # Seconds; below typical server/proxy idle timeouts
+    }
+
 class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'dev-secret-key-change-in-production'
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///clinical_assistant.db'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_ENGINE_OPTIONS = engine_options(SQLALCHEMY_DATABASE_URI)
+    # Applied to every new SQLite connection. WAL lets readers run alongside a writer
+    # (across worker processes too) and busy_timeout makes writers wait for the lock
+    # instead of failing with "database is locked".
+    SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',  # Durable at checkpoints; safe with WAL
+        'busy_timeout': 5000,  # Milliseconds
+        'mmap_size': 256 * 1024 * 1024,
+        'cache_size': -16000,  # KiB (negative), per connection
+    }
+    DEBUG = os.environ.get('FLASK_DEBUG') == '1'
     UPLOAD_FOLDER = 'uploads'
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB max file size
     ALLOWED_EXTENSIONS = {'pdf', 'png', 'jpg', 'jpeg', 'dicom', 'dcm'}
-
+    IMAGE_WORKERS = int(os.environ.get('IMAGE_WORKERS', 2))  # Background tiling/thumbnail threads
+    IMAGE_DERIVATIVE_TIMEOUT = 900  # Seconds a pyramid build may stay pending before it is queued again
+    PHASH_DUPLICATE_DISTANCE = 6  # Max differing bits (of 64) for an image to be flagged as a near-duplicate of an earlier one
+    
+    # Resumable uploads (each chunk is its own request, so it must fit MAX_CONTENT_LENGTH)
+    UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+    RESUMABLE_UPLOAD_MAX_SIZE = 4 * 1024 * 1024 * 1024  # 4GB
+    RESUMABLE_UPLOAD_TTL = 24 * 3600  # Seconds before an idle upload is garbage-collected
+    RESUMABLE_UPLOAD_PURGE_INTERVAL = 600  # Seconds between opportunistic purges
+    
+    # Upload serving
+    UPLOADS_MAX_AGE = 0  # Seconds, for upload names that are not immutable
+    USE_X_SENDFILE = os.environ.get('USE_X_SENDFILE') == '1'  # Apache/lighttpd
+    UPLOADS_ACCEL_REDIRECT_PREFIX = os.environ.get('UPLOADS_ACCEL_REDIRECT_PREFIX')  # nginx internal location
+    
+    # Bulk import/export
+    BULK_IMPORT_MAX_SIZE = 4 * 1024 * 1024 * 1024  # 4GB request body for POST /api/import
+    BULK_IMPORT_BATCH_ROWS = 5000  # Rows per import transaction
+    EXPORT_BATCH_PATIENTS = 500  # Patients per export page
+    
+    # Admission control: per-class concurrency, wait queue (requests), queue wait (seconds)
+    # and per-client token bucket (rate per second, burst). Limits are per worker process;
+    # with threaded workers keep the expensive classes' concurrency + queue below the
+    # thread count so reads always find a free thread.
+    ADMISSION_CONTROL_ENABLED = os.environ.get('ADMISSION_CONTROL', '1') == '1'
+    ADMISSION_TRUST_PROXY = os.environ.get('ADMISSION_TRUST_PROXY') == '1'  # Rate-limit by X-Forwarded-For
+    ADMISSION_CLASSES = {
+        'chat': {'concurrency': 2, 'queue': 4, 'queue_timeout': 15, 'rate': 0.5, 'burst': 5},
+        'ocr_upload': {'concurrency': 2, 'queue': 4, 'queue_timeout': 30, 'rate': 0.5, 'burst': 10},
+        'image_upload': {'concurrency': 4, 'queue': 8, 'queue_timeout': 30, 'rate': 1, 'burst': 20},
+        'bulk': {'concurrency': 1, 'queue': 1, 'queue_timeout': 5, 'rate': 0.1, 'burst': 3},
+        # Archives hold their slot for the whole (possibly multi-GB) download
+        'archive': {'concurrency': 3, 'queue': 2, 'queue_timeout': 10, 'rate': 0.2, 'burst': 10},
+        'read': {'concurrency': 32, 'queue': 64, 'queue_timeout': 2, 'rate': 200, 'burst': 1000},
+    }
+    # Threads per worker process (set by gunicorn.conf.py); classes are sized to fit. 0 = unbounded (dev server)
+    ADMISSION_WORKER_THREADS = int(os.environ.get('WORKER_THREADS', 0))
+    
+    # Cold storage tiering (flask tier-storage, e.g. nightly from cron)
+    TIER_UPLOADS_AFTER_DAYS = int(os.environ.get('TIER_UPLOADS_AFTER_DAYS', 90))  # Idle days before an upload moves to a pack
+    TIER_VITALS_AFTER_DAYS = int(os.environ.get('TIER_VITALS_AFTER_DAYS', 365))  # Age of vitals moved to monthly segments
+    TIER_PACK_FOLDER = os.environ.get('TIER_PACK_FOLDER') or 'packs'  # Kept outside UPLOAD_FOLDER so it is never served
+    TIER_PACK_MAX_SIZE = 1024 * 1024 * 1024  # A new pack file is started past this size
+    TIER_CACHE_MAX_SIZE = 2 * 1024 * 1024 * 1024  # Rehydrated uploads kept in UPLOAD_FOLDER/cache
+    
+    # Change events (Server-Sent Events)
+    EVENTS_HEARTBEAT_INTERVAL = 15  # Seconds between keepalive comments
+    EVENTS_QUEUE_SIZE = 256  # Undelivered events per client before it is told to reload
+    # Open streams per process; each holds a thread, so keep it below the worker's thread count (0 = no limit)
+    EVENTS_MAX_STREAMS = int(os.environ.get('EVENTS_MAX_STREAMS', 0))
+    EVENTS_RELAY_PATH = os.environ.get('EVENTS_RELAY_PATH')  # SQLite file shared by workers; unset = single process
+    EVENTS_RELAY_POLL_INTERVAL = 0.25
+    
+    # Response encoding
+    COMPRESSION_ENABLED = True
+    COMPRESSION_MIN_SIZE = 1024  # Bytes; smaller bodies are sent uncompressed
+    COMPRESSION_LEVELS = {'gzip': 6, 'br': 5, 'zstd': 3}
@@ -1,8 +1,46 @@
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, update
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from datetime import datetime
 
 db = SQLAlchemy()
 
+# patient_id used for sections that are not scoped to a single patient
+GLOBAL_SCOPE = 0
+
+# Session.info key collecting touched sections until the transaction commits
+PENDING_CHANGES_KEY = 'pending_changes'
+
+def init_engine(app):
+    """Apply SQLITE_PRAGMAS to every new connection of the app's engine"""
+    with app.app_context():
+        engine = db.engine
+    pragmas = app.config.get('SQLITE_PRAGMAS')
+    if engine.dialect.name != 'sqlite' or not pragmas:
+        return
+    
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+def dispose_engine(app):
+    """Drop pooled connections inherited from a parent process without closing them.
+
+    Called in a forked worker: the parent's sockets and SQLite handles must
+    not be used from two processes, so the child starts with an empty pool.
+    """
+    with app.app_context():
+        db.engine.dispose(close=False)
+
+def format_phash(value):
+    """Render a signed 64-bit perceptual hash column as 16 hex digits"""
+    return f"{value & 0xFFFFFFFFFFFFFFFF:016x}" if value is not None else None
+
 class Patient(db.Model):
     __tablename__ = 'patients'
     
@@ -19,13 +57,16 @@ class Patient(db.Model):
     images = db.relationship('MedicalImage', backref='patient', lazy=True, cascade='all, delete-orphan')
     dental_records = db.relationship('DentalAssessment', backref='patient', lazy=True, cascade='all, delete-orphan')
     
+    # Columns selected by the streamed list endpoints, matching to_dict()
+    list_columns = ('id', 'reference_number', 'name', 'created_at', 'updated_at')
+    
     def to_dict(self):
         return {
             'id': self.id,
             'reference_number': self.reference_number,
             'name': self.name,
-            'created_at': self.created_at.isoformat() if self.created_at else None,
-            'updated_at': self.updated_at.isoformat() if self.updated_at else None
+            'created_at': self.created_at,
+            'updated_at': self.updated_at
         }
 
 class Document(db.Model):
@@ -35,22 +76,42 @@ class Document(db.Model):
     patient_id = db.Column(db.Integer, db.ForeignKey('patients.id'), nullable=False)
     filename = db.Column(db.String(255), nullable=False)
     file_path = db.Column(db.String(500), nullable=False)
-    parsed_text = db.Column(db.Text)
+    sha256 = db.Column(db.String(64), index=True)
+    text_preview = db.Column(db.String(500))
+    text_length = db.Column(db.Integer)
     document_type = db.Column(db.String(100))
     uploaded_at = db.Column(db.DateTime, default=datetime.utcnow)
     
+    # Full parsed text lives compressed in document_texts and is only loaded on access
+    text = db.relationship('DocumentText', uselist=False, lazy='select', cascade='all, delete-orphan')
+    
+    list_columns = ('id', 'patient_id', 'filename', 'sha256', 'text_preview', 'text_length', 'document_type', 'uploaded_at')
+    
     def to_dict(self):
         return {
             'id': self.id,
             'patient_id': self.patient_id,
             'filename': self.filename,
-            'parsed_text': self.parsed_text,
+            'sha256': self.sha256,
+            'text_preview': self.text_preview,
+            'text_length': self.text_length,
             'document_type': self.document_type,
-            'uploaded_at': self.uploaded_at.isoformat() if self.uploaded_at else None
+            'uploaded_at': self.uploaded_at
         }
 
+class DocumentText(db.Model):
+    """Compressed parsed text of a document, kept out of the documents row"""
+    __tablename__ = 'document_texts'
+    
+    document_id = db.Column(db.Integer, db.ForeignKey('documents.id'), primary_key=True, autoincrement=False)
+    codec = db.Column(db.String(10), nullable=False)
+    data = db.Column(db.LargeBinary, nullable=False)
+
 class Vital(db.Model):
     __tablename__ = 'vitals'
+    __table_args__ = (
+        db.Index('ix_vitals_patient_recorded', 'patient_id', 'recorded_at'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     patient_id = db.Column(db.Integer, db.ForeignKey('patients.id'), nullable=False)
@@ -64,6 +125,11 @@ class Vital(db.Model):
     oxygen_saturation = db.Column(db.Float)
     recorded_at = db.Column(db.DateTime, default=datetime.utcnow)
     
+    list_columns = (
+        'id', 'patient_id', 'temperature', 'weight', 'height', 'blood_pressure_systolic',
+        'blood_pressure_diastolic', 'heart_rate', 'respiratory_rate', 'oxygen_saturation', 'recorded_at'
+    )
+    
     def to_dict(self):
         return {
             'id': self.id,
@@ -76,7 +142,7 @@ class Vital(db.Model):
             'heart_rate': self.heart_rate,
             'respiratory_rate': self.respiratory_rate,
             'oxygen_saturation': self.oxygen_saturation,
-            'recorded_at': self.recorded_at.isoformat() if self.recorded_at else None
+            'recorded_at': self.recorded_at
         }
 
 class FamilyHistory(db.Model):
@@ -90,6 +156,12 @@ class FamilyHistory(db.Model):
     notes = db.Column(db.Text)
     recorded_at = db.Column(db.DateTime, default=datetime.utcnow)
     
+    # Normalised vocabulary codes used by the cohort aggregates
+    condition_code = db.Column(db.String(100), index=True)
+    relation_code = db.Column(db.String(50))
+    
+    list_columns = ('id', 'patient_id', 'condition', 'relation', 'age_of_onset', 'notes', 'recorded_at')
+    
     def to_dict(self):
         return {
             'id': self.id,
@@ -98,9 +170,39 @@ class FamilyHistory(db.Model):
             'relation': self.relation,
             'age_of_onset': self.age_of_onset,
             'notes': self.notes,
-            'recorded_at': self.recorded_at.isoformat() if self.recorded_at else None
+            'recorded_at': self.recorded_at
         }
 
+class FamilyConditionStat(db.Model):
+    """Cohort aggregate: family history entries per condition and relation"""
+    __tablename__ = 'family_condition_stats'
+    
+    condition_code = db.Column(db.String(100), primary_key=True)
+    relation_code = db.Column(db.String(50), primary_key=True)
+    entries = db.Column(db.Integer, nullable=False, default=0)
+    onset_count = db.Column(db.Integer, nullable=False, default=0)
+    onset_sum = db.Column(db.Integer, nullable=False, default=0)
+
+class FamilyOnsetBucket(db.Model):
+    """Cohort aggregate: age-of-onset distribution per condition, by decade"""
+    __tablename__ = 'family_onset_buckets'
+    
+    condition_code = db.Column(db.String(100), primary_key=True)
+    bucket = db.Column(db.String(10), primary_key=True)
+    entries = db.Column(db.Integer, nullable=False, default=0)
+
+class PatientConditionRisk(db.Model):
+    """Hereditary-risk index: relatives per patient affected by each condition"""
+    __tablename__ = 'patient_condition_risk'
+    __table_args__ = (
+        db.Index('ix_condition_risk_first_degree', 'condition_code', 'first_degree_count'),
+    )
+    
+    patient_id = db.Column(db.Integer, db.ForeignKey('patients.id'), primary_key=True, autoincrement=False)
+    condition_code = db.Column(db.String(100), primary_key=True)
+    first_degree_count = db.Column(db.Integer, nullable=False, default=0)
+    total_count = db.Column(db.Integer, nullable=False, default=0)
+
 class MedicalImage(db.Model):
     __tablename__ = 'medical_images'
     
@@ -108,18 +210,79 @@ class MedicalImage(db.Model):
     patient_id = db.Column(db.Integer, db.ForeignKey('patients.id'), nullable=False)
     filename = db.Column(db.String(255), nullable=False)
     file_path = db.Column(db.String(500), nullable=False)
+    sha256 = db.Column(db.String(64), index=True)
     image_type = db.Column(db.String(100))
     description = db.Column(db.Text)
     uploaded_at = db.Column(db.DateTime, default=datetime.utcnow)
     
+    # 64-bit perceptual hash, plus its four 16-bit bands for multi-index Hamming search
+    phash = db.Column(db.BigInteger)
+    phash_band0 = db.Column(db.Integer, index=True)
+    phash_band1 = db.Column(db.Integer, index=True)
+    phash_band2 = db.Column(db.Integer, index=True)
+    phash_band3 = db.Column(db.Integer, index=True)
+    # Closest earlier image of the same patient within PHASH_DUPLICATE_DISTANCE bits
+    near_duplicate_of = db.Column(db.Integer, db.ForeignKey('medical_images.id'))
+    
+    # Tile pyramid and thumbnails: pending, ready, failed, or none (DICOM previews are rendered on request)
+    derivatives_status = db.Column(db.String(10), nullable=False, default='pending')
+    derivatives_error = db.Column(db.Text)
+    derivatives_updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    dicom = db.relationship('DicomMetadata', backref='image', uselist=False, cascade='all, delete-orphan')
+    
+    list_columns = (
+        'id', 'patient_id', 'filename', 'sha256', 'phash', 'near_duplicate_of', 'image_type', 'description',
+        'uploaded_at', 'derivatives_status'
+    )
+    list_formatters = {'phash': format_phash}
+    
     def to_dict(self):
         return {
             'id': self.id,
             'patient_id': self.patient_id,
             'filename': self.filename,
+            'sha256': self.sha256,
+            'phash': format_phash(self.phash),
+            'near_duplicate_of': self.near_duplicate_of,
             'image_type': self.image_type,
             'description': self.description,
-            'uploaded_at': self.uploaded_at.isoformat() if self.uploaded_at else None
+            'uploaded_at': self.uploaded_at,
+            'derivatives_status': self.derivatives_status
+        }
+
+class DicomMetadata(db.Model):
+    """Indexed DICOM header tags for a medical image"""
+    __tablename__ = 'dicom_metadata'
+    __table_args__ = (
+        db.Index('ix_dicom_patient_modality', 'patient_id', 'modality'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    image_id = db.Column(db.Integer, db.ForeignKey('medical_images.id'), nullable=False, unique=True)
+    patient_id = db.Column(db.Integer, db.ForeignKey('patients.id'), nullable=False)
+    modality = db.Column(db.String(16), index=True)
+    study_instance_uid = db.Column(db.String(64), index=True)
+    series_instance_uid = db.Column(db.String(64), index=True)
+    sop_instance_uid = db.Column(db.String(64), index=True)
+    rows = db.Column(db.Integer)
+    columns = db.Column(db.Integer)
+    number_of_frames = db.Column(db.Integer)
+    acquisition_date = db.Column(db.Date, index=True)
+    transfer_syntax_uid = db.Column(db.String(64))
+    pixel_data_offset = db.Column(db.BigInteger)
+    
+    def to_dict(self):
+        return {
+            'modality': self.modality,
+            'study_instance_uid': self.study_instance_uid,
+            'series_instance_uid': self.series_instance_uid,
+            'sop_instance_uid': self.sop_instance_uid,
+            'rows': self.rows,
+            'columns': self.columns,
+            'number_of_frames': self.number_of_frames,
+            'acquisition_date': self.acquisition_date,
+            'transfer_syntax_uid': self.transfer_syntax_uid
         }
 
 class DentalAssessment(db.Model):
@@ -140,6 +303,139 @@ class DentalAssessment(db.Model):
             'patient_id': self.patient_id,
             'tooth_id': self.tooth_id,
             'condition': self.condition,
-            'updated_at': self.updated_at.isoformat() if self.updated_at else None
+            'updated_at': self.updated_at
         }
 
+class UploadSession(db.Model):
+    """Resumable upload in progress; chunks are written straight into a part file"""
+    __tablename__ = 'upload_sessions'
+    
+    id = db.Column(db.String(32), primary_key=True)
+    patient_id = db.Column(db.Integer, db.ForeignKey('patients.id'), nullable=False)
+    kind = db.Column(db.String(20), nullable=False)
+    filename = db.Column(db.String(255), nullable=False)
+    total_size = db.Column(db.BigInteger, nullable=False)
+    chunk_size = db.Column(db.Integer, nullable=False)
+    sha256 = db.Column(db.String(64))
+    fields = db.Column(db.JSON)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
+    
+    chunks = db.relationship('UploadChunk', backref='upload', lazy=True, cascade='all, delete-orphan')
+    
+    @property
+    def total_chunks(self):
+        return max(1, -(-self.total_size // self.chunk_size))
+    
+    def to_dict(self):
+        return {
+            'upload_id': self.id,
+            'patient_id': self.patient_id,
+            'kind': self.kind,
+            'filename': self.filename,
+            'total_size': self.total_size,
+            'chunk_size': self.chunk_size,
+            'total_chunks': self.total_chunks,
+            'received': sorted(chunk.index for chunk in self.chunks),
+            'created_at': self.created_at,
+            'updated_at': self.updated_at
+        }
+
+class UploadChunk(db.Model):
+    __tablename__ = 'upload_chunks'
+    
+    upload_id = db.Column(db.String(32), db.ForeignKey('upload_sessions.id'), primary_key=True)
+    index = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    sha256 = db.Column(db.String(64), nullable=False)
+
+class PackBlob(db.Model):
+    """A compressed object in a cold-storage pack file, addressed by the SHA-256 of its content"""
+    __tablename__ = 'pack_blobs'
+    
+    sha256 = db.Column(db.String(64), primary_key=True)
+    pack = db.Column(db.String(100), nullable=False)
+    offset = db.Column(db.BigInteger, nullable=False)
+    length = db.Column(db.BigInteger, nullable=False)  # Bytes stored in the pack
+    size = db.Column(db.BigInteger, nullable=False)  # Bytes once decompressed
+    codec = db.Column(db.String(10), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class ArchivedUpload(db.Model):
+    """An uploaded file moved out of the upload folder into a pack"""
+    __tablename__ = 'archived_uploads'
+    
+    file_path = db.Column(db.String(500), primary_key=True)
+    sha256 = db.Column(db.String(64), db.ForeignKey('pack_blobs.sha256'), nullable=False, index=True)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    blob = db.relationship('PackBlob', lazy='joined')
+
+class VitalSegment(db.Model):
+    """One patient's vitals for a calendar month, moved out of the vitals table into a pack"""
+    __tablename__ = 'vital_segments'
+    
+    patient_id = db.Column(db.Integer, db.ForeignKey('patients.id'), primary_key=True, autoincrement=False)
+    month = db.Column(db.String(7), primary_key=True)  # YYYY-MM
+    sha256 = db.Column(db.String(64), db.ForeignKey('pack_blobs.sha256'), nullable=False)
+    row_count = db.Column(db.Integer, nullable=False)
+    # Lowest row id, so readers open a segment only when an id-ordered merge reaches it
+    first_id = db.Column(db.Integer, nullable=False)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    blob = db.relationship('PackBlob', lazy='joined')
+
+class SectionVersion(db.Model):
+    """Monotonic change counter per patient and record section, used for ETags"""
+    __tablename__ = 'section_versions'
+    
+    patient_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    section = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+def upsert(db_session, model, keys, values, updates):
+    """Insert a row, or apply updates to the existing row with the same primary key.
+
+    Uses the dialect's single-statement upsert, so concurrent writers cannot
+    both insert the same key. Dialects without one fall back to UPDATE and
+    then INSERT if no row matched.
+    """
+    table = model.__table__
+    dialect = db_session.get_bind().dialect.name
+    if dialect in ('sqlite', 'postgresql'):
+        insert = sqlite_insert if dialect == 'sqlite' else postgresql_insert
+        statement = insert(table).values(**keys, **values).on_conflict_do_update(
+            index_elements=list(keys), set_=updates
+        )
+    elif dialect in ('mysql', 'mariadb'):
+        statement = mysql_insert(table).values(**keys, **values).on_duplicate_key_update(updates)
+    else:
+        result = db_session.execute(
+            update(table)
+            .where(*(table.c[column] == value for column, value in keys.items()))
+            .values(updates)
+        )
+        if result.rowcount == 0:
+            db_session.execute(table.insert().values(**keys, **values))
+        return
+    db_session.execute(statement)
+
+def increment_counters(db_session, model, keys, **increments):
+    """Add to counter columns of the row identified by keys, creating it if needed"""
+    table = model.__table__
+    upsert(db_session, model, keys, increments, {
+        column: table.c[column] + amount for column, amount in increments.items()
+    })
+
+def touch_section(db_session, patient_id, *sections):
+    """Bump the version of one or more sections as part of the current transaction"""
+    now = datetime.utcnow()
+    pending = db_session.info.setdefault(PENDING_CHANGES_KEY, {}).setdefault(patient_id, set())
+    pending.update(sections)
+    table = SectionVersion.__table__
+    for section in sections:
+        upsert(
+            db_session, SectionVersion, {'patient_id': patient_id, 'section': section},
+            {'version': 1, 'updated_at': now},
+            {'version': table.c.version + 1, 'updated_at': now}
+        )
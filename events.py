@@ -0,0 +1,243 @@
+"""
+Events - Change feed published after commit, served as Server-Sent Events
+"""
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+from collections import deque
+
+from sqlalchemy import event
+
+from database import PENDING_CHANGES_KEY
+
+
+def format_sse(evt):
+    """Encode one change event in the text/event-stream format"""
+    data = json.dumps({'patient_id': evt['patient_id'], 'sections': evt['sections']}, separators=(',', ':'))
+    return f"id: {evt['id']}\nevent: change\ndata: {data}\n\n"
+
+
+RESET_EVENT = "event: reset\ndata: {}\n\n"
+
+
+class Subscription:
+    """A subscriber's bounded queue of events, optionally filtered to one patient"""
+
+    def __init__(self, patient_id=None, maxsize=256):
+        self.patient_id = patient_id
+        self.queue = queue.Queue(maxsize)
+        self.overflowed = False
+
+    def wants(self, evt):
+        return self.patient_id is None or evt['patient_id'] == self.patient_id
+
+    def offer(self, evt):
+        try:
+            self.queue.put_nowait(evt)
+        except queue.Full:
+            # A slow client loses individual events and is told to reload instead
+            self.overflowed = True
+
+
+class SQLiteRelay:
+    """Share events between worker processes through a local SQLite log.
+
+    Every worker appends its committed changes to the log, and a poller
+    thread in each worker that has subscribers dispatches new rows to its
+    local bus. The log's row ids are the event ids, so ``Last-Event-ID``
+    means the same thing whichever worker a client reconnects to.
+    """
+
+    def __init__(self, path, poll_interval=0.25, retention=10000):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._poller = None
+        self._poller_pid = None
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS change_events ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, patient_id INTEGER NOT NULL, '
+            'sections TEXT NOT NULL, created_at REAL NOT NULL)'
+        )
+        return connection
+
+    def _connection(self):
+        # Connections must not cross a fork, so they are keyed by process as well as thread
+        if getattr(self._local, 'pid', None) != os.getpid():
+            self._local.connection = self._connect()
+            self._local.pid = os.getpid()
+        return self._local.connection
+
+    def append(self, changes):
+        now = time.time()
+        self._connection().executemany(
+            'INSERT INTO change_events (patient_id, sections, created_at) VALUES (?, ?, ?)',
+            [(change['patient_id'], json.dumps(change['sections']), now) for change in changes]
+        )
+
+    def start(self, bus):
+        """Start the poller in this process, once"""
+        with self._lock:
+            if self._poller_pid == os.getpid() and self._poller.is_alive():
+                return
+            self._poller = threading.Thread(target=self._poll, args=(bus,), name='event-relay', daemon=True)
+            self._poller_pid = os.getpid()
+            self._poller.start()
+
+    def _poll(self, bus):
+        connection = self._connect()
+        last_id = connection.execute('SELECT COALESCE(MAX(id), 0) FROM change_events').fetchone()[0]
+        polls = 0
+        while True:
+            rows = connection.execute(
+                'SELECT id, patient_id, sections FROM change_events WHERE id > ? ORDER BY id', (last_id,)
+            ).fetchall()
+            for event_id, patient_id, sections in rows:
+                bus.dispatch({'id': event_id, 'patient_id': patient_id, 'sections': json.loads(sections)})
+                last_id = event_id
+
+            polls += 1
+            if polls % 1000 == 0:
+                connection.execute('DELETE FROM change_events WHERE id <= ?', (last_id - self.retention,))
+            time.sleep(self.poll_interval)
+
+
+class TooManySubscribers(Exception):
+    """Every event stream slot of this process is in use"""
+
+
+class EventBus:
+    """In-process publish/subscribe of record changes"""
+
+    def __init__(self, queue_size=256, replay_size=1000, max_subscribers=None):
+        self.queue_size = queue_size
+        self.max_subscribers = max_subscribers
+        self.relay = None
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        self._recent = deque(maxlen=replay_size)
+        self._next_id = 1
+
+    def publish(self, changes):
+        """Publish a list of ``{'patient_id', 'sections'}`` changes"""
+        if self.relay:
+            self.relay.append(changes)
+            return
+        for change in changes:
+            with self._lock:
+                evt = dict(change, id=self._next_id)
+                self._next_id += 1
+            self.dispatch(evt)
+
+    def dispatch(self, evt):
+        with self._lock:
+            self._recent.append(evt)
+            self._next_id = max(self._next_id, evt['id'] + 1)
+            subscribers = list(self._subscribers)
+        for subscription in subscribers:
+            if subscription.wants(evt):
+                subscription.offer(evt)
+
+    def subscribe(self, patient_id=None, last_event_id=None):
+        """Register a subscriber; returns (subscription, replay) where replay is
+        the missed events since last_event_id, or None if they are no longer
+        available and the client must reload.
+
+        Raises TooManySubscribers once max_subscribers streams are open, since
+        each one holds a server thread for as long as it is connected.
+        """
+        if self.relay:
+            self.relay.start(self)
+
+        subscription = Subscription(patient_id, self.queue_size)
+        with self._lock:
+            if self.max_subscribers and len(self._subscribers) >= self.max_subscribers:
+                raise TooManySubscribers()
+            self._subscribers.add(subscription)
+            replay = []
+            if last_event_id is not None:
+                oldest = self._recent[0]['id'] if self._recent else self._next_id
+                if last_event_id + 1 < oldest or last_event_id >= self._next_id:
+                    replay = None
+                else:
+                    replay = [evt for evt in self._recent if evt['id'] > last_event_id and subscription.wants(evt)]
+        return subscription, replay
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    @property
+    def subscriber_count(self):
+        return len(self._subscribers)
+
+    def stream(self, subscription, replay, heartbeat=15):
+        """Generate the text/event-stream body for a subscription"""
+        try:
+            yield "retry: 3000\n\n"
+            if replay is None:
+                yield RESET_EVENT
+            else:
+                for evt in replay:
+                    yield format_sse(evt)
+
+            while True:
+                if subscription.overflowed:
+                    subscription.overflowed = False
+                    while not subscription.queue.empty():
+                        subscription.queue.get_nowait()
+                    yield RESET_EVENT
+                try:
+                    evt = subscription.queue.get(timeout=heartbeat)
+                except queue.Empty:
+                    # Comment lines keep proxies from timing out and detect closed clients
+                    yield ": keepalive\n\n"
+                    continue
+                yield format_sse(evt)
+        finally:
+            self.unsubscribe(subscription)
+
+
+bus = EventBus()
+
+
+def _after_commit(session):
+    pending = session.info.pop(PENDING_CHANGES_KEY, None)
+    if not pending:
+        return
+    # The transaction is already committed, so a relay failure must not reach the
+    # caller; the section versions are durable and clients catch up on revalidation
+    try:
+        bus.publish([
+            {'patient_id': patient_id, 'sections': sorted(sections)}
+            for patient_id, sections in pending.items()
+        ])
+    except Exception as e:
+        print(f"Warning: Could not publish section changes: {str(e)}")
+
+
+def _after_rollback(session):
+    session.info.pop(PENDING_CHANGES_KEY, None)
+
+
+def init_app(app, db):
+    """Publish section changes from db's sessions once they are committed"""
+    bus.queue_size = app.config.get('EVENTS_QUEUE_SIZE', 256)
+    bus.max_subscribers = app.config.get('EVENTS_MAX_STREAMS')
+    relay_path = app.config.get('EVENTS_RELAY_PATH')
+    if relay_path:
+        bus.relay = SQLiteRelay(relay_path, app.config.get('EVENTS_RELAY_POLL_INTERVAL', 0.25))
+
+    if not event.contains(db.session, 'after_commit', _after_commit):
+        event.listen(db.session, 'after_commit', _after_commit)
+        event.listen(db.session, 'after_rollback', _after_rollback)
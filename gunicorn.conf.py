@@ -0,0 +1,50 @@
+"""
+Gunicorn configuration - Production multi-worker serving
+
+    gunicorn -c gunicorn.conf.py
+
+The app (including MasterAgent's model weights and tokenizer) is loaded once
+in the master and workers are forked from it, so the model's memory is
+shared copy-on-write instead of loaded once per worker.
+"""
+import gc
+import multiprocessing
+import os
+
+wsgi_app = 'wsgi:app'
+bind = os.environ.get('BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+# Threads serve the long-lived event streams and I/O-bound uploads next to normal requests
+worker_class = 'gthread'
+threads = int(os.environ.get('WORKER_THREADS', 8))
+# Admission control sizes its queues from the thread count
+os.environ.setdefault('WORKER_THREADS', str(threads))
+# Event streams hold a thread each; leave at least half the threads for normal requests
+os.environ.setdefault('EVENTS_MAX_STREAMS', str(max(1, threads // 2)))
+preload_app = True
+timeout = 120
+graceful_timeout = 30
+keepalive = 5
+# Recycle workers now and then; with preloading a new worker is just a fork
+max_requests = int(os.environ.get('MAX_REQUESTS', 10000))
+max_requests_jitter = max_requests // 10
+
+# Workers each have their own event bus, so change events go through a shared log
+if workers > 1:
+    os.environ.setdefault('EVENTS_RELAY_PATH', os.path.abspath('change_events.db'))
+
+# A collection in the master writes to every object's header, which would copy
+# the shared pages into each worker; keep the preloaded heap untouched instead.
+gc.disable()
+
+
+def pre_fork(server, worker):
+    # Move everything allocated so far out of the collector's reach, so
+    # collections in the worker never touch (and copy) the master's pages
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    import wsgi
+    wsgi.after_fork(inference_threads=max(1, multiprocessing.cpu_count() // workers))
+    gc.enable()
@@ -0,0 +1,152 @@
+"""
+Migrations - Bring an existing database up to the current models in place
+"""
+from sqlalchemy import inspect, literal, select, text, update
+
+from database import db, Document, DocumentText, MedicalImage, VitalSegment
+import storage
+import text_store
+
+BATCH_SIZE = 500
+
+
+def _column_ddl(column, dialect):
+    """Column definition for ALTER TABLE ADD COLUMN.
+
+    NOT NULL is only kept when there is a scalar default to fill existing
+    rows with; other columns are added nullable and backfilled below.
+    """
+    ddl = f"{column.name} {column.type.compile(dialect=dialect)}"
+    default = column.default.arg if column.default is not None and column.default.is_scalar else None
+    if default is not None:
+        value = literal(default).compile(dialect=dialect, compile_kwargs={'literal_binds': True})
+        ddl += f" DEFAULT {value}"
+        if not column.nullable:
+            ddl += " NOT NULL"
+    return ddl
+
+
+def add_missing_columns(engine):
+    """Create new tables and add new columns and indexes to existing ones.
+
+    Returns ``(created_tables, added_columns)`` where added_columns maps a
+    table name to the set of columns that were added.
+    """
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    created = {table.name for table in db.metadata.sorted_tables if table.name not in existing_tables}
+    added = {}
+    with engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            present = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in present:
+                    connection.execute(text(
+                        f"ALTER TABLE {table.name} ADD COLUMN {_column_ddl(column, engine.dialect)}"
+                    ))
+                    added.setdefault(table.name, set()).add(column.name)
+            for index in table.indexes:
+                index.create(connection, checkfirst=True)
+    db.metadata.create_all(engine)
+    return created, added
+
+
+def move_parsed_text(db_session, columns):
+    """Copy documents.parsed_text into document_texts with its preview and length. Returns rows moved."""
+    if 'parsed_text' not in columns:
+        return 0
+    moved = 0
+    while True:
+        rows = db_session.execute(text(
+            "SELECT d.id, d.parsed_text FROM documents d "
+            "LEFT JOIN document_texts t ON t.document_id = d.id "
+            "WHERE d.parsed_text IS NOT NULL AND t.document_id IS NULL ORDER BY d.id LIMIT :limit"
+        ), {'limit': BATCH_SIZE}).all()
+        if not rows:
+            break
+        for document_id, parsed_text in rows:
+            codec, blob = text_store.compress_text(parsed_text)
+            db_session.add(DocumentText(document_id=document_id, codec=codec, data=blob))
+            db_session.execute(
+                update(Document).where(Document.id == document_id)
+                .values(text_preview=text_store.preview(parsed_text), text_length=len(parsed_text))
+            )
+        db_session.commit()
+        moved += len(rows)
+    return moved
+
+
+def backfill_upload_hashes(db_session):
+    """Hash uploads stored before the sha256 column existed. Returns the number hashed."""
+    hashed = 0
+    for model in (Document, MedicalImage):
+        last_id = 0
+        while True:
+            rows = db_session.execute(
+                select(model.id, model.file_path)
+                .where(model.sha256.is_(None), model.id > last_id).order_by(model.id).limit(BATCH_SIZE)
+            ).all()
+            if not rows:
+                break
+            for row in rows:
+                try:
+                    sha256 = storage.file_sha256(row.file_path)
+                except FileNotFoundError:
+                    continue
+                db_session.execute(update(model).where(model.id == row.id).values(sha256=sha256))
+                hashed += 1
+            db_session.commit()
+            last_id = rows[-1].id
+    return hashed
+
+
+def backfill_segment_first_ids(db_session):
+    """Record the lowest row id of segments written before first_id existed"""
+    import tiering
+
+    segments = db_session.execute(select(VitalSegment).where(VitalSegment.first_id.is_(None))).scalars().all()
+    for segment in segments:
+        first = next(tiering._segment_rows(segment.blob), None)
+        segment.first_id = first['id'] if first else 0
+    db_session.commit()
+    return len(segments)
+
+
+def drop_column(engine, table, column):
+    """Drop a column the models no longer map, where the database supports it"""
+    try:
+        with engine.begin() as connection:
+            connection.execute(text(f"ALTER TABLE {table} DROP COLUMN {column}"))
+        return True
+    except Exception as e:
+        print(f"Warning: Could not drop {table}.{column}, it is left unused: {str(e)}")
+        return False
+
+
+def upgrade(db_session):
+    """Upgrade the database to the current schema; safe to run repeatedly. Returns a summary."""
+    from agents.family_history_agent import FamilyHistoryAgent
+
+    engine = db_session.get_bind()
+    inspector = inspect(engine)
+    document_columns = set()
+    if inspector.has_table('documents'):
+        document_columns = {column['name'] for column in inspector.get_columns('documents')}
+    created, added = add_missing_columns(engine)
+    summary = {'created_tables': sorted(created), 'added_columns': {t: sorted(c) for t, c in added.items()}}
+
+    summary['texts_moved'] = move_parsed_text(db_session, document_columns)
+    summary['uploads_hashed'] = backfill_upload_hashes(db_session)
+    if 'first_id' in added.get('vital_segments', ()):
+        summary['segments_indexed'] = backfill_segment_first_ids(db_session)
+
+    # Entries recorded before normalisation have no codes and are missing from the aggregates
+    if 'condition_code' in added.get('family_history', ()) or 'patient_condition_risk' in created:
+        summary['family_history_normalised'] = FamilyHistoryAgent().rebuild_aggregates(db_session)
+
+    # Only once everything above has been copied out of it
+    if 'parsed_text' in document_columns:
+        summary['dropped_columns'] = ['documents.parsed_text'] if drop_column(engine, 'documents', 'parsed_text') else []
+    return summary
@@ -0,0 +1,154 @@
+"""
+Resumable Uploads - Chunked upload protocol (init, PUT chunks, commit)
+"""
+import glob
+import hashlib
+import os
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from database import UploadSession, UploadChunk
+
+UPLOAD_KINDS = ('document', 'image')
+STREAM_READ_SIZE = 1024 * 1024
+
+
+class UploadError(ValueError):
+    """Raised when a resumable upload request cannot be honoured"""
+
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def part_path(incoming_dir, upload_id):
+    return os.path.join(incoming_dir, f"{upload_id}.part")
+
+
+def create_session(patient_id, data, incoming_dir, chunk_size, max_size, db_session):
+    """Start an upload and preallocate its part file"""
+    kind = data.get('kind')
+    if kind not in UPLOAD_KINDS:
+        raise UploadError(f"kind must be one of: {', '.join(UPLOAD_KINDS)}")
+
+    try:
+        total_size = int(data.get('total_size'))
+    except (TypeError, ValueError):
+        raise UploadError('total_size must be an integer')
+    if total_size <= 0 or total_size > max_size:
+        raise UploadError(f"total_size must be between 1 and {max_size} bytes", 413 if total_size > max_size else 400)
+
+    upload = UploadSession(
+        id=uuid.uuid4().hex,
+        patient_id=patient_id,
+        kind=kind,
+        filename=data['filename'],
+        total_size=total_size,
+        chunk_size=chunk_size,
+        sha256=(data.get('sha256') or '').lower() or None,
+        fields={key: data[key] for key in ('document_type', 'image_type', 'description') if key in data}
+    )
+
+    os.makedirs(incoming_dir, exist_ok=True)
+    with open(part_path(incoming_dir, upload.id), 'wb') as f:
+        f.truncate(total_size)
+
+    db_session.add(upload)
+    db_session.commit()
+    return upload
+
+
+def write_chunk(upload, index, stream, expected_sha256, incoming_dir, db_session):
+    """Write one chunk at its offset in the part file, verifying its checksum.
+
+    The body is copied from the request stream to disk in small pieces with
+    pwrite, so a chunk is never buffered in memory. A chunk that fails
+    verification is not recorded and can simply be sent again.
+    """
+    if not 0 <= index < upload.total_chunks:
+        raise UploadError(f"Chunk index must be between 0 and {upload.total_chunks - 1}")
+
+    offset = index * upload.chunk_size
+    expected_length = min(upload.chunk_size, upload.total_size - offset)
+    chunk = db_session.get(UploadChunk, (upload.id, index))
+
+    try:
+        checksum = _write_at(part_path(incoming_dir, upload.id), offset, expected_length, stream, index)
+        if expected_sha256 and expected_sha256.lower() != checksum:
+            raise UploadError(f"Checksum mismatch for chunk {index}", 422)
+    except UploadError:
+        # The region may have been partially overwritten, so it must be sent again
+        if chunk:
+            db_session.delete(chunk)
+            db_session.commit()
+        raise
+
+    if chunk:
+        chunk.sha256 = checksum
+    else:
+        db_session.add(UploadChunk(upload_id=upload.id, index=index, sha256=checksum))
+    upload.updated_at = datetime.utcnow()
+    db_session.commit()
+    return checksum
+
+
+def _write_at(path, offset, expected_length, stream, index):
+    """Copy exactly expected_length bytes from stream to path at offset; return their SHA-256"""
+    digest = hashlib.sha256()
+    written = 0
+
+    fd = os.open(path, os.O_WRONLY)
+    try:
+        while written <= expected_length:
+            data = stream.read(min(STREAM_READ_SIZE, expected_length + 1 - written))
+            if not data:
+                break
+            if written + len(data) > expected_length:
+                raise UploadError(f"Chunk {index} is larger than {expected_length} bytes")
+            os.pwrite(fd, data, offset + written)
+            digest.update(data)
+            written += len(data)
+    finally:
+        os.close(fd)
+
+    if written != expected_length:
+        raise UploadError(f"Chunk {index} must be {expected_length} bytes, got {written}")
+    return digest.hexdigest()
+
+
+def missing_chunks(upload):
+    received = {chunk.index for chunk in upload.chunks}
+    return [index for index in range(upload.total_chunks) if index not in received]
+
+
+def discard(upload, incoming_dir, db_session):
+    """Delete an upload session and its part file"""
+    try:
+        os.remove(part_path(incoming_dir, upload.id))
+    except FileNotFoundError:
+        pass
+    db_session.delete(upload)
+    db_session.commit()
+
+
+def purge_stale(incoming_dir, max_age, db_session):
+    """Garbage-collect uploads (and orphaned spool files) idle for max_age seconds"""
+    cutoff = datetime.utcnow() - timedelta(seconds=max_age)
+    stale = db_session.query(UploadSession).filter(UploadSession.updated_at < cutoff).all()
+    for upload in stale:
+        discard(upload, incoming_dir, db_session)
+
+    live = {upload_id for (upload_id,) in db_session.query(UploadSession.id)}
+    removed = len(stale)
+    for path in glob.glob(os.path.join(incoming_dir, '*.part')) + glob.glob(os.path.join(incoming_dir, '.ingest-*')):
+        upload_id = os.path.basename(path).split('.', 1)[0]
+        if upload_id in live:
+            continue
+        try:
+            if os.path.getmtime(path) < time.time() - max_age:
+                os.remove(path)
+                removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
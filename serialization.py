@@ -0,0 +1,122 @@
+"""
+Serialization - Fast JSON and MessagePack encoding for API responses
+"""
+import json
+import uuid
+from datetime import date, datetime
+from decimal import Decimal
+
+from flask import has_request_context, request
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+try:
+    import msgpack
+    MSGPACK_AVAILABLE = True
+except ImportError:
+    MSGPACK_AVAILABLE = False
+
+MSGPACK_MIMETYPES = ('application/msgpack', 'application/x-msgpack')
+
+
+def default_encoder(obj):
+    """Encode values the fast encoders do not handle natively"""
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    if isinstance(obj, uuid.UUID):
+        return str(obj)
+    if isinstance(obj, Decimal):
+        return str(obj)
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not serializable")
+
+
+def _orjson_option(kwargs):
+    """Translate stdlib json keyword arguments into orjson options.
+
+    Returns None when an argument has no orjson equivalent so the caller can
+    fall back to the stdlib encoder.
+    """
+    option = orjson.OPT_NON_STR_KEYS
+    for key, value in kwargs.items():
+        if key == 'indent':
+            if value:
+                option |= orjson.OPT_INDENT_2
+        elif key == 'sort_keys':
+            if value:
+                option |= orjson.OPT_SORT_KEYS
+        elif key in ('separators', 'ensure_ascii'):
+            continue
+        else:
+            return None
+    return option
+
+
+def dumps_bytes(obj, **kwargs):
+    """Serialize obj to UTF-8 JSON bytes, using orjson when available"""
+    if ORJSON_AVAILABLE:
+        option = _orjson_option(kwargs)
+        if option is not None:
+            return orjson.dumps(obj, default=default_encoder, option=option)
+    kwargs.setdefault('default', default_encoder)
+    kwargs.setdefault('ensure_ascii', False)
+    return json.dumps(obj, **kwargs).encode('utf-8')
+
+
+def loads_bytes(data):
+    """Parse JSON from bytes or str, using orjson when available"""
+    if ORJSON_AVAILABLE:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def packb(obj):
+    """Serialize obj to MessagePack bytes"""
+    return msgpack.packb(obj, default=default_encoder, use_bin_type=True)
+
+
+def wants_msgpack():
+    """Check whether the current request prefers MessagePack over JSON"""
+    if not MSGPACK_AVAILABLE or not has_request_context():
+        return False
+    offered = ['application/json', *MSGPACK_MIMETYPES]
+    return request.accept_mimetypes.best_match(offered) in MSGPACK_MIMETYPES
+
+
+class ClinicalJSONProvider(DefaultJSONProvider):
+    """JSON provider backed by orjson with MessagePack content negotiation.
+
+    Datetimes are encoded natively, so models can hand raw column values to
+    ``jsonify`` instead of calling ``isoformat()`` per row.
+    """
+
+    def dumps(self, obj, **kwargs):
+        return dumps_bytes(obj, **kwargs).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        if ORJSON_AVAILABLE and not kwargs:
+            return orjson.loads(s)
+        return super().loads(s, **kwargs)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+
+        if wants_msgpack():
+            response = self._app.response_class(packb(obj), mimetype=MSGPACK_MIMETYPES[0])
+        else:
+            dump_args = {}
+            if (self.compact is None and self._app.debug) or self.compact is False:
+                dump_args['indent'] = 2
+            response = self._app.response_class(
+                dumps_bytes(obj, **dump_args) + b"\n", mimetype=self.mimetype
+            )
+
+        if MSGPACK_AVAILABLE:
+            response.vary.add('Accept')
+        return response
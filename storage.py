@@ -0,0 +1,288 @@
+"""
+Storage - Helpers for storing and serving uploaded files
+"""
+import hashlib
+import mimetypes
+import os
+import re
+import tempfile
+from collections import namedtuple
+
+from flask import Request, abort, current_app, send_file
+from werkzeug.security import safe_join
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Enough leading bytes to recognise every supported format (DICOM needs 132)
+SNIFF_SIZE = 512
+
+IngestResult = namedtuple('IngestResult', ['path', 'sha256', 'size', 'format'])
+
+
+class IngestError(ValueError):
+    """Raised when an upload is rejected during ingestion"""
+    status_code = 400
+
+
+class UploadExistsError(IngestError):
+    """Raised instead of replacing a file that is already stored under the target name"""
+    status_code = 409
+
+# Uploads are saved as "<YYYYmmdd>_<HHMMSS>_<uuid hex>_<name>" or under their content
+# hash, and never replace an existing file, so a given URL never changes content and
+# can be cached forever. Older names without the uuid part may have been reused.
+IMMUTABLE_NAME = re.compile(r'^(\d{8}_\d{6}_[0-9a-f]{32}_.+|[0-9a-f]{64}(\..+)?)$')
+
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+
+def file_sha256(file_path):
+    """Hash a file on disk in fixed-size chunks"""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def move_into_place(src_path, final_path):
+    """Move a file to final_path, raising UploadExistsError rather than replacing a file there"""
+    try:
+        # link() fails if the target exists, so the check and the move are one atomic step
+        os.link(src_path, final_path)
+    except FileExistsError:
+        raise UploadExistsError(f"A file named {os.path.basename(final_path)} is already stored")
+    except OSError:
+        # Filesystems without hard links
+        if os.path.exists(final_path):
+            raise UploadExistsError(f"A file named {os.path.basename(final_path)} is already stored")
+        os.rename(src_path, final_path)
+        return
+    os.unlink(src_path)
+
+
+def sniff_format(head):
+    """Identify a file format from its leading bytes"""
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'png'
+    if head.startswith(b'\xff\xd8\xff'):
+        return 'jpeg'
+    if head.startswith(b'%PDF-'):
+        return 'pdf'
+    if head[128:132] == b'DICM':
+        return 'dicom'
+    return None
+
+
+class IngestSpool:
+    """Upload target that hashes and sniffs bytes while werkzeug spools them.
+
+    The multipart parser writes each uploaded file straight into a temp file
+    inside the upload folder, so ingestion only has to validate the sniffed
+    header and rename the file into place - the body is never read back.
+    The temp file is removed on close unless it has been adopted.
+    """
+
+    def __init__(self, directory):
+        fd, self.path = tempfile.mkstemp(dir=directory, prefix='.ingest-')
+        self._file = os.fdopen(fd, 'w+b')
+        self._digest = hashlib.sha256()
+        self.head = b''
+        self.size = 0
+        self.adopted = False
+
+    def write(self, data):
+        if len(self.head) < SNIFF_SIZE:
+            self.head += bytes(data[:SNIFF_SIZE - len(self.head)])
+        self._digest.update(data)
+        self.size += len(data)
+        return self._file.write(data)
+
+    @property
+    def sha256(self):
+        return self._digest.hexdigest()
+
+    def adopt(self, final_path):
+        """Atomically move the spooled file to its final location"""
+        self._file.flush()
+        move_into_place(self.path, final_path)
+        self.adopted = True
+        self.path = final_path
+
+    def close(self):
+        self._file.close()
+        if not self.adopted:
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+
+    def __iter__(self):
+        return iter(self._file)
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+
+def large_body(config_key):
+    """Let a view accept request bodies up to app.config[config_key] instead of MAX_CONTENT_LENGTH"""
+    def decorator(view):
+        view.max_content_length_key = config_key
+        return view
+    return decorator
+
+
+class UploadRequest(Request):
+    """Request class that spools file uploads through IngestSpool"""
+
+    @property
+    def max_content_length(self):
+        view = current_app.view_functions.get(self.endpoint) if self.endpoint else None
+        config_key = getattr(view, 'max_content_length_key', None)
+        if config_key:
+            return current_app.config[config_key]
+        return super().max_content_length
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        incoming_dir = os.path.join(current_app.config['UPLOAD_FOLDER'], 'incoming')
+        os.makedirs(incoming_dir, exist_ok=True)
+        return IngestSpool(incoming_dir)
+
+
+def _check_header(head, validate):
+    file_format = sniff_format(head)
+    if validate is not None:
+        is_valid, error = validate(head, file_format)
+        if not is_valid:
+            raise IngestError(error)
+    return file_format
+
+
+def ingest_stream(stream, dest_dir, filename, validate=None):
+    """Copy a stream to dest_dir/filename in one pass, hashing as it goes.
+
+    ``validate(head, format)`` is called on the first bytes before anything
+    else is written and returns ``(is_valid, error)``. The file is written to
+    a temp name and renamed into place only once complete.
+    """
+    head = b''
+    while len(head) < SNIFF_SIZE:
+        chunk = stream.read(SNIFF_SIZE - len(head))
+        if not chunk:
+            break
+        head += chunk
+    file_format = _check_header(head, validate)
+
+    fd, tmp_path = tempfile.mkstemp(dir=dest_dir, prefix='.ingest-')
+    digest = hashlib.sha256(head)
+    size = len(head)
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            out.write(head)
+            for chunk in iter(lambda: stream.read(HASH_CHUNK_SIZE), b''):
+                digest.update(chunk)
+                size += len(chunk)
+                out.write(chunk)
+        final_path = os.path.join(dest_dir, filename)
+        move_into_place(tmp_path, final_path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+    return IngestResult(final_path, digest.hexdigest(), size, file_format)
+
+
+def adopt_file(src_path, dest_dir, filename, validate=None):
+    """Validate, hash and atomically move an already-assembled file into dest_dir"""
+    with open(src_path, 'rb') as f:
+        file_format = _check_header(f.read(SNIFF_SIZE), validate)
+    sha256 = file_sha256(src_path)
+    final_path = os.path.join(dest_dir, filename)
+    move_into_place(src_path, final_path)
+    return IngestResult(final_path, sha256, os.path.getsize(final_path), file_format)
+
+
+def ingest_upload(file_storage, dest_dir, filename, validate=None):
+    """Move an uploaded file into dest_dir/filename without re-reading it"""
+    stream = file_storage.stream
+    if not isinstance(stream, IngestSpool):
+        stream.seek(0)
+        return ingest_stream(stream, dest_dir, filename, validate)
+
+    file_format = _check_header(stream.head, validate)
+    final_path = os.path.join(dest_dir, filename)
+    stream.adopt(final_path)
+    return IngestResult(final_path, stream.sha256, stream.size, file_format)
+
+
+def stored_digest(file_path):
+    """Look up the content hash recorded for an uploaded file, if any"""
+    from database import db, Document, MedicalImage
+
+    category = os.path.basename(os.path.dirname(file_path))
+    model = {'documents': Document, 'images': MedicalImage}.get(category)
+    if model is None:
+        return None
+    # Names from before uploads were made unique can be shared by several rows;
+    # the newest one wrote the file that is on disk now
+    return db.session.query(model.sha256).filter_by(file_path=file_path).order_by(model.id.desc()).limit(1).scalar()
+
+
+def send_upload(relative_path):
+    """Serve a file from the upload folder.
+
+    Supports byte ranges and conditional requests, strong ETags from the
+    stored SHA-256, far-future caching for immutable names, and hands the
+    transfer to a front proxy (X-Accel-Redirect) or the WSGI server's
+    sendfile-backed file wrapper when available.
+    """
+    import tiering
+
+    upload_root = current_app.config['UPLOAD_FOLDER']
+    file_path = safe_join(upload_root, relative_path)
+    # Archived uploads are served from a copy rehydrated into the upload folder's cache
+    serve_path = tiering.local_path(file_path) if file_path is not None else None
+    if serve_path is None:
+        abort(404)
+
+    immutable = bool(IMMUTABLE_NAME.match(os.path.basename(file_path)))
+    max_age = IMMUTABLE_MAX_AGE if immutable else current_app.config.get('UPLOADS_MAX_AGE', 0)
+    digest = stored_digest(file_path)
+
+    accel_prefix = current_app.config.get('UPLOADS_ACCEL_REDIRECT_PREFIX')
+    if accel_prefix:
+        response = current_app.response_class()
+        served = os.path.relpath(serve_path, upload_root).replace(os.sep, '/')
+        response.headers['X-Accel-Redirect'] = f"{accel_prefix.rstrip('/')}/{served}"
+        response.mimetype = mimetypes.guess_type(file_path)[0] or 'application/octet-stream'
+        if digest:
+            response.set_etag(digest)
+    else:
+        response = send_file(
+            os.path.abspath(serve_path),
+            mimetype=mimetypes.guess_type(file_path)[0],
+            conditional=True,
+            etag=digest or True,
+            max_age=max_age,
+        )
+
+    return private_cache(response, max_age, immutable)
+
+
+def private_cache(response, max_age, immutable=True):
+    """Let only the user's own browser cache a response; uploads and their derivatives are patient data.
+
+    send_file marks anything with a max-age public, which would let shared
+    proxies and CDNs keep a copy.
+    """
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.max_age = max_age
+    if immutable:
+        response.cache_control.no_cache = None
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response
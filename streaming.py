@@ -0,0 +1,69 @@
+"""
+Streaming - ORM-free list queries encoded incrementally as JSON
+"""
+from flask import current_app, jsonify, stream_with_context
+from sqlalchemy import select
+
+from database import db
+from serialization import MSGPACK_AVAILABLE, dumps_bytes, wants_msgpack
+
+BATCH_SIZE = 1000
+
+
+def list_select(model):
+    """Core select of a model's list columns, in the same shape as its to_dict()"""
+    table = model.__table__
+    return select(*(table.c[name] for name in model.list_columns))
+
+
+def iter_batches(statement, batch_size=BATCH_SIZE, formatters=None, db_session=None):
+    """Yield lists of row dicts from a Core select, batch_size rows at a time.
+
+    Rows come straight off the connection with yield_per, so no ORM
+    instances or identity map entries are created and memory is bounded by
+    the batch size rather than the result size.
+    """
+    connection = (db_session or db.session).connection()
+    result = connection.execution_options(yield_per=batch_size).execute(statement)
+    for partition in result.mappings().partitions():
+        rows = [dict(row) for row in partition]
+        if formatters:
+            for row in rows:
+                for key, formatter in formatters.items():
+                    row[key] = formatter(row[key])
+        yield rows
+
+
+def _json_array(batches):
+    yield b'['
+    first = True
+    for rows in batches:
+        if not rows:
+            continue
+        # Each batch is encoded as one array and spliced into the outer one
+        chunk = dumps_bytes(rows)[1:-1]
+        yield chunk if first else b',' + chunk
+        first = False
+    yield b']\n'
+
+
+def stream_list(statement, batch_size=BATCH_SIZE, formatters=None):
+    """Respond with the rows of statement as a JSON array, encoded batch by batch"""
+    return stream_batches(iter_batches(statement, batch_size, formatters))
+
+
+def stream_batches(batches):
+    """Respond with an iterable of row lists as one JSON array.
+
+    MessagePack needs the array length up front, so clients that ask for it
+    get a buffered (but still ORM-free) response instead.
+    """
+    if wants_msgpack():
+        return jsonify([row for rows in batches for row in rows])
+
+    response = current_app.response_class(
+        stream_with_context(_json_array(batches)), mimetype='application/json'
+    )
+    if MSGPACK_AVAILABLE:
+        response.vary.add('Accept')
+    return response
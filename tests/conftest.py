@@ -0,0 +1,39 @@
+"""
+Shared fixtures: the app against a throwaway SQLite database and upload folder
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKDIR = tempfile.mkdtemp(prefix='clinical-assistant-tests-')
+
+# Config is read when the app is imported, so these must be set first
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(WORKDIR, 'test.db')}"
+os.environ['ADMISSION_CONTROL'] = '0'
+sys.path.insert(0, ROOT)
+os.chdir(WORKDIR)
+
+
+@pytest.fixture
+def app():
+    from app import app, db
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+    yield app
+    with app.app_context():
+        db.session.remove()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def patient_id(client):
+    return client.post('/api/patients', json={'name': 'Test Patient'}).get_json()['id']
@@ -0,0 +1,45 @@
+"""
+Bulk import: bad records are reported per line and the rest are imported
+"""
+import json
+
+from database import DentalAssessment, Patient
+
+
+def _import(client, records):
+    body = '\n'.join(json.dumps(record) for record in records)
+    return client.post('/api/import?format=ndjson', data=body, content_type='application/x-ndjson')
+
+
+def test_non_string_tooth_condition_is_a_record_error(app, client):
+    response = _import(client, [
+        {'name': 'First', 'teeth': {'t1': 'cavity'}},
+        {'name': 'Second', 'teeth': {'t2': 5}},
+        {'name': 'Third', 'teeth': {'t3': {'nested': 'root'}}},
+        {'name': 'Fourth', 'teeth': {'t4': 'root'}},
+    ])
+
+    assert response.status_code == 200
+    summary = response.get_json()
+    assert summary['patients_created'] == 2
+    assert [error['line'] for error in summary['errors']] == [2, 3]
+    assert 'Invalid condition for t2' in summary['errors'][0]['error']
+    with app.app_context():
+        assert {patient.name for patient in Patient.query.all()} == {'First', 'Fourth'}
+        assert {row.tooth_id: row.condition for row in DentalAssessment.query.all()} == {'t1': 'cavity', 't4': 'root'}
+
+
+def test_wrong_field_type_is_a_record_error(client):
+    response = _import(client, [{'name': 5}, {'name': 'Valid'}])
+
+    summary = response.get_json()
+    assert response.status_code == 200
+    assert summary['patients_created'] == 1
+    assert summary['errors'][0]['line'] == 1
+
+
+def test_non_string_condition_on_tooth_route_is_not_an_error(client, patient_id):
+    response = client.post(f'/api/patients/{patient_id}/teeth', json={'tooth_id': 't2', 'condition': 5})
+
+    assert response.status_code == 200
+    assert response.get_json()['action'] == 'removed'
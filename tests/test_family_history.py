@@ -0,0 +1,45 @@
+"""
+Hereditary-risk index: how family history entries are counted as relatives
+"""
+
+
+def add_history(client, patient_id, relation, condition='Breast cancer'):
+    response = client.post(
+        f'/api/patients/{patient_id}/family-history', json={'condition': condition, 'relation': relation}
+    )
+    assert response.status_code == 201
+
+
+def hereditary_risk(client, **params):
+    return client.get('/api/analytics/family-history', query_string=params).get_json()['hereditary_risk']
+
+
+def test_two_affected_sisters_reach_the_default_threshold(client, patient_id):
+    add_history(client, patient_id, 'Sister')
+    add_history(client, patient_id, 'Sister')
+
+    risk = hereditary_risk(client)
+    assert risk['min_first_degree_relatives'] == 2
+    assert risk['patients'] == [
+        {'patient_id': patient_id, 'condition': 'breast_cancer', 'first_degree_relatives': 2}
+    ]
+
+
+def test_repeated_entries_for_a_parent_count_once(client, patient_id):
+    add_history(client, patient_id, 'Mother')
+    add_history(client, patient_id, 'mom', condition='breast carcinoma')
+    add_history(client, patient_id, 'Mother')
+
+    assert hereditary_risk(client)['patients'] == []
+    assert hereditary_risk(client, min_first_degree=1)['patients'][0]['first_degree_relatives'] == 1
+
+
+def test_rebuild_gives_the_same_counts(app, client, patient_id):
+    for relation in ('Mother', 'Mother', 'Brother', 'Brother', 'Aunt'):
+        add_history(client, patient_id, relation)
+    before = hereditary_risk(client)
+
+    result = app.test_cli_runner().invoke(args=['rebuild-family-aggregates'])
+    assert result.exit_code == 0
+    assert hereditary_risk(client) == before
+    assert before['patients'][0]['first_degree_relatives'] == 3
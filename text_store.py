@@ -0,0 +1,62 @@
+"""
+Text Store - Compressed, out-of-row storage for parsed document text
+"""
+import zlib
+
+try:
+    import zstandard
+    ZSTD_AVAILABLE = True
+except ImportError:
+    ZSTD_AVAILABLE = False
+
+PREVIEW_LENGTH = 500
+ZSTD_LEVEL = 9
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Codec name -> HTTP content coding that carries the same bytes
+CONTENT_CODINGS = {
+    'zstd': 'zstd',
+    'zlib': 'deflate',
+}
+
+
+def preferred_codec():
+    return 'zstd' if ZSTD_AVAILABLE else 'zlib'
+
+
+def compress_text(text, codec=None):
+    """Compress UTF-8 text; returns (codec, blob)"""
+    codec = codec or preferred_codec()
+    data = text.encode('utf-8')
+    if codec == 'zstd':
+        return codec, zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    return 'zlib', zlib.compress(data, 9)
+
+
+def iter_text_bytes(codec, blob, chunk_size=STREAM_CHUNK_SIZE):
+    """Decompress a blob incrementally, yielding UTF-8 byte chunks"""
+    if codec == 'zstd':
+        reader = zstandard.ZstdDecompressor().stream_reader(blob)
+        while True:
+            chunk = reader.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+        return
+
+    decompressor = zlib.decompressobj()
+    for offset in range(0, len(blob), chunk_size):
+        chunk = decompressor.decompress(blob[offset:offset + chunk_size])
+        if chunk:
+            yield chunk
+    tail = decompressor.flush()
+    if tail:
+        yield tail
+
+
+def decompress_text(codec, blob):
+    return b''.join(iter_text_bytes(codec, blob)).decode('utf-8')
+
+
+def preview(text, length=PREVIEW_LENGTH):
+    return text[:length] if text else None
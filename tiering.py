@@ -0,0 +1,505 @@
+"""
+Tiering - Cold storage of idle uploads and old vitals in compressed, content-addressed packs
+"""
+import hashlib
+import heapq
+import itertools
+import os
+import tempfile
+import time
+import uuid
+import zlib
+from collections import deque
+from datetime import datetime, timedelta
+from operator import itemgetter
+
+from flask import current_app
+from sqlalchemy import delete, func, select, update
+
+from database import db, Document, MedicalImage, Vital, PackBlob, ArchivedUpload, VitalSegment, touch_section
+from serialization import dumps_bytes, loads_bytes
+import storage
+import streaming
+
+try:
+    import zstandard
+    ZSTD_AVAILABLE = True
+except ImportError:
+    ZSTD_AVAILABLE = False
+
+READ_SIZE = 1024 * 1024
+ZSTD_LEVEL = 6
+ZLIB_LEVEL = 6
+# Formats that are already compressed are stored as-is
+INCOMPRESSIBLE_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.pdf', '.zip', '.gz'}
+UPLOAD_MODELS = (Document, MedicalImage)
+UPLOAD_SECTIONS = {Document: 'documents', MedicalImage: 'images'}
+CACHE_TOUCH_INTERVAL = 60  # Seconds; how stale a cached file's mtime may get before a hit refreshes it
+CACHE_EVICTION_GRACE = 600  # Seconds after its last hit that a cached file cannot be evicted
+SEGMENT_READ_SIZE = 64 * 1024  # Compressed bytes of a vitals segment decoded at a time
+VITALS_BATCH_ROWS = 50000  # Old vitals rows moved per transaction
+DELETE_CHUNK = 5000
+
+
+def preferred_codec():
+    return 'zstd' if ZSTD_AVAILABLE else 'zlib'
+
+
+def _compressor(codec):
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+    if codec == 'zlib':
+        return zlib.compressobj(ZLIB_LEVEL)
+    return None
+
+
+def _decompressor(codec):
+    if codec == 'zstd':
+        return zstandard.ZstdDecompressor().decompressobj()
+    if codec == 'zlib':
+        return zlib.decompressobj()
+    return None
+
+
+def _file_chunks(file_path, chunk_size=READ_SIZE):
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            yield chunk
+
+
+class PackWriter:
+    """Append independently compressed blobs to pack files.
+
+    Packs are only ever appended to and a new one is started once the
+    current file passes max_size. Nothing refers to the bytes written until
+    ``sync`` has made them durable and the index rows are committed, so an
+    interrupted run leaves at most some unreferenced bytes behind.
+    """
+
+    def __init__(self, pack_dir, max_size):
+        self.pack_dir = pack_dir
+        self.max_size = max_size
+        self.name = None
+        self._file = None
+
+    def _rotate(self):
+        self.close()
+        os.makedirs(self.pack_dir, exist_ok=True)
+        self.name = f"pack-{datetime.utcnow():%Y%m%d%H%M%S}-{uuid.uuid4().hex[:8]}.pack"
+        self._file = open(os.path.join(self.pack_dir, self.name), 'xb')
+
+    def write(self, chunks, codec):
+        """Append one blob from an iterable of bytes; returns (sha256, PackBlob column values)"""
+        if self._file is None or self._file.tell() >= self.max_size:
+            self._rotate()
+        offset = self._file.tell()
+        compressor = _compressor(codec)
+        digest = hashlib.sha256()
+        size = 0
+        for chunk in chunks:
+            digest.update(chunk)
+            size += len(chunk)
+            self._file.write(compressor.compress(chunk) if compressor else chunk)
+        if compressor:
+            self._file.write(compressor.flush())
+        return digest.hexdigest(), {
+            'pack': self.name,
+            'offset': offset,
+            'length': self._file.tell() - offset,
+            'size': size,
+            'codec': codec,
+        }
+
+    def sync(self):
+        if self._file:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        if self._file:
+            self.sync()
+            self._file.close()
+            self._file = None
+
+
+def pack_writer():
+    return PackWriter(current_app.config['TIER_PACK_FOLDER'], current_app.config['TIER_PACK_MAX_SIZE'])
+
+
+def iter_blob(blob, chunk_size=READ_SIZE):
+    """Yield the decompressed content of a pack blob in pieces"""
+    decompressor = _decompressor(blob.codec)
+    with open(os.path.join(current_app.config['TIER_PACK_FOLDER'], blob.pack), 'rb') as f:
+        f.seek(blob.offset)
+        remaining = blob.length
+        while remaining:
+            data = f.read(min(chunk_size, remaining))
+            if not data:
+                raise IOError(f"Pack {blob.pack} is truncated")
+            remaining -= len(data)
+            if decompressor:
+                data = decompressor.decompress(data)
+            if data:
+                yield data
+    if decompressor:
+        tail = decompressor.flush()
+        if tail:
+            yield tail
+
+
+# ------------------------------------------------------------------ uploads
+
+def cache_folder():
+    return os.path.join(current_app.config['UPLOAD_FOLDER'], 'cache')
+
+
+def rehydrate(blob, extension=''):
+    """Path of a verified copy of a blob in the cache, extracting it on first use"""
+    cache_dir = cache_folder()
+    cached_path = os.path.join(cache_dir, blob.sha256 + extension.lower())
+    try:
+        if time.time() - os.path.getmtime(cached_path) > CACHE_TOUCH_INTERVAL:
+            os.utime(cached_path)  # Recently used files survive trim_cache
+        return cached_path
+    except FileNotFoundError:
+        pass
+
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix='.rehydrate-')
+    digest = hashlib.sha256()
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            for chunk in iter_blob(blob):
+                digest.update(chunk)
+                out.write(chunk)
+        if digest.hexdigest() != blob.sha256:
+            raise IOError(f"Pack blob {blob.sha256} failed verification")
+        os.replace(tmp_path, cached_path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+    trim_cache(current_app.config['TIER_CACHE_MAX_SIZE'])
+    return cached_path
+
+
+def local_path(file_path):
+    """Readable path for an upload: the file itself, or a rehydrated copy if it
+    has been archived. None if the upload exists in neither place."""
+    if os.path.isfile(file_path):
+        return file_path
+    archived = db.session.get(ArchivedUpload, file_path)
+    if archived is None:
+        return None
+    return rehydrate(archived.blob, os.path.splitext(file_path)[1])
+
+
+def upload_chunks(file_path, chunk_size=READ_SIZE):
+    """Iterator over an upload's bytes, read from disk or straight from its pack
+    without going through the cache. None if the upload is missing."""
+    archived = None if os.path.isfile(file_path) else db.session.get(ArchivedUpload, file_path)
+    return read_upload(file_path, archived.blob if archived else None, chunk_size)
+
+
+def read_upload(file_path, blob, chunk_size=READ_SIZE):
+    """Iterator over an upload's bytes from disk, or from blob if it has been archived.
+
+    blob is a PackBlob or any row with its pack, offset, length and codec, so
+    the caller can look it up first and read after its transaction has ended.
+    None if the upload is in neither place.
+    """
+    if os.path.isfile(file_path):
+        return _file_chunks(file_path, chunk_size)
+    if blob is None:
+        return None
+    return iter_blob(blob, chunk_size)
+
+
+def trim_cache(max_size):
+    """Delete least recently used rehydrated files until the cache fits max_size; returns bytes freed.
+
+    Files hit within CACHE_EVICTION_GRACE are kept even if the cache stays
+    over size: local_path may just have returned them to a caller that has
+    not opened them yet.
+    """
+    cutoff = time.time() - CACHE_TOUCH_INTERVAL - CACHE_EVICTION_GRACE
+    entries = []
+    try:
+        for entry in os.scandir(cache_folder()):
+            if entry.name.startswith('.'):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    except FileNotFoundError:
+        return 0
+
+    excess = sum(size for _, size, _ in entries) - max_size
+    freed = 0
+    for mtime, size, path in sorted(entries):
+        if freed >= excess or mtime > cutoff:
+            break
+        try:
+            os.unlink(path)
+            freed += size
+        except FileNotFoundError:
+            pass
+    return freed
+
+
+def _upload_pages(db_session, model, batch_size):
+    last_id = 0
+    while True:
+        rows = db_session.execute(
+            select(model.id, model.patient_id, model.file_path, model.sha256)
+            .where(model.id > last_id).order_by(model.id).limit(batch_size)
+        ).all()
+        if not rows:
+            return
+        yield rows
+        last_id = rows[-1].id
+
+
+def archive_idle_uploads(db_session, idle_days, writer, batch_size=100):
+    """Move uploads not read or written for idle_days into packs.
+
+    Idleness is the later of the file's access and modification times, so it
+    relies on the filesystem updating atime (the default relatime does, at
+    most once a day). Identical files are stored once. Originals are removed
+    only after the pack is synced and its index committed. Returns
+    ``(files, bytes)`` moved.
+    """
+    cutoff = time.time() - idle_days * 86400
+    files = moved_bytes = 0
+    for model in UPLOAD_MODELS:
+        for rows in _upload_pages(db_session, model, batch_size):
+            candidates = []
+            for row in rows:
+                try:
+                    stat = os.stat(row.file_path)
+                except FileNotFoundError:
+                    continue
+                if max(stat.st_atime, stat.st_mtime) < cutoff:
+                    candidates.append((row, stat.st_size))
+            if not candidates:
+                continue
+
+            paths = [row.file_path for row, _ in candidates]
+            already_archived = set(db_session.execute(
+                select(ArchivedUpload.file_path).where(ArchivedUpload.file_path.in_(paths))
+            ).scalars())
+            digests = {row.file_path: row.sha256 or storage.file_sha256(row.file_path) for row, _ in candidates}
+            stored = set(db_session.execute(
+                select(PackBlob.sha256).where(PackBlob.sha256.in_(set(digests.values())))
+            ).scalars())
+
+            removable = [path for path in paths if path in already_archived]
+            for row, size in candidates:
+                if row.file_path in already_archived:
+                    continue
+                sha256 = digests[row.file_path]
+                if sha256 not in stored:
+                    extension = os.path.splitext(row.file_path)[1].lower()
+                    codec = 'none' if extension in INCOMPRESSIBLE_EXTENSIONS else preferred_codec()
+                    written, values = writer.write(_file_chunks(row.file_path), codec)
+                    if written != sha256:
+                        print(f"Warning: {row.file_path} does not match its recorded hash; left in place")
+                        continue
+                    db_session.add(PackBlob(sha256=sha256, **values))
+                    stored.add(sha256)
+                if row.sha256 is None:
+                    # The digest is part of the list payload
+                    db_session.execute(update(model).where(model.id == row.id).values(sha256=sha256))
+                    touch_section(db_session, row.patient_id, UPLOAD_SECTIONS[model])
+                db_session.add(ArchivedUpload(file_path=row.file_path, sha256=sha256))
+                already_archived.add(row.file_path)
+                removable.append(row.file_path)
+                files += 1
+                moved_bytes += size
+
+            writer.sync()
+            db_session.commit()
+            for path in removable:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+    return files, moved_bytes
+
+
+# ------------------------------------------------------------------- vitals
+
+def _encode_segment(rows):
+    return b''.join(dumps_bytes(row) + b'\n' for row in rows)
+
+
+def _decode_row(line):
+    row = loads_bytes(line)
+    if row['recorded_at']:
+        row['recorded_at'] = datetime.fromisoformat(row['recorded_at'])
+    return row
+
+
+def _segment_rows(blob):
+    """Rows of a vitals segment in id order, decoded as the blob is read"""
+    pending = b''
+    for data in iter_blob(blob, SEGMENT_READ_SIZE):
+        lines = (pending + data).split(b'\n')
+        pending = lines.pop()
+        for line in lines:
+            if line:
+                yield _decode_row(line)
+    if pending:
+        yield _decode_row(pending)
+
+
+def _merge_segments(segments):
+    """Rows of segments (ordered by first_id) in id order.
+
+    Months mostly cover increasing id ranges, but late arrivals make them
+    overlap, so this is a k-way merge that only opens a segment once the
+    merge reaches its first id. Usually one segment is being read at a time.
+    """
+    waiting = deque(segments)
+    heap = []
+    sequence = itertools.count()  # Tie-breaker, so rows themselves are never compared
+    while heap or waiting:
+        while waiting and (not heap or waiting[0].first_id <= heap[0][0]):
+            rows = _segment_rows(waiting.popleft().blob)
+            row = next(rows, None)
+            if row is not None:
+                heapq.heappush(heap, (row['id'], next(sequence), row, rows))
+        _, _, row, rows = heap[0]
+        following = next(rows, None)
+        if following is None:
+            heapq.heappop(heap)
+        else:
+            heapq.heapreplace(heap, (following['id'], next(sequence), following, rows))
+        yield row
+
+
+def archived_vitals(db_session, patient_ids):
+    """Archived vitals rows of the given patients, as {patient_id: rows in id order}"""
+    segments = db_session.execute(
+        select(VitalSegment).where(VitalSegment.patient_id.in_(patient_ids))
+        .order_by(VitalSegment.patient_id, VitalSegment.first_id)
+    ).scalars()
+    return {
+        patient_id: list(_merge_segments(patient_segments))
+        for patient_id, patient_segments in itertools.groupby(segments, key=lambda segment: segment.patient_id)
+    }
+
+
+def merge_vitals(archived, hot):
+    """Merge two id-ordered iterables of vitals rows"""
+    return heapq.merge(archived, hot, key=itemgetter('id'))
+
+
+def vitals_batches(db_session, patient_id, batch_size=streaming.BATCH_SIZE):
+    """Yield a patient's vitals in id order, from the vitals table and archived segments.
+
+    Archived segments are streamed from their packs as the merge reaches them.
+    """
+    segments = db_session.execute(
+        select(VitalSegment).where(VitalSegment.patient_id == patient_id).order_by(VitalSegment.first_id)
+    ).scalars().all()
+    statement = streaming.list_select(Vital).where(Vital.patient_id == patient_id).order_by(Vital.id)
+    batches = streaming.iter_batches(statement, batch_size, db_session=db_session)
+    if not segments:
+        yield from batches
+        return
+
+    merged = merge_vitals(_merge_segments(segments), (row for rows in batches for row in rows))
+    while True:
+        batch = list(itertools.islice(merged, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def _month_start(moment):
+    return moment.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def _patient_chunks(counts, max_rows):
+    """Group (patient_id, rows) pairs so each group has about max_rows rows"""
+    chunk, total = [], 0
+    for patient_id, count in counts:
+        if chunk and total + count > max_rows:
+            yield chunk
+            chunk, total = [], 0
+        chunk.append(patient_id)
+        total += count
+    if chunk:
+        yield chunk
+
+
+def _write_segment(db_session, writer, patient_id, month, rows):
+    segment = db_session.get(VitalSegment, (patient_id, month))
+    replaced = None
+    if segment is not None:
+        # Late arrivals for an archived month are merged into its segment
+        new_ids = {row['id'] for row in rows}
+        rows = sorted(
+            [row for row in _segment_rows(segment.blob) if row['id'] not in new_ids] + rows,
+            key=itemgetter('id')
+        )
+        replaced = segment.sha256
+
+    data = _encode_segment(rows)
+    sha256 = hashlib.sha256(data).hexdigest()
+    if db_session.get(PackBlob, sha256) is None:
+        _, values = writer.write([data], preferred_codec())
+        db_session.add(PackBlob(sha256=sha256, **values))
+
+    if segment is None:
+        segment = VitalSegment(patient_id=patient_id, month=month)
+        db_session.add(segment)
+    segment.sha256 = sha256
+    segment.row_count = len(rows)
+    segment.first_id = rows[0]['id']
+    segment.archived_at = datetime.utcnow()
+    if replaced and replaced != sha256:
+        # Its bytes stay in the pack, but nothing can refer to them any more
+        db_session.flush()
+        db_session.execute(delete(PackBlob).where(PackBlob.sha256 == replaced))
+
+
+def archive_old_vitals(db_session, age_days, writer):
+    """Move vitals recorded in whole months older than age_days into one pack
+    segment per patient and month. Returns the number of rows moved."""
+    cutoff = _month_start(datetime.utcnow() - timedelta(days=age_days))
+    table = Vital.__table__
+    counts = db_session.execute(
+        select(table.c.patient_id, func.count())
+        .where(table.c.recorded_at < cutoff)
+        .group_by(table.c.patient_id).order_by(table.c.patient_id)
+    ).all()
+
+    moved = 0
+    for patient_ids in _patient_chunks(counts, VITALS_BATCH_ROWS):
+        rows = db_session.execute(
+            streaming.list_select(Vital)
+            .where(table.c.patient_id.in_(patient_ids), table.c.recorded_at < cutoff)
+            .order_by(table.c.patient_id, table.c.id)
+        ).mappings().all()
+
+        segments = {}
+        for row in rows:
+            key = (row['patient_id'], row['recorded_at'].strftime('%Y-%m'))
+            segments.setdefault(key, []).append(dict(row))
+        for (patient_id, month), segment_rows in segments.items():
+            _write_segment(db_session, writer, patient_id, month, segment_rows)
+
+        ids = [row['id'] for row in rows]
+        for offset in range(0, len(ids), DELETE_CHUNK):
+            db_session.execute(delete(Vital).where(Vital.id.in_(ids[offset:offset + DELETE_CHUNK])))
+        writer.sync()
+        db_session.commit()
+        moved += len(ids)
+    return moved
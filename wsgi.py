@@ -0,0 +1,15 @@
+"""
+WSGI entry point - Application object for production servers (see gunicorn.conf.py)
+"""
+from app import app, db, master_agent
+from database import dispose_engine
+import migrations
+
+with app.app_context():
+    migrations.upgrade(db.session)
+
+
+def after_fork(inference_threads=1):
+    """Reset state a worker must not share with the process it was forked from"""
+    dispose_engine(app)
+    master_agent.after_fork(inference_threads)